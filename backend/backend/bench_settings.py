@@ -0,0 +1,58 @@
+"""
+Settings for offline benchmarks such as `manage.py replay_attendance`
+
+SQLite, an in-memory channel layer and control channel and immediate huey tasks,
+so neither postgres nor redis is needed. Uploads and classifier artifacts live
+in .fuskar-bench so a benchmark never touches the real gallery.
+
+    python manage.py migrate --settings=backend.bench_settings
+    python manage.py replay_attendance lecture.avi --gallery students/ --settings=backend.bench_settings
+"""
+from backend.settings import *
+
+# replay_attendance refuses to run against any other settings
+BENCHMARK = True
+BENCH_ROOT = os.path.join(BASE_DIR, '.fuskar-bench')
+os.makedirs(os.path.join(BENCH_ROOT, 'cache'), exist_ok=True)
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BENCH_ROOT, 'db.sqlite3'),
+    }
+}
+
+CHANNEL_LAYERS = {
+    "default": {
+        "BACKEND": "channels.layers.InMemoryChannelLayer",
+    },
+}
+
+CONTROL_CHANNEL = {
+    "BACKEND": "fuskar.utils.control.LocalControlChannel",
+}
+
+# tasks run inline with in-memory storage for their locks
+HUEY = {
+    'name': 'fuskar-bench',
+    'immediate': True,
+}
+
+# models are loaded by the benchmark process itself
+INFERENCE_WORKER_ENABLED = False
+
+MEDIA_ROOT = MEDIA_PATH = os.path.join(BENCH_ROOT, 'media')
+TRAIN_DIR = os.path.join(MEDIA_PATH, 'images')
+
+SVM_EMBEDDING_MAP = os.path.join(BENCH_ROOT, 'cache', 'svm-embedding-map.pkl')
+KNN_EMBEDDING_MAP = os.path.join(BENCH_ROOT, 'cache', 'knn-embedding-map.pkl')
+ENCODING_LIST = os.path.join(BENCH_ROOT, 'cache', 'encoding-list.pkl')
+ANN_INDEX = os.path.join(BENCH_ROOT, 'cache', 'ann-index.npz')
+PATH_TO_EMBEDDING_DICT = os.path.join(BENCH_ROOT, 'cache', 'path-to-embedding-dict.pkl')
+EMBEDDING_STORE = os.path.join(BENCH_ROOT, 'cache', 'embeddings')
+RETRAIN_STATE = os.path.join(BENCH_ROOT, 'cache', 'retrain-state.json')
+PHASH_INDEX = os.path.join(BENCH_ROOT, 'cache', 'phash-index.pkl')
+PCA_GRAPH = os.path.join(BENCH_ROOT, 'images', 'pca-3d.png')
+
+# metrics stay inside the benchmark process
+METRICS_MULTIPROC_DIR = None
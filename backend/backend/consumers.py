@@ -2,21 +2,248 @@
 Consumers for routing object
 """
 import json
+import asyncio
+import threading
+from urllib.parse import parse_qs
+from collections import Counter
 from asgiref.sync import async_to_sync
 from channels.generic.websocket import WebsocketConsumer
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 
 
 
 class LectureConsumer(WebsocketConsumer):
+    """
+    Sends a lecture snapshot on connect, then the compact deltas
+    coalesced by fuskar.utils.broadcast.LectureBroadcaster
+    """
 
     def connect(self):
         self.accept()
-        lecture_id = self.scope["url_route"]["kwargs"]["pk"]
-        async_to_sync(self.channel_layer.group_add)(f'lectures_update_group_{lecture_id}', self.channel_name)
+        self.lecture_id = self.scope["url_route"]["kwargs"]["pk"]
+        self.students_present = set()
+        self.emotions = Counter()
+        async_to_sync(self.channel_layer.group_add)(f'lectures_update_group_{self.lecture_id}', self.channel_name)
+        self.send_snapshot()
 
     def disconnect(self, close_code):
-        pass
+        async_to_sync(self.channel_layer.group_discard)(f'lectures_update_group_{self.lecture_id}', self.channel_name)
+
+    def send_snapshot(self):
+        from fuskar.models import Lecture
+        from fuskar.serializers import LectureSerializer
+
+        lecture = Lecture.objects.prefetch_related('emotion_buckets').filter(id=self.lecture_id).first()
+        if lecture:
+            self.lecture_snapshot({'message': LectureSerializer(lecture).data})
 
     def trigger(self, event):
         message = event['message']
-        self.send(text_data=json.dumps(message))
\ No newline at end of file
+        self.send(text_data=json.dumps(message, cls=DjangoJSONEncoder))
+
+    def lecture_snapshot(self, event):
+        """
+        Replace the known state and send the full lecture
+        """
+        message = event['message']
+        self.students_present = set(message['students_present'])
+        self.emotions = Counter(message['emotions'])
+        self.send(text_data=json.dumps(dict(message, type='snapshot'), cls=DjangoJSONEncoder))
+
+    def lecture_delta(self, event):
+        """
+        Apply a delta to the known state and send only what is new to this client
+        """
+        message = event['message']
+        new_students = [student for student in message['students_present'] if student not in self.students_present]
+        self.students_present.update(new_students)
+        self.emotions.update(message['emotions'])
+        if not new_students and not message['emotions']:
+            return
+        self.send(text_data=json.dumps({
+            'type': 'delta',
+            'id': message['id'],
+            'students_present': new_students,
+            'emotions': message['emotions'],
+        }))
+
+
+class VideoStreamConsumer(object):
+    """
+    Streams the live preview as MJPEG without holding a worker thread per viewer
+
+    Query parameters: width (pixels), fps and quality (JPEG, 10-95). Frames go
+    through a bounded queue per viewer, when the viewer cannot keep up the
+    oldest queued frame is dropped so it always receives the newest ones.
+    """
+    headers = [
+        (b'content-type', b'multipart/x-mixed-replace;boundary=frame'),
+        (b'cache-control', b'no-cache'),
+        (b'access-control-allow-origin', b'*'),
+    ]
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.sent = 0
+        self.dropped = 0
+        # set by the stop messages published after this viewer connected,
+        # the stream stop flag of the legacy /video stream is ignored
+        self.stream_stop = threading.Event()
+        self.frame_broadcaster = None
+        # subscribing runs in the executor and may race the end of the connection
+        self.subscription_lock = threading.Lock()
+        self.closed = False
+
+    def options(self):
+        """
+        Width, frames per second and quality requested in the query string,
+        rounded so viewers asking for similar streams share encoded frames
+        """
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        width = int(query.get('width', [settings.STREAM_WIDTH])[0])
+        fps = float(query.get('fps', [settings.STREAM_MAX_FPS])[0])
+        quality = int(query.get('quality', [settings.STREAM_JPEG_QUALITY])[0])
+        if width <= 0 or fps <= 0 or not 10 <= quality <= 95:
+            raise ValueError("width and fps must be positive and quality between 10 and 95")
+        width = width if width == settings.STREAM_WIDTH else max(80, width // 80 * 80)
+        quality = quality if quality == settings.STREAM_JPEG_QUALITY else quality // 5 * 5
+        return width, min(fps, settings.STREAM_MAX_FPS), quality
+
+    async def reject(self, send, status, detail):
+        await send({'type': 'http.response.start', 'status': status, 'headers': [(b'content-type', b'text/plain')]})
+        await send({'type': 'http.response.body', 'body': detail.encode()})
+
+    def start_stream(self, source):
+        """
+        Listen for stream stops and subscribe to the source's frame broadcaster
+        """
+        self.watch_stop()
+        self.subscribe(source)
+
+    def on_stream_stop(self, message):
+        self.stream_stop.set()
+
+    def watch_stop(self):
+        """
+        Stop this viewer on every stop published from now on, earlier ones do not apply to it
+        """
+        from fuskar.utils.control import get_control_channel, STREAM_STOP
+
+        get_control_channel().subscribe(STREAM_STOP, self.on_stream_stop)
+
+    def subscribe(self, source):
+        """
+        Register with the running frame broadcaster of the source,
+        a new one is started if the previous one idled out or lost its source
+        """
+        from fuskar.utils.stream import get_frame_broadcaster
+
+        frame_broadcaster = get_frame_broadcaster(source)
+        with self.subscription_lock:
+            if not self.closed:
+                if self.frame_broadcaster is not None:
+                    self.frame_broadcaster.release()
+                frame_broadcaster.acquire()
+                self.frame_broadcaster = frame_broadcaster
+        return frame_broadcaster
+
+    def unsubscribe(self):
+        from fuskar.utils.control import get_control_channel, STREAM_STOP
+
+        get_control_channel().unsubscribe(STREAM_STOP, self.on_stream_stop)
+        with self.subscription_lock:
+            self.closed = True
+            if self.frame_broadcaster is not None:
+                self.frame_broadcaster.release()
+                self.frame_broadcaster = None
+
+    def stop_requested(self):
+        """
+        True once the stream was stopped after this viewer connected
+        """
+        return self.stream_stop.is_set()
+
+    async def __call__(self, receive, send):
+        try:
+            width, fps, quality = self.options()
+        except ValueError as exc:
+            await self.reject(send, 400, str(exc))
+            return
+        source = self.scope['url_route']['kwargs'].get('source', settings.DEFAULT_FRAME_SOURCE)
+        if source not in settings.FRAME_SOURCES:
+            await self.reject(send, 404, f"Unknown frame source {source}")
+            return
+
+        loop = asyncio.get_event_loop()
+        # the control channel and capture device are set up with blocking calls
+        await loop.run_in_executor(None, self.start_stream, source)
+        queue = asyncio.Queue(maxsize=settings.STREAM_QUEUE_SIZE)
+
+        tasks = list()
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': self.headers})
+            tasks = [
+                asyncio.ensure_future(self.produce(source, queue, width, fps, quality)),
+                asyncio.ensure_future(self.deliver(queue, send)),
+                asyncio.ensure_future(self.disconnected(receive)),
+            ]
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self.unsubscribe()
+            for task in tasks:
+                task.cancel()
+        try:
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        except Exception:
+            # the viewer is already gone
+            pass
+
+    async def produce(self, source, queue, width, fps, quality):
+        """
+        Queue the newest frame at most fps times a second, dropping the oldest queued frame when full
+        """
+        loop = asyncio.get_event_loop()
+        interval = 1.0 / fps
+        frame_broadcaster = self.frame_broadcaster
+        seen = 0
+        streamed = False
+        # broadcasters in a row that stopped without delivering a frame
+        barren = 0
+        while not self.stop_requested():
+            started = loop.time()
+            if not frame_broadcaster.isRunning:
+                # idled out before this viewer registered, or lost its source
+                barren = 0 if streamed else barren + 1
+                if barren > 1:
+                    # the source could not be opened
+                    return
+                frame_broadcaster = await loop.run_in_executor(None, self.subscribe, source)
+                seen = 0
+                streamed = False
+            if frame_broadcaster.sequence > seen:
+                seen, jpeg = await loop.run_in_executor(None, frame_broadcaster.variant, width, quality)
+                streamed = True
+                if jpeg is not None:
+                    if queue.full():
+                        queue.get_nowait()
+                        self.dropped += 1
+                    queue.put_nowait(jpeg)
+            await asyncio.sleep(max(0, interval - (loop.time() - started)))
+
+    async def deliver(self, queue, send):
+        while True:
+            jpeg = await queue.get()
+            await send({
+                'type': 'http.response.body',
+                'body': (b'--frame\r\n'
+                         b'Content-Type: image/jpeg\r\n\r\n' + jpeg + b'\r\n\r\n'),
+                'more_body': True,
+            })
+            self.sent += 1
+
+    async def disconnected(self, receive):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
@@ -1,13 +1,20 @@
 """
-Routing for websocket endpoints
+Routing for websocket and streaming endpoints
 """
-from django.urls import path
+from django.urls import path, re_path
 
+from channels.http import AsgiHandler
 from channels.routing import ProtocolTypeRouter, URLRouter
 
-from .consumers import LectureConsumer
+from .consumers import LectureConsumer, VideoStreamConsumer
 
 application = ProtocolTypeRouter({
+    "http": URLRouter([
+        path('video/live', VideoStreamConsumer, name="video-live"),
+        path('video/live/<str:source>', VideoStreamConsumer, name="video-live-source"),
+        # everything else goes to the django views
+        re_path(r'', AsgiHandler),
+    ]),
     "websocket": URLRouter([
         path('ws/lectures/<int:pk>', LectureConsumer, name="lecture-ws"),
     ])
@@ -90,6 +90,20 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Lecture changes are coalesced for this many seconds into one websocket delta
+WS_BROADCAST_WINDOW = 0.25
+# Seconds between full lecture snapshots sent to websockets
+WS_SNAPSHOT_INTERVAL = 30
+
+# Stop flags and session notifications shared by the web and huey processes,
+# fuskar.utils.control.LocalControlChannel keeps everything in-process
+CONTROL_CHANNEL = {
+    "BACKEND": "fuskar.utils.control.RedisControlChannel",
+    "CONFIG": {
+        "hosts": [("localhost", 6379)],
+    },
+}
+
 # allowed origins to make cross site requests
 CORS_ORIGIN_ALLOW_ALL = True
 
@@ -186,15 +200,38 @@ else:
 PREDICTION_MODES = [
     "knn",
     "svm",
-    "direct-euclid"
+    "direct-euclid",
+    "ann"
 ]
 
+# Mode used until the first retrain, which then picks knn or direct-euclid by the number
+# of students (ann is kept) and records its choice in RETRAIN_STATE for every process
 PREDICTION_MODE = PREDICTION_MODES[0]
 
 SVM_EMBEDDING_MAP = os.path.join(CACHE_PATH, 'cache', 'svm-embedding-map.pkl')
 KNN_EMBEDDING_MAP = os.path.join(CACHE_PATH, 'cache', 'knn-embedding-map.pkl')
 ENCODING_LIST = os.path.join(CACHE_PATH, 'cache', 'encoding-list.pkl')
+# Inverted file index of the ann mode, split into ANN_NLIST lists (None for the square root
+# of the gallery size) of which the ANN_NPROBE closest are searched for every face
+ANN_INDEX = os.path.join(CACHE_PATH, 'cache', 'ann-index.npz')
+ANN_NLIST = None
+ANN_NPROBE = 8
+# Legacy pickled embeddings, imported into the embedding store on the next retrain
 PATH_TO_EMBEDDING_DICT = os.path.join(CACHE_PATH, 'cache', 'path-to-embedding-dict.pkl')
+# Memory-mapped embedding store and the tombstoned fraction that triggers its compaction
+EMBEDDING_STORE = os.path.join(CACHE_PATH, 'cache', 'embeddings')
+EMBEDDING_STORE_COMPACT_RATIO = 0.25
+# Changes since the last full rebuild, as a fraction of the gallery, before the SVM is refit
+RETRAIN_DRIFT_THRESHOLD = 0.2
+RETRAIN_STATE = os.path.join(CACHE_PATH, 'cache', 'retrain-state.json')
+# Image changes arriving within this many seconds of each other are merged into one retrain
+RETRAIN_QUIET_WINDOW = 5
+# A retrain is forced once the oldest pending change has waited this many seconds
+RETRAIN_MAX_LATENCY = 60
+# Attempts at applying a delta before it is left to the next full retrain, retries back off exponentially
+RETRAIN_MAX_ATTEMPTS = 5
+# Seconds to wait for the lock of the pending retrain state before giving up
+RETRAIN_LOCK_TIMEOUT = 10
 PCA_GRAPH = os.path.join(CACHE_PATH, 'images', 'pca-3d.png')
 
 TRAIN_DIR = os.path.join(MEDIA_PATH, 'images')
@@ -204,3 +241,134 @@ CONFIDENCE = 0.59
 DISTANCE = 1 - CONFIDENCE
 TARGET_EMOTIONS = ['surprise', 'calm', 'anger', 'fear']
 ADJACENT_THRESHOLD = 20
+# Emotions are counted per bucket of this many seconds
+EMOTION_BUCKET_SECONDS = 10
+# Seconds between bulk writes of emotion counts
+EMOTION_FLUSH_INTERVAL = 5
+
+## Camera settings
+
+# Named frame sources lectures are mapped to by Lecture.source. None opens the default
+# camera (gstreamer on the jetson nano), otherwise a device index, gstreamer pipeline,
+# RTSP url or video file path, e.g. {"hall-a": "rtsp://10.0.0.12/stream"}
+# A local camera is read by one process at a time: while a lecture runs on it the
+# /video/live preview of that source waits for the attendance worker to release it,
+# and a lecture cannot start while the preview is being watched. Serve halls that need
+# both from a network stream (e.g. an RTSP server in front of the camera).
+FRAME_SOURCES = {
+    "default": None,
+}
+# Frame source of lectures without one and of the live preview stream
+DEFAULT_FRAME_SOURCE = "default"
+# Number of most recent frames kept by the capture service
+CAMERA_BUFFER_SIZE = 5
+# Seconds to wait for the capture service to deliver a frame
+CAMERA_READ_TIMEOUT = 5
+# Seconds a device may fail to deliver frames, or stay held by another process,
+# before its capture service gives up on it
+CAMERA_FAILURE_TIMEOUT = 10
+# Lock files marking which process reads each local camera
+CAPTURE_LOCK_DIR = os.path.join(CACHE_PATH, 'cache', 'capture')
+# Width and JPEG quality of the annotated live preview, encoded once per frame for all viewers
+STREAM_WIDTH = 400
+STREAM_JPEG_QUALITY = 80
+# Seconds the preview producer of a source keeps running without viewers
+STREAM_IDLE_TIMEOUT = 10
+# Highest frame rate a /video/live viewer can ask for
+STREAM_MAX_FPS = 15
+# Frames queued per /video/live viewer, the oldest is dropped when the viewer falls behind
+STREAM_QUEUE_SIZE = 2
+
+## Face detector settings
+
+# Detector of each pipeline: "hog" (dlib HOG), "cnn" (dlib CNN) or "ssd" (OpenCV DNN),
+# SCALE resizes frames before detection, boxes are mapped back to full resolution
+FACE_DETECTORS = {
+    "enrolment": {"DETECTOR": "cnn", "SCALE": 1.0},
+    "attendance": {"DETECTOR": "cnn", "SCALE": 1.0},
+    "preview": {"DETECTOR": "ssd", "SCALE": 1.0, "OPTIONS": {"confidence": 0.5}},
+}
+# Caffe model of the ssd detector
+SSD_PROTOTXT = os.path.join(CACHE_PATH, 'cache', 'deploy.prototxt')
+SSD_MODEL = os.path.join(CACHE_PATH, 'cache', 'detect.caffemodel')
+
+## Enrolment settings
+
+# Persisted BK-tree of perceptual hashes and the hamming distance treated as a near duplicate
+PHASH_INDEX = os.path.join(CACHE_PATH, 'cache', 'phash-index.pkl')
+PHASH_MAX_DISTANCE = 6
+
+# Threads sending bulk enrolment photos to the inference workers, one per worker keeps them all busy
+ENROLMENT_WORKERS = max((os.cpu_count() or 2) // 2, 1)
+
+## Attendance settings
+
+# Frames collected per CNN face detection pass, 1 disables batching
+ATTENDANCE_BATCH_SIZE = 8
+# Maximum seconds spent filling a batch before detection runs on what was collected
+ATTENDANCE_BATCH_MAX_WAIT = 1.0
+# Seconds between bulk inserts of newly recognised students
+ATTENDANCE_FLUSH_INTERVAL = 2
+# Processes running lecture pipelines, lectures sharing a frame source share a process
+ATTENDANCE_WORKERS = os.cpu_count()
+# Frames a lecture processes before yielding its process to the next lecture queued on it
+ATTENDANCE_FRAME_BUDGET = 16
+
+# Motion gate in front of face detection: a frame is processed when the share of pixels
+# changing by more than MOTION_PIXEL_THRESHOLD in any MOTION_GRID x MOTION_GRID cell of the
+# frame downscaled to MOTION_WIDTH reaches MOTION_THRESHOLD
+MOTION_WIDTH = 160
+MOTION_GRID = 4
+MOTION_PIXEL_THRESHOLD = 25
+MOTION_THRESHOLD = 0.02
+# Seconds after which a frame is processed even without motion, 0 disables the gate
+MOTION_KEEP_ALIVE = 5
+
+# Face tracks continue across processed frames while boxes overlap by TRACKING_IOU_THRESHOLD
+# and are dropped after TRACKING_MAX_MISSES frames without their face
+TRACKING_IOU_THRESHOLD = 0.3
+TRACKING_MAX_MISSES = 3
+# Seconds after which the identity of a tracked face is recognised again
+TRACKING_REVERIFY_INTERVAL = 30
+
+## Inference worker settings
+
+# Serve face detection, encoding and emotion models from the pool of warm processes
+# started with `manage.py run_inference_worker`, otherwise every process loads its own copy
+INFERENCE_WORKER_ENABLED = True
+# Processes in the pool, each holds its own copy of the models
+INFERENCE_WORKERS = max((os.cpu_count() or 2) // 2, 1)
+# Worker n listens on this address with -n inserted before the extension
+INFERENCE_WORKER_ADDRESS = os.path.join(CACHE_PATH, 'cache', 'inference.sock')
+INFERENCE_WORKER_AUTHKEY = SECRET_KEY.encode()
+# Seconds a process runs inference itself before trying an unreachable pool again
+INFERENCE_WORKER_RETRY = 30
+
+## Metrics and logging settings
+
+# Directory shared by every process for prometheus metrics, served aggregated on /metrics,
+# None keeps metrics per process
+METRICS_MULTIPROC_DIR = os.path.join(CACHE_PATH, 'metrics')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'verbose': {
+            'format': '%(asctime)s %(levelname)s %(processName)s %(name)s: %(message)s',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'verbose',
+        },
+    },
+    'loggers': {
+        # DEBUG logs every frame of every lecture
+        'fuskar': {
+            'handlers': ['console'],
+            'level': os.getenv('FUSKAR_LOG_LEVEL', 'INFO'),
+        },
+    },
+}
@@ -31,6 +31,7 @@ router.register(r'emotions', views.EmotionViewSet)
 
 urlpatterns = [
     path('video', views.get_stream),
+    path('metrics', views.metrics),
     path('', include(router.urls)),
     path('admin/', admin.site.urls),
     path('docs/', include_docs_urls(title='Fuskar API', authentication_classes=[], permission_classes=[]))
@@ -4,7 +4,13 @@ class FuskarConfig(AppConfig):
     name = 'fuskar'
 
     def ready(self):
+        import multiprocessing
         import fuskar.signals
+        from fuskar.utils import metrics
+
+        # a service starting, not one of the workers it spawns
+        if multiprocessing.current_process().name == 'MainProcess':
+            metrics.clear_dead_processes()
         # generate PCA plot
         from fuskar.utils.helpers import generate_pca_plot
         from django.conf import settings
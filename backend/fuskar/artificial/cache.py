@@ -0,0 +1,132 @@
+"""
+Process wide cache for the pickled classifier artifacts
+"""
+import os
+import json
+import time
+import pickle
+import tempfile
+import threading
+from fuskar.utils.metrics import MODEL_CACHE, STAGE_SECONDS
+
+
+def load_pickle(path):
+    """
+    Default loader, unpickles the artifact at path
+    """
+    with open(path, 'rb') as stream:
+        return pickle.load(stream)
+
+
+def load_json(path):
+    """
+    Loader for json artifacts
+    """
+    with open(path) as stream:
+        return json.load(stream)
+
+
+def publish_pickle(obj, path):
+    """
+    Atomically write a new version of an artifact
+
+    The pickle is written to a temporary file in the same directory and moved
+    over the old version so readers either see the old or the new artifact,
+    never a partially written one. The new mtime invalidates cached copies.
+    """
+    publish_file(path, lambda stream: pickle.dump(obj, stream))
+
+
+def publish_json(obj, path):
+    """
+    Atomically write a new version of a json artifact, see `publish_pickle`
+    """
+    publish_file(path, lambda stream: stream.write(json.dumps(obj).encode()))
+
+
+def publish_file(path, write):
+    """
+    Atomically replace the file at path with what `write` writes to the binary stream it receives
+    """
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as stream:
+            write(stream)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class ModelCache(object):
+    """
+    Keeps one loaded copy of every artifact keyed by its path
+    and version (mtime and size), reloading only when a new version is published
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = dict()
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "reloads": 0,
+            "reload_seconds": 0.0,
+        }
+
+    @staticmethod
+    def version(path):
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def get(self, path, loader=load_pickle):
+        """
+        Return the loaded artifact at path
+
+        :param path: path to the artifact
+        :param loader: callable taking the path and returning the loaded object,
+            artifacts loaded with different loaders are cached separately
+        """
+        key = (path, loader)
+        version = self.version(path)
+        entry = self.entries.get(key)
+        if entry and entry[0] == version:
+            self.counters["hits"] += 1
+            MODEL_CACHE.labels('hit').inc()
+            return entry[1]
+        with self.lock:
+            # another thread may have loaded this version while we waited
+            entry = self.entries.get(key)
+            if entry and entry[0] == version:
+                self.counters["hits"] += 1
+                MODEL_CACHE.labels('hit').inc()
+                return entry[1]
+            self.counters["misses"] += 1
+            MODEL_CACHE.labels('reload' if entry else 'miss').inc()
+            start = time.time()
+            obj = loader(path)
+            # replacing the entry evicts the previous version
+            self.entries[key] = (version, obj)
+            if entry:
+                self.counters["reloads"] += 1
+            self.counters["reload_seconds"] += time.time() - start
+            STAGE_SECONDS.labels('model_load').observe(time.time() - start)
+        return obj
+
+    def invalidate(self, path=None):
+        """
+        Drop cached artifacts for path or every artifact if path is None
+        """
+        with self.lock:
+            for key in list(self.entries.keys()):
+                if path is None or key[0] == path:
+                    del self.entries[key]
+
+    def stats(self):
+        return dict(self.counters, entries=len(self.entries))
+
+
+model_cache = ModelCache()
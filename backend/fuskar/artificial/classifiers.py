@@ -3,14 +3,35 @@ Implements all the classifiers to be used by Fuskar
 """
 import os
 import math
+import logging
 import cv2
 import pickle
 import numpy as np
 import face_recognition
+from django.conf import settings
 from sklearn import neighbors, svm
 from EmoPy.src.fermodel import FERModel
-from fuskar.models import Emotion
-from fuskar.utils.helpers import get_id_from_enc, get_encodings
+from fuskar.utils.emotions import EmotionAggregator
+from fuskar.artificial.cache import model_cache, publish_pickle, load_json
+from fuskar.artificial.matcher import EmbeddingMatcher
+from fuskar.artificial.ivf import IVFIndex
+
+logger = logging.getLogger(__name__)
+
+
+def trained_prediction_mode():
+    """
+    Prediction mode the classifiers were last trained for
+
+    update_classifiers records it in settings.RETRAIN_STATE so every process,
+    the attendance workers included, follows it; settings.PREDICTION_MODE
+    is used until the classifiers were trained once
+    """
+    try:
+        state = model_cache.get(settings.RETRAIN_STATE, loader=load_json)
+    except FileNotFoundError:
+        return settings.PREDICTION_MODE
+    return state.get("mode", settings.PREDICTION_MODE)
 
 
 class EmotionClassifier(object):
@@ -18,24 +39,43 @@ class EmotionClassifier(object):
     Predicts emotions based on the stored Emotions 
     for a particular lecture instance
     """
-    def __init__(self, lecture_instance, target_emotions):
+    def __init__(self, lecture_instance, target_emotions, inference=None):
         self.lecture_instance = lecture_instance
         self.target_emotions = target_emotions
-        self.model = FERModel(target_emotions, verbose=False)
+        # batch predictions go to the resident inference models when given,
+        # otherwise FERModel is loaded here
+        self.inference = inference
+        self.model = FERModel(target_emotions, verbose=False) if inference is None else None
+        self.aggregator = EmotionAggregator(lecture_instance)
 
     def add_to_db(self, emotions):
         """
-        Add emotions to lecture instance
+        Count emotions for the lecture instance, written in bulk by flush()
 
         :param emotions: emotions to be added to lecture_instance
         :type emotions: list
         """
-        print(f"Emotion(s) ==> {emotions}")
+        logger.debug("Emotion(s) ==> %s", emotions)
+        # cheap early filter on the copy loaded with the pipeline,
+        # flush() checks the current lecture row before writing
         if not self.lecture_instance.lock:
-            for emotion_detected in emotions:
-                emotion = Emotion.objects.create(emotion=emotion_detected)
-                self.lecture_instance.emotions.add(emotion)
-        
+            self.aggregator.add(emotions)
+
+    def flush(self, force=False):
+        """
+        Write the emotion counts accumulated since the last flush
+        """
+        self.aggregator.flush(force=force)
+
+
+    def emotions_from_prediction(self, prediction, threshold):
+        """
+        Emotions whose score is within threshold of the highest score
+        """
+        prediction = list(prediction)
+        highest = max(prediction)
+        return [self.target_emotions[index] for index, score in enumerate(prediction)
+                if highest - score <= threshold and score != 0]
 
     def predict_emotions(self, image, threshold, add_to_db=True):
         """
@@ -45,25 +85,65 @@ class EmotionClassifier(object):
         :param image: loaded image matrix either using cv2 or PIL
         :type image: np.array
         """
-        maxdiff = lambda lst: [(max(lst) - lst[i])<=threshold and lst[i] !=0 for i in range(0,len(lst)-1)]
+        if self.inference is not None:
+            height, width = image.shape[:2]
+            return self.predict_emotions_batch(image, [(0, width, height, 0)], threshold, add_to_db=add_to_db)[0]
         gray_image = image
         if len(image.shape) > 2:
             gray_image = cv2.cvtColor(image, code=cv2.COLOR_BGR2GRAY)
         resized_image = cv2.resize(gray_image, self.model.target_dimensions, interpolation=cv2.INTER_LINEAR)
         final_image = np.array([np.array([resized_image]).reshape(list(self.model.target_dimensions)+[self.model.channels])])
         prediction = self.model.model.predict(final_image)
-        # normalized_prediction = [x/sum(prediction) for x in prediction]
-        prediction = list(prediction[0])
-        print(prediction)
-        emotions = list()
-        a = maxdiff(prediction)
-        for index, val in enumerate(a):
-            if val:
-                emotions.append(self.target_emotions[index])
+        emotions = self.emotions_from_prediction(prediction[0], threshold)
         if add_to_db:
             self.add_to_db(emotions)
         return emotions
 
+    def predict_emotions_batch(self, frame, boxes, threshold, add_to_db=True):
+        """
+        Predict the emotions of every face in a frame with a single model pass
+
+        :param frame: BGR frame the boxes were detected in
+        :param boxes: (top, right, bottom, left) face boxes as returned by get_boxes
+        :return: list of emotions per box, empty for boxes that fall outside the frame
+        """
+        if self.inference is not None:
+            results = self.inference.emotions(frame, boxes, threshold)
+            if add_to_db:
+                for emotions in results:
+                    if emotions:
+                        self.add_to_db(emotions)
+            return results
+        results = [list() for _ in boxes]
+        if not boxes:
+            return results
+        gray_frame = frame
+        if len(frame.shape) > 2:
+            gray_frame = cv2.cvtColor(frame, code=cv2.COLOR_BGR2GRAY)
+        height, width = gray_frame.shape[:2]
+        target_dimensions = tuple(self.model.target_dimensions)
+
+        faces = list()
+        indices = list()
+        for index, (top, right, bottom, left) in enumerate(boxes):
+            top, bottom = max(top, 0), min(bottom, height)
+            left, right = max(left, 0), min(right, width)
+            if bottom <= top or right <= left:
+                continue
+            faces.append(cv2.resize(gray_frame[top:bottom, left:right], target_dimensions, interpolation=cv2.INTER_LINEAR))
+            indices.append(index)
+        if not faces:
+            return results
+
+        # one (N, H, W, C) tensor for every face in the frame
+        batch = np.stack(faces).reshape([len(faces)] + list(target_dimensions) + [self.model.channels])
+        predictions = self.model.model.predict(batch)
+        for index, prediction in zip(indices, predictions):
+            results[index] = self.emotions_from_prediction(prediction, threshold)
+            if add_to_db:
+                self.add_to_db(results[index])
+        return results
+
 class KNN:
     """
     Implements a K-Nearest-Neighbour classification system for 
@@ -91,7 +171,7 @@ class KNN:
         if not n_neighbors:
             n_neighbors = int(round(math.sqrt(len(X))))
             if verbose:
-                print(f"Chose n_neighbors of {n_neighbors} automatically for dataset of size {len(X)}")
+                logger.info("Chose n_neighbors of %d automatically for dataset of size %d", n_neighbors, len(X))
 
         # Create and train the KNN classifier
         knn_clf = neighbors.KNeighborsClassifier(n_neighbors=n_neighbors, algorithm=knn_algo, weights='distance')
@@ -99,12 +179,9 @@ class KNN:
 
         # Save the trained KNN classifier
         if pickle_path:
-            if not os.path.exists(os.path.dirname(pickle_path)):
-                os.mkdir(os.path.dirname(pickle_path))
-            with open(pickle_path, 'wb') as f:
-                pickle.dump(knn_clf, f)
-                if verbose:
-                    print(f"Saved pickled KNN to path {pickle_path}")
+            publish_pickle(knn_clf, pickle_path)
+            if verbose:
+                logger.info("Saved pickled KNN to path %s", pickle_path)
 
         return knn_clf
 
@@ -118,14 +195,13 @@ class KNN:
         :return: a list of id and face locations for the recognized faces in the image: [(id, bounding box), ...].
             For faces of unrecognized persons, the name 'unknown' will be returned.
         """
-        print(f"Predicting using {self.name} mode")
+        logger.debug("Predicting using %s mode", self.name)
         distance_threshold = 1 - self.confidence_threshold
         if knn_clf is None and self.pickle_path is None:
             raise Exception("Must supply knn classifier either thourgh knn_clf or pickle_path")
 
         if not knn_clf:
-            with open(self.pickle_path, 'rb') as stream:
-                knn_clf = pickle.load(stream)
+            knn_clf = model_cache.get(self.pickle_path)
         
         if len(face_encodings) > 0:
             closest_distances = knn_clf.kneighbors(face_encodings, n_neighbors=1)
@@ -155,37 +231,76 @@ class DirectEuclid:
         """
         Doesn't actually train, just saves the path to pickle path
         """
-        with open(pickle_path, 'wb') as output:
-            pickle.dump(encoding_list_tuple, output)
-            print(f"Saved encoding list to {pickle_path}")
+        publish_pickle(encoding_list_tuple, pickle_path)
+        logger.info("Saved encoding list to %s", pickle_path)
 
 
     def predict(self, face_encodings):
         """
-        Use the pickled classifier to predict
+        Use the pickled encoding list to predict, every face is compared
+        against the whole gallery in a single matrix operation
         """
-        print(f"Predicting using {self.name} mode")
-        predictions = list()
+        logger.debug("Predicting using %s mode", self.name)
         distance_threshold = 1 - self.confidence_threshold
-        with open(self.pickle_path, 'rb') as stream:
-                encoding_list_tuple = pickle.load(stream)
+        matcher = model_cache.get(self.pickle_path, loader=EmbeddingMatcher.load)
+        return matcher.match(face_encodings, distance_threshold)
 
-        encoding_list = get_encodings(encoding_list_tuple)
-        if len(face_encodings) > 0:
-            for i in face_encodings:
-                results = face_recognition.face_distance(encoding_list, i)
-                # get min face distance and compare
-                min_distance = min(results)
-                index = list(results).index(min_distance)
-                if index:
-                    encoding = encoding_list[index]
-                    single_id = get_id_from_enc(encoding_list_tuple, encoding)
-                    if min_distance <= distance_threshold:
-                        predictions.append(single_id)
-                    else:
-                        predictions.append("unknown")
-            return predictions
 
+class ANN:
+    """
+    Approximate nearest neighbour search over an inverted file index, only the
+    embeddings in the lists closest to a face are compared against it
+    """
+
+    name = "ann"
+
+    def __init__(self, pickle_path, confidence_threshold, nprobe):
+        """
+        set index path, confidence threshold and the number of lists probed per face
+        """
+        self.pickle_path = pickle_path
+        self.confidence_threshold = confidence_threshold
+        self.nprobe = nprobe
+
+    @staticmethod
+    def train(X, Y, image_ids, pickle_path, nlist=None, verbose=True):
+        """
+        Recompute the lists of the index from the whole gallery
+        """
+        index = IVFIndex.build(X, Y, image_ids, nlist=nlist)
+        index.save(pickle_path)
+        if verbose:
+            logger.info("Saved ANN index with %d list(s) to path %s", index.nlist, pickle_path)
+        return index
+
+    @staticmethod
+    def update(pickle_path, added, removed, verbose=True):
+        """
+        Insert and delete embeddings of the saved index without recomputing its lists
+
+        :param added: (image id, student id, embedding) tuples
+        :param removed: image ids
+        """
+        index = IVFIndex.load(pickle_path)
+        index.remove(removed)
+        if added:
+            image_ids, student_ids, embeddings = zip(*added)
+            index.add(embeddings, student_ids, image_ids)
+        index.save(pickle_path)
+        if verbose:
+            logger.info("Updated ANN index at %s with %d added and %d removed embedding(s)",
+                        pickle_path, len(added), len(removed))
+        return index
+
+    def predict(self, face_encodings):
+        """
+        Use the saved index to predict, a face is "unknown" when its closest
+        embedding among the probed lists is beyond the distance threshold
+        """
+        logger.debug("Predicting using %s mode", self.name)
+        distance_threshold = 1 - self.confidence_threshold
+        index = model_cache.get(self.pickle_path, loader=IVFIndex.load)
+        return index.match(face_encodings, distance_threshold, self.nprobe)
 
 
 class SVM:
@@ -215,14 +330,11 @@ class SVM:
         clf = svm.SVC(gamma=gamma, probability=probability)
         clf.fit(X, Y)
 
-        # Save the trained KNN classifier
+        # Save the trained SVM classifier
         if pickle_path:
-            if not os.path.exists(os.path.dirname(pickle_path)):
-                os.mkdir(os.path.dirname(pickle_path))
-            with open(pickle_path, 'wb') as f:
-                pickle.dump(clf, f)
-                if verbose:
-                    print(f"Saved pickled SVM to path {pickle_path}")
+            publish_pickle(clf, pickle_path)
+            if verbose:
+                logger.info("Saved pickled SVM to path %s", pickle_path)
         return clf
 
     def predict(self, face_encodings, svm_clf=None):
@@ -234,16 +346,15 @@ class SVM:
         :return: a list of id for the recognized faces in the image: [1, 2, ...]
             For faces of unrecognized persons, the name 'unknown' will be returned.
         """
-        print(f"Predicting using {self.name} mode")
+        logger.debug("Predicting using %s mode", self.name)
         prediction_set = list()
 
         if svm_clf is None and self.pickle_path is None:
             raise Exception("Must supply svm classifier either thourgh svm_clf or pickle_path")
 
         if not svm_clf:
-            with open(self.pickle_path, 'rb') as stream:
-                svm_clf = pickle.load(stream)
-            classes = svm_clf.classes_
+            svm_clf = model_cache.get(self.pickle_path)
+        classes = svm_clf.classes_
         
         if len(face_encodings) > 0:
             probability = list(svm_clf.predict_proba(face_encodings))
@@ -0,0 +1,172 @@
+"""
+Face detector backends
+
+Every detector takes BGR frames, optionally detects on a copy downscaled by
+its `scale` and returns (top, right, bottom, left) boxes in the coordinates
+of the full resolution frame, ready for face_recognition.face_encodings.
+Pipelines pick their detector in settings.FACE_DETECTORS.
+
+Neither dlib nor OpenCV DNN models may run from several threads at once. Every
+detector holds the lock of the model it runs: dlib's HOG and CNN models are
+globals of face_recognition shared by every detector of their kind in the
+process, each SSD detector loads its own network.
+"""
+import threading
+import cv2
+import numpy as np
+import face_recognition
+from django.conf import settings
+
+detectors = dict()
+detectors_lock = threading.Lock()
+
+
+class FaceDetector(object):
+    """
+    Base detector, subclasses implement `detect_scaled` and set `lock`
+    """
+    name = None
+    lock = None
+
+    def __init__(self, scale=1.0):
+        """
+        :param scale: factor frames are resized by before detection, boxes are mapped back
+        """
+        self.scale = scale
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(scale={self.scale})"
+
+    def resize(self, frame):
+        if self.scale == 1:
+            return frame
+        height, width = frame.shape[:2]
+        size = (max(int(width * self.scale), 1), max(int(height * self.scale), 1))
+        return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+    def detect_scaled(self, frames):
+        """
+        Boxes of every (already resized) frame
+        """
+        raise NotImplementedError
+
+    def detect(self, frames):
+        """
+        Boxes of every frame at full resolution
+        """
+        if not frames:
+            return list()
+        scaled = [self.resize(frame) for frame in frames]
+        with self.lock:
+            results = self.detect_scaled(scaled)
+        if self.scale == 1:
+            return [[tuple(int(x) for x in box) for box in boxes] for boxes in results]
+        mapped = list()
+        for frame, boxes in zip(frames, results):
+            height, width = frame.shape[:2]
+            mapped.append([(
+                max(int(round(top / self.scale)), 0),
+                min(int(round(right / self.scale)), width),
+                min(int(round(bottom / self.scale)), height),
+                max(int(round(left / self.scale)), 0),
+            ) for top, right, bottom, left in boxes])
+        return mapped
+
+
+class HOGDetector(FaceDetector):
+    """
+    dlib's HOG detector, fast on CPU but misses small and turned faces
+    """
+    name = "hog"
+    # face_recognition.api.face_detector
+    lock = threading.Lock()
+
+    def __init__(self, scale=1.0, upsample=1):
+        super(HOGDetector, self).__init__(scale)
+        self.upsample = upsample
+
+    def detect_scaled(self, frames):
+        return [face_recognition.face_locations(frame[:, :, ::-1], number_of_times_to_upsample=self.upsample, model='hog')
+                for frame in frames]
+
+
+class CNNDetector(FaceDetector):
+    """
+    dlib's CNN detector, the most accurate and the slowest without a GPU,
+    equally sized frames are detected in a single pass
+    """
+    name = "cnn"
+    # face_recognition.api.cnn_face_detector
+    lock = threading.Lock()
+
+    def __init__(self, scale=1.0, upsample=1):
+        super(CNNDetector, self).__init__(scale)
+        self.upsample = upsample
+
+    def detect_scaled(self, frames):
+        rgb_frames = [frame[:, :, ::-1] for frame in frames]
+        if len(rgb_frames) == 1 or len(set(frame.shape for frame in rgb_frames)) > 1:
+            return [face_recognition.face_locations(frame, number_of_times_to_upsample=self.upsample, model='cnn')
+                    for frame in rgb_frames]
+        return face_recognition.batch_face_locations(rgb_frames, number_of_times_to_upsample=self.upsample,
+                                                     batch_size=len(rgb_frames))
+
+
+class SSDDetector(FaceDetector):
+    """
+    OpenCV DNN single shot detector (res10 300x300 caffe model)
+    """
+    name = "ssd"
+    size = (300, 300)
+    mean = (104.0, 177.0, 123.0)
+
+    def __init__(self, scale=1.0, confidence=0.5, prototxt=None, model=None):
+        """
+        :param confidence: minimum detection confidence
+        """
+        super(SSDDetector, self).__init__(scale)
+        self.confidence = confidence
+        self.net = cv2.dnn.readNetFromCaffe(prototxt or settings.SSD_PROTOTXT, model or settings.SSD_MODEL)
+        # setInput and forward share the network's state
+        self.lock = threading.Lock()
+
+    def detect_scaled(self, frames):
+        blob = cv2.dnn.blobFromImages([cv2.resize(frame, self.size) for frame in frames], 1.0, self.size, self.mean)
+        self.net.setInput(blob)
+        # (1, 1, detections, 7) rows of [image, class, confidence, left, top, right, bottom]
+        detections = self.net.forward()[0, 0]
+        results = [list() for _ in frames]
+        for image, _, confidence, left, top, right, bottom in detections:
+            if confidence < self.confidence:
+                continue
+            height, width = frames[int(image)].shape[:2]
+            left, right = np.clip([left * width, right * width], 0, width).astype(int)
+            top, bottom = np.clip([top * height, bottom * height], 0, height).astype(int)
+            if right > left and bottom > top:
+                results[int(image)].append((top, right, bottom, left))
+        return results
+
+
+DETECTORS = {detector.name: detector for detector in (HOGDetector, CNNDetector, SSDDetector)}
+
+
+def create_detector(name, scale=1.0, **options):
+    try:
+        detector = DETECTORS[name]
+    except KeyError:
+        raise KeyError(f"Unknown face detector {name}, expected one of {list(DETECTORS)}")
+    return detector(scale=scale, **options)
+
+
+def get_detector(pipeline):
+    """
+    The detector configured for a pipeline in settings.FACE_DETECTORS,
+    created once per process
+
+    :param pipeline: "enrolment", "attendance" or "preview"
+    """
+    with detectors_lock:
+        if pipeline not in detectors:
+            config = settings.FACE_DETECTORS[pipeline]
+            detectors[pipeline] = create_detector(config["DETECTOR"], config.get("SCALE", 1.0), **config.get("OPTIONS", {}))
+    return detectors[pipeline]
@@ -0,0 +1,244 @@
+"""
+Face detection, encoding and emotion models kept resident in one process
+
+Without the inference worker every process loads its own copy once through
+`get_inference()`. With INFERENCE_WORKER_ENABLED the models live in the pool of
+INFERENCE_WORKERS processes started by `manage.py run_inference_worker` and other
+processes talk to them over local sockets through `InferenceClient`, which falls
+back to models loaded in process while no worker can be reached.
+
+Frames are BGR numpy arrays as delivered by OpenCV, boxes are
+(top, right, bottom, left) tuples as returned by face_recognition.
+"""
+import os
+import time
+import logging
+import itertools
+import threading
+from multiprocessing.connection import Listener, Client
+import numpy as np
+import face_recognition
+from django.conf import settings
+from fuskar.artificial.detectors import get_detector
+
+logger = logging.getLogger(__name__)
+
+inference = None
+inference_lock = threading.Lock()
+# face_recognition's encoder is a module global shared by every caller in the process
+encoder_lock = threading.Lock()
+
+
+class InferenceError(Exception):
+    """
+    Raised by the client when the worker failed to run a request
+    """
+
+
+def worker_address(index):
+    """
+    Socket address of the inference worker `index` of the pool
+    """
+    root, extension = os.path.splitext(settings.INFERENCE_WORKER_ADDRESS)
+    return f"{root}-{index}{extension}"
+
+
+class InferenceModels(object):
+    """
+    Detection, encoding and emotion models loaded once per process
+    """
+    def __init__(self, target_emotions=None):
+        self.target_emotions = target_emotions or settings.TARGET_EMOTIONS
+        # dlib and keras models are not safe to call from several threads at once, every
+        # model has its own lock so different models run concurrently, the detectors
+        # hold the locks of their models themselves, see fuskar.artificial.detectors
+        self.emotions_lock = threading.Lock()
+        self._emotion_classifier = None
+
+    @property
+    def emotion_classifier(self):
+        if self._emotion_classifier is None:
+            from fuskar.artificial.classifiers import EmotionClassifier
+
+            self._emotion_classifier = EmotionClassifier(lecture_instance=None, target_emotions=self.target_emotions)
+        return self._emotion_classifier
+
+    def ping(self):
+        return True
+
+    def detect(self, frames, pipeline='attendance'):
+        """
+        Face boxes of every frame found by the detector configured for pipeline
+        """
+        return get_detector(pipeline).detect(frames)
+
+    def encode(self, frame, boxes):
+        """
+        128-d encodings of the faces at boxes
+        """
+        with encoder_lock:
+            return face_recognition.face_encodings(frame[:, :, ::-1], known_face_locations=boxes)
+
+    def emotions(self, frame, boxes, threshold):
+        """
+        Emotions of every face at boxes, see EmotionClassifier.predict_emotions_batch
+        """
+        with self.emotions_lock:
+            return self.emotion_classifier.predict_emotions_batch(frame, boxes, threshold, add_to_db=False)
+
+    def warm_up(self, shape=(480, 640, 3)):
+        """
+        Run every model once on a dummy frame so the first real frame does not pay
+        for lazy initialisation
+
+        :return: seconds spent warming up
+        """
+        start = time.time()
+        frame = np.zeros(shape, dtype=np.uint8)
+        box = (shape[0] // 4, shape[1] * 3 // 4, shape[0] * 3 // 4, shape[1] // 4)
+        for pipeline in ('attendance', 'enrolment'):
+            self.detect([frame], pipeline)
+        self.encode(frame, [box])
+        self.emotions(frame, [box], settings.ADJACENT_THRESHOLD)
+        return time.time() - start
+
+
+class InferenceServer(object):
+    """
+    Serves InferenceModels methods over a multiprocessing connection listener,
+    one thread per client connection
+    """
+    methods = ('ping', 'detect', 'encode', 'emotions')
+
+    def __init__(self, models, address, authkey):
+        self.models = models
+        self.address = address
+        self.authkey = authkey
+
+    def serve_forever(self):
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            # stale socket left behind by a previous worker
+            os.remove(self.address)
+        with Listener(self.address, authkey=self.authkey) as listener:
+            while True:
+                try:
+                    connection = listener.accept()
+                except Exception as exc:
+                    logger.warning("Rejected inference client: %r", exc)
+                    continue
+                threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+
+    def handle(self, connection):
+        with connection:
+            while True:
+                try:
+                    method, args, kwargs = connection.recv()
+                except (EOFError, OSError):
+                    return
+                if method not in self.methods:
+                    connection.send(('error', f"Unknown inference method {method}"))
+                    continue
+                try:
+                    connection.send(('ok', getattr(self.models, method)(*args, **kwargs)))
+                except Exception as exc:
+                    connection.send(('error', repr(exc)))
+
+
+class InferenceClient(object):
+    """
+    Same interface as InferenceModels, forwarded to the pool of inference workers
+    over one connection per thread
+
+    Threads are spread across the workers. While no worker accepts connections,
+    calls run on models loaded in this process and the pool is tried again
+    every INFERENCE_WORKER_RETRY seconds.
+    """
+    def __init__(self, addresses, authkey, retry=None):
+        self.addresses = list(addresses)
+        self.authkey = authkey
+        self.retry = settings.INFERENCE_WORKER_RETRY if retry is None else retry
+        self.local = threading.local()
+        # processes start counting at their pid so their first threads land on different workers
+        self.counter = itertools.count(os.getpid())
+        self.unreachable_since = None
+        self.fallback_lock = threading.Lock()
+        self._fallback = None
+
+    @property
+    def fallback(self):
+        with self.fallback_lock:
+            if self._fallback is None:
+                self._fallback = InferenceModels()
+            return self._fallback
+
+    def connect(self):
+        """
+        Connection to the first worker accepting one, starting at the next worker in turn
+
+        :return: connection or None if no worker could be reached
+        """
+        start = next(self.counter)
+        for offset in range(len(self.addresses)):
+            address = self.addresses[(start + offset) % len(self.addresses)]
+            try:
+                return Client(address, authkey=self.authkey)
+            except OSError as exc:
+                logger.debug("Inference worker at %s unreachable: %r", address, exc)
+        return None
+
+    def call(self, method, *args, **kwargs):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            if self.unreachable_since and time.time() - self.unreachable_since < self.retry:
+                return getattr(self.fallback, method)(*args, **kwargs)
+            connection = self.local.connection = self.connect()
+            if connection is None:
+                if not self.unreachable_since:
+                    logger.warning("No inference worker reachable, running %s on models loaded in process %d",
+                                   method, os.getpid())
+                self.unreachable_since = time.time()
+                return getattr(self.fallback, method)(*args, **kwargs)
+            if self.unreachable_since:
+                logger.info("Inference worker reachable again from process %d", os.getpid())
+                self.unreachable_since = None
+        try:
+            connection.send((method, args, kwargs))
+            status, result = connection.recv()
+        except (EOFError, OSError) as exc:
+            # the worker restarted, reconnect on the next call and answer this one locally
+            self.local.connection = None
+            logger.warning("Inference worker connection lost (%r), running %s in process", exc, method)
+            return getattr(self.fallback, method)(*args, **kwargs)
+        if status == 'error':
+            raise InferenceError(result)
+        return result
+
+    def ping(self):
+        return self.call('ping')
+
+    def detect(self, frames, pipeline='attendance'):
+        return self.call('detect', frames, pipeline)
+
+    def encode(self, frame, boxes):
+        return self.call('encode', frame, boxes)
+
+    def emotions(self, frame, boxes, threshold):
+        return self.call('emotions', frame, boxes, threshold)
+
+
+def get_inference():
+    """
+    Client of the inference workers if they are enabled,
+    otherwise models loaded once for this process
+    """
+    global inference
+
+    with inference_lock:
+        if inference is None:
+            if settings.INFERENCE_WORKER_ENABLED:
+                inference = InferenceClient(
+                    [worker_address(index) for index in range(settings.INFERENCE_WORKERS)],
+                    settings.INFERENCE_WORKER_AUTHKEY)
+            else:
+                inference = InferenceModels()
+    return inference
@@ -0,0 +1,227 @@
+"""
+Inverted file (IVF) index for approximate nearest embedding search, used by the ann prediction mode
+"""
+import os
+import tempfile
+import numpy as np
+
+EMBEDDING_DTYPE = np.float32
+# rows of data compared against the centroids at once, bounds the distance matrix in memory
+CHUNK_SIZE = 8192
+
+
+def squared_distances(queries, points, point_norms=None):
+    """
+    Squared euclidean distance of every query to every point, shape (queries, points)
+    """
+    if point_norms is None:
+        point_norms = np.einsum('ij,ij->i', points, points)
+    squared = np.einsum('ij,ij->i', queries, queries)[:, None] + point_norms[None, :] - 2 * queries @ points.T
+    np.maximum(squared, 0, out=squared)
+    return squared
+
+
+def nearest_centroids(data, centroids):
+    """
+    Index of the closest centroid of every row of data
+    """
+    norms = np.einsum('ij,ij->i', centroids, centroids)
+    assignment = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), CHUNK_SIZE):
+        chunk = data[start:start + CHUNK_SIZE]
+        assignment[start:start + CHUNK_SIZE] = squared_distances(chunk, centroids, norms).argmin(axis=1)
+    return assignment
+
+
+def kmeans(data, k, iterations=10, seed=0):
+    """
+    Lloyd's k-means, empty clusters are reseeded with random points
+
+    :return: (k, dim) centroids
+    """
+    rng = np.random.RandomState(seed)
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = nearest_centroids(data, centroids)
+        counts = np.bincount(assignment, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, data)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            centroids[empty] = data[rng.choice(len(data), len(empty), replace=False)]
+    return centroids
+
+
+class IVFIndex(object):
+    """
+    Partitions the gallery into `nlist` lists around k-means centroids, a query is
+    only compared with the embeddings of its `nprobe` closest lists
+
+    Embeddings are inserted into and deleted from their list in place, the centroids
+    are only recomputed by `build`, which retraining does once the gallery drifted.
+    """
+    def __init__(self, centroids, dim=128):
+        self.centroids = np.ascontiguousarray(centroids, dtype=EMBEDDING_DTYPE)
+        self.centroid_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        self.dim = dim
+        nlist = len(self.centroids)
+        self.embeddings = [np.empty((0, dim), dtype=EMBEDDING_DTYPE) for _ in range(nlist)]
+        self.norms = [np.empty(0, dtype=EMBEDDING_DTYPE) for _ in range(nlist)]
+        self.image_ids = [np.empty(0, dtype=np.int64) for _ in range(nlist)]
+        self.labels = [np.empty(0, dtype=np.int64) for _ in range(nlist)]
+        # image id -> list number
+        self.location = dict()
+
+    def __len__(self):
+        return len(self.location)
+
+    def __contains__(self, image_id):
+        return image_id in self.location
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, embeddings, labels, image_ids, nlist=None, iterations=10, sample=64, seed=0):
+        """
+        Train the centroids on the gallery and insert every embedding
+
+        :param nlist: number of lists (default: square root of the gallery size)
+        :param sample: k-means runs on at most nlist * sample embeddings
+        """
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=EMBEDDING_DTYPE))
+        if len(embeddings) == 0 or embeddings.size == 0:
+            return cls(np.zeros((1, embeddings.shape[1]), dtype=EMBEDDING_DTYPE), embeddings.shape[1])
+        nlist = min(nlist or max(int(round(np.sqrt(len(embeddings)))), 1), len(embeddings))
+        training = embeddings
+        if len(embeddings) > nlist * sample:
+            rng = np.random.RandomState(seed)
+            training = embeddings[rng.choice(len(embeddings), nlist * sample, replace=False)]
+        index = cls(kmeans(training, nlist, iterations=iterations, seed=seed), embeddings.shape[1])
+        index.add(embeddings, labels, image_ids)
+        return index
+
+    def add(self, embeddings, labels, image_ids):
+        """
+        Insert embeddings, replacing those of image ids already in the index
+        """
+        embeddings = np.asarray(embeddings, dtype=EMBEDDING_DTYPE).reshape(-1, self.dim)
+        labels = np.asarray(labels, dtype=np.int64)
+        image_ids = np.asarray(image_ids, dtype=np.int64)
+        self.remove([image_id for image_id in image_ids.tolist() if image_id in self.location])
+        assignment = nearest_centroids(embeddings, self.centroids)
+        for list_no in np.unique(assignment):
+            rows = np.flatnonzero(assignment == list_no)
+            self.embeddings[list_no] = np.concatenate([self.embeddings[list_no], embeddings[rows]])
+            self.norms[list_no] = np.concatenate(
+                [self.norms[list_no], np.einsum('ij,ij->i', embeddings[rows], embeddings[rows])])
+            self.labels[list_no] = np.concatenate([self.labels[list_no], labels[rows]])
+            self.image_ids[list_no] = np.concatenate([self.image_ids[list_no], image_ids[rows]])
+            for image_id in image_ids[rows].tolist():
+                self.location[image_id] = list_no
+
+    def remove(self, image_ids):
+        """
+        Delete the embeddings of image ids, unknown ids are ignored
+
+        :return: number of embeddings deleted
+        """
+        removed = 0
+        by_list = dict()
+        for image_id in image_ids:
+            list_no = self.location.pop(image_id, None)
+            if list_no is not None:
+                by_list.setdefault(list_no, set()).add(image_id)
+        for list_no, ids in by_list.items():
+            keep = ~np.isin(self.image_ids[list_no], list(ids))
+            removed += len(keep) - int(keep.sum())
+            self.embeddings[list_no] = self.embeddings[list_no][keep]
+            self.norms[list_no] = self.norms[list_no][keep]
+            self.labels[list_no] = self.labels[list_no][keep]
+            self.image_ids[list_no] = self.image_ids[list_no][keep]
+        return removed
+
+    def search(self, queries, nprobe):
+        """
+        Closest indexed embedding of every query among its nprobe closest lists
+
+        :return: (labels, image ids, distances), image id -1 when the probed lists are empty
+        """
+        queries = np.asarray(queries, dtype=EMBEDDING_DTYPE).reshape(-1, self.dim)
+        nprobe = min(nprobe, self.nlist)
+        probes = squared_distances(queries, self.centroids, self.centroid_norms)
+        if nprobe < self.nlist:
+            probes = np.argpartition(probes, nprobe - 1, axis=1)[:, :nprobe]
+        else:
+            probes = np.broadcast_to(np.arange(self.nlist), (len(queries), self.nlist))
+        labels = np.full(len(queries), -1, dtype=np.int64)
+        image_ids = np.full(len(queries), -1, dtype=np.int64)
+        distances = np.full(len(queries), np.inf, dtype=EMBEDDING_DTYPE)
+        for query_no, lists in enumerate(probes):
+            lists = [list_no for list_no in lists if len(self.image_ids[list_no])]
+            if not lists:
+                continue
+            candidates = np.concatenate([self.embeddings[list_no] for list_no in lists])
+            norms = np.concatenate([self.norms[list_no] for list_no in lists])
+            squared = squared_distances(queries[query_no:query_no + 1], candidates, norms)[0]
+            best = int(squared.argmin())
+            labels[query_no] = np.concatenate([self.labels[list_no] for list_no in lists])[best]
+            image_ids[query_no] = np.concatenate([self.image_ids[list_no] for list_no in lists])[best]
+            distances[query_no] = np.sqrt(squared[best])
+        return labels, image_ids, distances
+
+    def match(self, face_encodings, distance_threshold, nprobe):
+        """
+        Label of the closest indexed embedding for every face encoding,
+        "unknown" when it is further than distance_threshold
+        """
+        if len(face_encodings) == 0:
+            return list()
+        labels, _, distances = self.search(face_encodings, nprobe)
+        return [str(label) if distance <= distance_threshold else "unknown"
+                for label, distance in zip(labels.tolist(), distances.tolist())]
+
+    def save(self, path):
+        """
+        Atomically write the index next to the other artifacts
+        """
+        directory = os.path.dirname(path) or '.'
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as stream:
+                np.savez(
+                    stream,
+                    centroids=self.centroids,
+                    sizes=np.array([len(ids) for ids in self.image_ids], dtype=np.int64),
+                    embeddings=np.concatenate(self.embeddings),
+                    labels=np.concatenate(self.labels),
+                    image_ids=np.concatenate(self.image_ids))
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a saved index, usable as a model cache loader
+        """
+        with np.load(path) as data:
+            index = cls(data['centroids'], data['centroids'].shape[1])
+            offsets = np.concatenate([[0], np.cumsum(data['sizes'])])
+            embeddings, labels, image_ids = data['embeddings'], data['labels'], data['image_ids']
+        for list_no in range(index.nlist):
+            start, end = offsets[list_no], offsets[list_no + 1]
+            index.embeddings[list_no] = np.ascontiguousarray(embeddings[start:end])
+            index.norms[list_no] = np.einsum('ij,ij->i', index.embeddings[list_no], index.embeddings[list_no])
+            index.labels[list_no] = labels[start:end]
+            index.image_ids[list_no] = image_ids[start:end]
+            for image_id in index.image_ids[list_no].tolist():
+                index.location[image_id] = list_no
+        return index
@@ -0,0 +1,67 @@
+"""
+Vectorised nearest embedding matcher used by the direct-euclid prediction mode
+"""
+import numpy as np
+from fuskar.artificial.cache import load_pickle
+
+
+class EmbeddingMatcher(object):
+    """
+    Holds the gallery as a contiguous float32 embedding matrix with a parallel label array
+    and matches every face of a frame against it in a single matrix operation
+    """
+    def __init__(self, embeddings, labels):
+        self.embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if self.embeddings.ndim == 1:
+            self.embeddings = self.embeddings.reshape(-1, 128)
+        self.labels = np.asarray(labels, dtype=object)
+        # squared norms of the gallery, reused for every query
+        self.norms = np.einsum('ij,ij->i', self.embeddings, self.embeddings)
+
+    def __len__(self):
+        return len(self.labels)
+
+    @classmethod
+    def from_encoding_list(cls, encoding_list_tuple):
+        """
+        Build a matcher from a list of (encoding, id) tuples
+        """
+        if not encoding_list_tuple:
+            return cls(np.empty((0, 128), dtype=np.float32), [])
+        encodings, labels = zip(*encoding_list_tuple)
+        return cls(np.array(encodings, dtype=np.float32), labels)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a matcher from a pickled encoding list, usable as a model cache loader
+        """
+        return cls.from_encoding_list(load_pickle(path))
+
+    def distances(self, face_encodings):
+        """
+        Euclidean distance of every face encoding to every gallery embedding
+
+        :return: array of shape (faces, gallery)
+        """
+        queries = np.asarray(face_encodings, dtype=np.float32).reshape(-1, self.embeddings.shape[1])
+        squared = (np.einsum('ij,ij->i', queries, queries)[:, None]
+                   + self.norms[None, :]
+                   - 2 * queries @ self.embeddings.T)
+        np.maximum(squared, 0, out=squared)
+        return np.sqrt(squared)
+
+    def match(self, face_encodings, distance_threshold):
+        """
+        Label of the closest gallery embedding for every face encoding,
+        "unknown" when the closest embedding is further than distance_threshold
+        """
+        if len(face_encodings) == 0:
+            return list()
+        if len(self) == 0:
+            return ["unknown"] * len(face_encodings)
+        distances = self.distances(face_encodings)
+        indices = np.argmin(distances, axis=1)
+        closest = distances[np.arange(len(indices)), indices]
+        return [label if distance <= distance_threshold else "unknown"
+                for label, distance in zip(self.labels[indices], closest)]
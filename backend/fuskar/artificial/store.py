@@ -0,0 +1,212 @@
+"""
+On-disk embedding store shared by every process through the page cache
+
+The store is a directory holding
+    CURRENT            the generation of the files below
+    embeddings.<gen>   float32 matrix, one row of `dim` values per image
+    index.<gen>        int64 rows of (image id, student id, alive)
+
+Appending writes one row to the end of both files, deleting flips the alive
+flag of a row in place and compaction rewrites the live rows into a new
+generation once enough rows are tombstoned.
+"""
+import os
+import tempfile
+import threading
+import numpy as np
+
+EMBEDDING_DTYPE = np.dtype('<f4')
+INDEX_DTYPE = np.dtype('<i8')
+INDEX_FIELDS = 3
+IMAGE_ID, STUDENT_ID, ALIVE = range(INDEX_FIELDS)
+
+
+class EmbeddingStore(object):
+    """
+    Memory-mapped float32 embedding matrix with an (image id, student id, row) index
+    """
+    def __init__(self, path, dim=128, compact_ratio=0.25):
+        """
+        :param path: directory holding the store files
+        :param dim: embedding dimension
+        :param compact_ratio: fraction of tombstoned rows that triggers compaction
+        """
+        self.path = path
+        self.dim = dim
+        self.compact_ratio = compact_ratio
+        self.lock = threading.RLock()
+        self.state = None
+        self.rows_by_image = dict()
+        self._index = None
+        self._embeddings = None
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    @property
+    def row_bytes(self):
+        return self.dim * EMBEDDING_DTYPE.itemsize
+
+    @property
+    def index_row_bytes(self):
+        return INDEX_FIELDS * INDEX_DTYPE.itemsize
+
+    def generation(self):
+        current = os.path.join(self.path, 'CURRENT')
+        if not os.path.exists(current):
+            return 0
+        with open(current) as stream:
+            return int(stream.read().strip() or 0)
+
+    def files(self, generation=None):
+        if generation is None:
+            generation = self.generation()
+        return (os.path.join(self.path, f'embeddings.{generation}'),
+                os.path.join(self.path, f'index.{generation}'))
+
+    def file_state(self):
+        generation = self.generation()
+        _, index_path = self.files(generation)
+        if not os.path.exists(index_path):
+            return (generation, 0, 0)
+        stat = os.stat(index_path)
+        return (generation, stat.st_size, stat.st_mtime_ns)
+
+    def refresh(self):
+        """
+        Re-map the files if another process appended, deleted or compacted
+        """
+        with self.lock:
+            state = self.file_state()
+            if state == self.state:
+                return
+            self.remap(state)
+            alive = np.flatnonzero(self._index[:, ALIVE])
+            self.rows_by_image = dict(zip(self._index[alive, IMAGE_ID].tolist(), alive.tolist()))
+
+    def remap(self, state):
+        generation, index_size, _ = state
+        embeddings_path, index_path = self.files(generation)
+        rows = index_size // self.index_row_bytes
+        if rows:
+            self._index = np.memmap(index_path, dtype=INDEX_DTYPE, mode='r', shape=(rows, INDEX_FIELDS))
+            # the embedding file may hold a trailing row whose index entry was never written
+            self._embeddings = np.memmap(embeddings_path, dtype=EMBEDDING_DTYPE, mode='r', shape=(rows, self.dim))
+        else:
+            self._index = np.empty((0, INDEX_FIELDS), dtype=INDEX_DTYPE)
+            self._embeddings = np.empty((0, self.dim), dtype=EMBEDDING_DTYPE)
+        self.state = state
+
+    def __contains__(self, image_id):
+        self.refresh()
+        return image_id in self.rows_by_image
+
+    def __len__(self):
+        self.refresh()
+        return len(self.rows_by_image)
+
+    def image_ids(self):
+        self.refresh()
+        return set(self.rows_by_image.keys())
+
+    def get(self, image_id):
+        """
+        Embedding of an image or None if it is not in the store
+        """
+        self.refresh()
+        row = self.rows_by_image.get(image_id)
+        if row is None:
+            return None
+        return np.array(self._embeddings[row])
+
+    def append(self, image_id, student_id, embedding):
+        """
+        Append the embedding of an image, replacing any previous embedding of that image
+
+        :return: row number of the new embedding
+        """
+        embedding = np.asarray(embedding, dtype=EMBEDDING_DTYPE).reshape(self.dim)
+        with self.lock:
+            self.refresh()
+            if image_id in self.rows_by_image:
+                self.delete(image_id)
+            embeddings_path, index_path = self.files()
+            rows = os.path.getsize(index_path) // self.index_row_bytes if os.path.exists(index_path) else 0
+            with open(embeddings_path, 'ab') as stream:
+                # drop a partial row left behind by an interrupted append
+                stream.truncate(rows * self.row_bytes)
+                stream.write(embedding.tobytes())
+            with open(index_path, 'ab') as stream:
+                stream.write(np.array([image_id, student_id, 1], dtype=INDEX_DTYPE).tobytes())
+            # our own write, only the maps need to grow
+            self.remap(self.file_state())
+            self.rows_by_image[image_id] = rows
+            return rows
+
+    def delete(self, image_id):
+        """
+        Tombstone the row of an image
+
+        :return: True if the image was in the store
+        """
+        with self.lock:
+            self.refresh()
+            row = self.rows_by_image.get(image_id)
+            if row is None:
+                return False
+            _, index_path = self.files()
+            with open(index_path, 'r+b') as stream:
+                stream.seek(row * self.index_row_bytes + ALIVE * INDEX_DTYPE.itemsize)
+                stream.write(np.array([0], dtype=INDEX_DTYPE).tobytes())
+            del self.rows_by_image[image_id]
+            self.remap(self.file_state())
+            return True
+
+    def tombstones(self):
+        self.refresh()
+        return len(self._index) - len(self.rows_by_image)
+
+    def maybe_compact(self):
+        """
+        Compact the store if the tombstoned fraction exceeds compact_ratio
+        """
+        self.refresh()
+        total = len(self._index)
+        if total and self.tombstones() / total > self.compact_ratio:
+            self.compact()
+            return True
+        return False
+
+    def compact(self):
+        """
+        Rewrite the live rows into a new generation and switch to it
+        """
+        with self.lock:
+            self.refresh()
+            generation = self.generation()
+            alive = np.flatnonzero(self._index[:, ALIVE])
+            embeddings_path, index_path = self.files(generation + 1)
+            np.ascontiguousarray(self._embeddings[alive]).tofile(embeddings_path)
+            np.ascontiguousarray(self._index[alive]).tofile(index_path)
+            fd, tmp_path = tempfile.mkstemp(dir=self.path)
+            with os.fdopen(fd, 'w') as stream:
+                stream.write(str(generation + 1))
+            os.replace(tmp_path, os.path.join(self.path, 'CURRENT'))
+            # processes still mapping the old generation keep their inode alive
+            for old_path in self.files(generation):
+                if os.path.exists(old_path):
+                    os.remove(old_path)
+            self.state = None
+            self.refresh()
+
+    def gallery(self):
+        """
+        Live embeddings with their student and image ids
+
+        :return: (embeddings, student_ids, image_ids), embeddings is the memory map itself
+            when there are no tombstones
+        """
+        self.refresh()
+        if not self.tombstones():
+            return self._embeddings, np.array(self._index[:, STUDENT_ID]), np.array(self._index[:, IMAGE_ID])
+        alive = np.flatnonzero(self._index[:, ALIVE])
+        return self._embeddings[alive], self._index[alive, STUDENT_ID], self._index[alive, IMAGE_ID]
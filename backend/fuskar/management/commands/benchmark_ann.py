@@ -0,0 +1,80 @@
+"""
+Benchmarks the ann prediction mode against exact nearest neighbour search on synthetic galleries
+"""
+import time
+import timeit
+import numpy as np
+from sklearn import neighbors
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from fuskar.artificial.ivf import IVFIndex
+from fuskar.artificial.matcher import EmbeddingMatcher
+
+
+def synthetic_gallery(rng, size, photos_per_student, spread):
+    """
+    Gallery of size embeddings, photos of a student scattered around its own centre
+
+    :return: (centres, embeddings, student ids)
+    """
+    students = max(size // photos_per_student, 1)
+    centres = rng.normal(scale=0.1, size=(students, 128))
+    student_ids = np.arange(size) % students
+    embeddings = centres[student_ids] + rng.normal(scale=spread, size=(size, 128))
+    return centres, embeddings.astype(np.float32), student_ids
+
+
+class Command(BaseCommand):
+    help = ("Benchmark recall@1 and query latency of the ann index against the exact ball tree "
+            "of the knn mode and the direct-euclid matrix on synthetic galleries")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+        parser.add_argument('--queries', type=int, default=500, help="faces searched per gallery")
+        parser.add_argument('--nprobe', type=int, nargs='+', default=[settings.ANN_NPROBE])
+        parser.add_argument('--nlist', type=int, default=settings.ANN_NLIST)
+        parser.add_argument('--photos', type=int, default=10, help="photos per student")
+        parser.add_argument('--spread', type=float, default=0.03, help="deviation of photos from their student")
+        parser.add_argument('--updates', type=int, default=100, help="embeddings inserted and deleted incrementally")
+
+    def handle(self, *args, **options):
+        rng = np.random.RandomState(0)
+        for size in options['sizes']:
+            centres, embeddings, student_ids = synthetic_gallery(rng, size, options['photos'], options['spread'])
+            image_ids = np.arange(size)
+            queries = (centres[rng.randint(len(centres), size=options['queries'])]
+                       + rng.normal(scale=options['spread'], size=(options['queries'], 128))).astype(np.float32)
+
+            # exact nearest embedding of every query
+            matcher = EmbeddingMatcher(embeddings, student_ids)
+            chunks = np.array_split(queries, max(len(queries) // 50, 1))
+            exact = np.concatenate([matcher.distances(chunk).argmin(axis=1) for chunk in chunks])
+
+            start = time.time()
+            ball_tree = neighbors.NearestNeighbors(n_neighbors=1, algorithm='ball_tree').fit(embeddings)
+            tree_build = time.time() - start
+            tree = timeit.timeit(lambda: ball_tree.kneighbors(queries, n_neighbors=1), number=1) / len(queries)
+            brute = timeit.timeit(lambda: [matcher.distances(query).argmin() for query in queries], number=1) / len(queries)
+
+            start = time.time()
+            index = IVFIndex.build(embeddings, student_ids, image_ids, nlist=options['nlist'])
+            build = time.time() - start
+            self.stdout.write(
+                f"gallery {size:>6}: ball tree build {tree_build:7.2f}s, {tree * 1000:7.3f}ms/face, "
+                f"matrix {brute * 1000:7.3f}ms/face, ann build {build:6.2f}s with {index.nlist} lists")
+            for nprobe in options['nprobe']:
+                _, found, _ = index.search(queries, nprobe)
+                recall = float(np.mean(found == exact))
+                ann = timeit.timeit(lambda: [index.search(query, nprobe) for query in queries], number=1) / len(queries)
+                self.stdout.write(
+                    f"    nprobe {nprobe:>3}: recall@1 {recall:.3f}, {ann * 1000:7.3f}ms/face, "
+                    f"speed up {tree / ann:5.1f}x over ball tree, {brute / ann:5.1f}x over matrix")
+
+            updates = min(options['updates'], size)
+            removed = image_ids[rng.choice(size, updates, replace=False)].tolist()
+            start = time.time()
+            index.remove(removed)
+            index.add(embeddings[removed], student_ids[removed], removed)
+            self.stdout.write(
+                f"    {updates} incremental delete(s) and insert(s) in {(time.time() - start) * 1000:.1f}ms, "
+                f"full rebuild {build * 1000:.1f}ms")
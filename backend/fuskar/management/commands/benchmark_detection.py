@@ -0,0 +1,49 @@
+"""
+Compares single frame CNN face detection against batched detection
+"""
+import time
+import cv2
+import face_recognition
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from fuskar.tasks import get_boxes, get_boxes_batch
+from fuskar.utils.camera import read_frames
+
+
+class Command(BaseCommand):
+    help = "Benchmark single frame against batched CNN face detection and encoding"
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help="video file or directory of images")
+        parser.add_argument('--frames', type=int, default=64, help="number of frames to process")
+        parser.add_argument('--batch-size', type=int, default=settings.ATTENDANCE_BATCH_SIZE)
+
+    def encode(self, frame, boxes):
+        return face_recognition.face_encodings(frame[:, :, ::-1], known_face_locations=boxes)
+
+    def handle(self, *args, **options):
+        frames = read_frames(options['source'], limit=options['frames'])
+        if not frames:
+            raise CommandError(f"No frames could be read from {options['source']}")
+        # batched detection needs equally sized frames
+        height, width = frames[0].shape[:2]
+        frames = [cv2.resize(frame, (width, height)) for frame in frames]
+        batch_size = options['batch_size']
+
+        start = time.time()
+        for frame in frames:
+            _, boxes = get_boxes(frame)
+            self.encode(frame, boxes)
+        single = time.time() - start
+
+        start = time.time()
+        for i in range(0, len(frames), batch_size):
+            batch, batch_boxes = get_boxes_batch(frames[i:i + batch_size])
+            for frame, boxes in zip(batch, batch_boxes):
+                self.encode(frame, boxes)
+        batched = time.time() - start
+
+        self.stdout.write(f"{len(frames)} frame(s) of {width}x{height}")
+        self.stdout.write(f"single frame: {single:.2f}s, {len(frames) / single:.2f} fps")
+        self.stdout.write(f"batch of {batch_size}: {batched:.2f}s, {len(frames) / batched:.2f} fps")
+        self.stdout.write(f"speed up: {single / batched:.2f}x")
@@ -0,0 +1,107 @@
+"""
+Compares the speed, recall and precision of the face detector backends
+on labelled images, or their agreement with the stored enrolment boxes
+"""
+import os
+import json
+import time
+import cv2
+from django.core.management.base import BaseCommand, CommandError
+from fuskar.models import Image
+from fuskar.artificial.detectors import DETECTORS, create_detector
+from fuskar.utils.tracking import iou
+
+
+def match_boxes(boxes, expected, threshold):
+    """
+    Number of expected boxes greedily matched by a distinct detected box overlapping it by threshold
+    """
+    unmatched = list(boxes)
+    matched = 0
+    for target in expected:
+        if not unmatched:
+            break
+        best = max(unmatched, key=lambda box: iou(box, target))
+        if iou(best, target) >= threshold:
+            unmatched.remove(best)
+            matched += 1
+    return matched
+
+
+class Command(BaseCommand):
+    help = ("Benchmark face detectors and detection scales against labelled face boxes (--annotations), "
+            "or report their agreement with the CNN boxes stored for enrolled images")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--annotations', help=(
+            "json file mapping image paths (relative to the file) to lists of "
+            "[top, right, bottom, left] face boxes, used as ground truth"))
+        parser.add_argument('--detectors', nargs='+', default=list(DETECTORS), choices=list(DETECTORS))
+        parser.add_argument('--scales', nargs='+', type=float, default=[1.0, 0.5])
+        parser.add_argument('--limit', type=int, default=200, help="number of images to use")
+        parser.add_argument('--iou', type=float, default=0.5, help="overlap with an expected box counted as found")
+
+    def annotated(self, path, limit):
+        """
+        (BGR image, labelled face boxes) read from an annotation file
+        """
+        try:
+            with open(path) as stream:
+                annotations = json.load(stream)
+        except (OSError, ValueError) as exc:
+            raise CommandError(f"Cannot read annotations from {path}: {exc}")
+        root = os.path.dirname(os.path.abspath(path))
+        fixtures = list()
+        for name, boxes in sorted(annotations.items())[:limit]:
+            frame = cv2.imread(os.path.join(root, name))
+            if frame is None:
+                self.stderr.write(f"Skipping unreadable image {name}")
+                continue
+            fixtures.append((frame, [tuple(box) for box in boxes]))
+        return fixtures
+
+    def enrolled(self, limit):
+        """
+        (BGR image, stored face box) of enrolled images whose face location is known
+        """
+        fixtures = list()
+        images = Image.objects.exclude(face_top=None).order_by('id')[:limit]
+        for image in images:
+            frame = cv2.imread(image.file.path)
+            if frame is not None:
+                fixtures.append((frame, [image.face_location]))
+        return fixtures
+
+    def handle(self, *args, **options):
+        if options['annotations']:
+            fixtures = self.annotated(options['annotations'], options['limit'])
+            if not fixtures:
+                raise CommandError(f"No readable annotated images in {options['annotations']}")
+            self.stdout.write(f"{len(fixtures)} annotated image(s), recall and precision against the labelled boxes")
+        else:
+            fixtures = self.enrolled(options['limit'])
+            if not fixtures:
+                raise CommandError("No enrolled images with a stored face location, upload or retrain first, "
+                                   "or pass --annotations")
+            self.stdout.write(
+                f"{len(fixtures)} enrolled image(s). WARNING: without --annotations the reference boxes are the "
+                f"ones the CNN enrolment detector stored, the figures below measure agreement with the CNN, "
+                f"not accuracy; cnn is compared with itself and other detectors lose for small box differences")
+        self.stdout.write(f"{'detector':<10}{'scale':>7}{'ms/image':>11}{'recall':>9}{'precision':>11}")
+        expected_total = sum(len(expected) for _, expected in fixtures)
+        for name in options['detectors']:
+            for scale in options['scales']:
+                detector = create_detector(name, scale=scale)
+                # first call pays for lazy model initialisation
+                detector.detect([fixtures[0][0]])
+                matched = detected = 0
+                seconds = 0
+                for frame, expected in fixtures:
+                    start = time.time()
+                    boxes = detector.detect([frame])[0]
+                    seconds += time.time() - start
+                    detected += len(boxes)
+                    matched += match_boxes(boxes, expected, options['iou'])
+                self.stdout.write(
+                    f"{name:<10}{scale:>7.2f}{1000 * seconds / len(fixtures):>11.1f}"
+                    f"{matched / max(expected_total, 1):>9.3f}{matched / max(detected, 1):>11.3f}")
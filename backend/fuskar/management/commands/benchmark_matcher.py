@@ -0,0 +1,49 @@
+"""
+Micro-benchmarks the vectorised direct-euclid matcher against the per face list scan
+"""
+import timeit
+import numpy as np
+import face_recognition
+from django.core.management.base import BaseCommand
+from fuskar.artificial.matcher import EmbeddingMatcher
+from fuskar.utils.helpers import get_id_from_enc, get_encodings
+
+
+def list_scan(encoding_list_tuple, face_encodings, distance_threshold):
+    """
+    The previous direct-euclid prediction, one face_distance call per face
+    """
+    predictions = list()
+    encoding_list = get_encodings(encoding_list_tuple)
+    for i in face_encodings:
+        results = face_recognition.face_distance(encoding_list, i)
+        min_distance = min(results)
+        index = list(results).index(min_distance)
+        single_id = get_id_from_enc(encoding_list_tuple, encoding_list[index])
+        predictions.append(single_id if min_distance <= distance_threshold else "unknown")
+    return predictions
+
+
+class Command(BaseCommand):
+    help = "Benchmark direct-euclid matching against synthetic galleries"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+        parser.add_argument('--faces', type=int, default=10, help="faces per frame")
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        rng = np.random.RandomState(0)
+        faces = options['faces']
+        repeat = options['repeat']
+        for size in options['sizes']:
+            gallery = rng.normal(scale=0.1, size=(size, 128))
+            encoding_list_tuple = [(list(enc), str(i % 200)) for i, enc in enumerate(gallery)]
+            queries = gallery[rng.choice(size, faces)] + rng.normal(scale=0.01, size=(faces, 128))
+            matcher = EmbeddingMatcher.from_encoding_list(encoding_list_tuple)
+
+            scan = timeit.timeit(lambda: list_scan(encoding_list_tuple, queries, 0.41), number=repeat) / repeat
+            vectorised = timeit.timeit(lambda: matcher.match(queries, 0.41), number=repeat) / repeat
+            self.stdout.write(
+                f"gallery {size:>6}: list scan {scan * 1000:9.3f}ms/frame, "
+                f"matrix {vectorised * 1000:8.3f}ms/frame, speed up {scan / vectorised:.1f}x")
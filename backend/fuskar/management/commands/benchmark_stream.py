@@ -0,0 +1,62 @@
+"""
+Opens many concurrent viewers on the live video stream and reports what each receives
+"""
+import time
+import asyncio
+from urllib.parse import urlsplit
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = "Benchmark concurrent viewers of the async MJPEG stream served by daphne"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default="http://localhost:8000/video/live?fps=10&width=320",
+                            help="stream to open, the legacy /video endpoint works too")
+        parser.add_argument('--clients', type=int, nargs='+', default=[1, 10, 25, 50])
+        parser.add_argument('--seconds', type=float, default=15)
+
+    async def view(self, url, seconds):
+        """
+        Read the stream for `seconds` and count the frames and bytes received
+        """
+        parts = urlsplit(url)
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: {parts.netloc}\r\nConnection: close\r\n\r\n".encode())
+        frames = received = 0
+        deadline = time.time() + seconds
+        tail = b''
+        try:
+            while time.time() < deadline:
+                try:
+                    chunk = await asyncio.wait_for(reader.read(65536), timeout=max(deadline - time.time(), 0.01))
+                except asyncio.TimeoutError:
+                    break
+                if not chunk:
+                    break
+                received += len(chunk)
+                # boundaries may be split across reads
+                data = tail + chunk
+                frames += data.count(b'--frame')
+                tail = data[-7:].replace(b'--frame', b'')
+        finally:
+            writer.close()
+        return frames, received
+
+    async def run(self, url, clients, seconds):
+        return await asyncio.gather(*[self.view(url, seconds) for _ in range(clients)], return_exceptions=True)
+
+    def handle(self, *args, **options):
+        loop = asyncio.get_event_loop()
+        seconds = options['seconds']
+        self.stdout.write(f"{'clients':>8}{'failed':>8}{'min fps':>10}{'mean fps':>10}{'MB/s total':>12}")
+        for clients in options['clients']:
+            results = loop.run_until_complete(self.run(options['url'], clients, seconds))
+            ok = [result for result in results if not isinstance(result, Exception)]
+            if not ok:
+                raise CommandError(f"No viewer could read {options['url']}: {results[0]!r}")
+            fps = [frames / seconds for frames, _ in ok]
+            total = sum(received for _, received in ok) / seconds / 1e6
+            self.stdout.write(f"{clients:>8}{len(results) - len(ok):>8}{min(fps):>10.2f}"
+                              f"{sum(fps) / len(fps):>10.2f}{total:>12.2f}")
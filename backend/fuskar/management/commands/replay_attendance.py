@@ -0,0 +1,158 @@
+"""
+Replays recorded video through the attendance pipeline and reports per stage latencies
+"""
+import os
+import json
+import time
+import platform
+from itertools import islice
+import numpy as np
+from django.conf import settings
+from django.db import connection, models
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from fuskar.models import Student, Course, Lecture
+from fuskar.signals import take_attendance_and_emotions_on_lecture_create
+from fuskar.tasks import retrain_pkl
+from fuskar.utils.camera import iter_frames
+from fuskar.utils.enrolment import bulk_enrol, IMAGE_EXTENSIONS
+from fuskar.utils.pipeline import AttendancePipeline
+
+# artifact each prediction mode loads
+MODE_ARTIFACTS = {
+    "knn": "KNN_EMBEDDING_MAP",
+    "svm": "SVM_EMBEDDING_MAP",
+    "direct-euclid": "ENCODING_LIST",
+    "ann": "ANN_INDEX",
+}
+
+
+def summarize(durations):
+    """
+    Latency percentiles of a stage in milliseconds
+    """
+    values = np.array(durations) * 1000
+    return {
+        "count": len(values),
+        "mean_ms": round(float(values.mean()), 3),
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p90_ms": round(float(np.percentile(values, 90)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+        "max_ms": round(float(values.max()), 3),
+    }
+
+
+class Command(BaseCommand):
+    help = ("Replay a video file or directory of images through the attendance pipeline for every "
+            "prediction mode and write per stage latencies, fps and queries per frame as json. "
+            "Run with --settings=backend.bench_settings")
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help="video file or directory of images")
+        parser.add_argument('--gallery', help="directory of <student name>/<photo> to enrol before replaying")
+        parser.add_argument('--frames', type=int, default=300, help="maximum number of frames to replay")
+        parser.add_argument('--modes', nargs='+', default=list(settings.PREDICTION_MODES), choices=list(settings.PREDICTION_MODES))
+        parser.add_argument('--batch-size', type=int, default=settings.ATTENDANCE_BATCH_SIZE)
+        parser.add_argument('--no-motion-gate', action='store_true', help="run detection on every frame")
+        parser.add_argument('--no-tracking', action='store_true', help="encode and classify every face on every frame")
+        parser.add_argument('--output', help="json file to write (default: replay-<time>.json in BENCH_ROOT)")
+
+    def enrol(self, gallery):
+        """
+        Create a student per gallery directory, enrol their photos and train the classifiers
+        """
+        entries = list()
+        for name in sorted(os.listdir(gallery)):
+            directory = os.path.join(gallery, name)
+            if not os.path.isdir(directory):
+                continue
+            student, _ = Student.objects.get_or_create(
+                matric_no=name[:15],
+                defaults={'full_name': name, 'email': f"{name}@replay.fuskar", 'gender': 'M'})
+            for photo in sorted(os.listdir(directory)):
+                if photo.lower().endswith(IMAGE_EXTENSIONS):
+                    with open(os.path.join(directory, photo), 'rb') as stream:
+                        entries.append((student.id, photo, stream.read()))
+        images, _ = bulk_enrol(entries)
+        self.stdout.write(f"Enrolled {len(images)} of {len(entries)} photo(s), training classifiers")
+        retrain_pkl.call_local()
+
+    def replay(self, course, mode, options):
+        """
+        Run the frames through a fresh lecture pipeline classifying with `mode`, timing every stage
+        """
+        lecture = Lecture.objects.create(course=course)
+        pipeline = AttendancePipeline(lecture.id, record_timings=True, prediction_mode=mode)
+        frames = iter_frames(options['source'], limit=options['frames'])
+        count = 0
+        started = time.time()
+        with CaptureQueriesContext(connection) as queries:
+            while True:
+                with pipeline.stage('capture'):
+                    batch = list(islice(frames, options['batch_size']))
+                if not batch:
+                    break
+                pipeline.process_frames(batch)
+                count += len(batch)
+            pipeline.close()
+        elapsed = time.time() - started
+        lecture.stopped_at = timezone.now()
+        lecture.save()
+        return {
+            "frames": count,
+            "seconds": round(elapsed, 3),
+            "fps": round(count / elapsed, 3) if elapsed else 0,
+            "queries": len(queries.captured_queries),
+            "queries_per_frame": round(len(queries.captured_queries) / count, 3) if count else 0,
+            "students_present": lecture.students_present.count(),
+            "motion_gate": pipeline.motion_gate.stats(),
+            "tracker": pipeline.tracker.stats(),
+            "stages": {stage: summarize(durations) for stage, durations in pipeline.timings.items() if durations},
+        }
+
+    def handle(self, *args, **options):
+        if not getattr(settings, 'BENCHMARK', False):
+            raise CommandError("replay_attendance writes lectures and artifacts, run it with --settings=backend.bench_settings")
+        # lectures are driven by the replay instead of the attendance scheduler
+        models.signals.post_save.disconnect(take_attendance_and_emotions_on_lecture_create, sender=Lecture)
+
+        if options['gallery']:
+            self.enrol(options['gallery'])
+        if not Student.objects.exists():
+            raise CommandError("No students enrolled, pass --gallery")
+        course, _ = Course.objects.get_or_create(department='CPE', code='RPL', defaults={'name': "Replay benchmark"})
+        course.registered_students.set(Student.objects.all())
+
+        overrides = dict()
+        if options['no_motion_gate']:
+            overrides['MOTION_KEEP_ALIVE'] = 0
+        if options['no_tracking']:
+            overrides['TRACKING_REVERIFY_INTERVAL'] = 0
+        results = {
+            "started_at": timezone.now().isoformat(),
+            "host": platform.node(),
+            "source": options['source'],
+            "batch_size": options['batch_size'],
+            "detector": settings.FACE_DETECTORS['attendance'],
+            "motion_gate": not options['no_motion_gate'],
+            "tracking": not options['no_tracking'],
+            "modes": dict(),
+        }
+        for mode in options['modes']:
+            if not os.path.exists(getattr(settings, MODE_ARTIFACTS[mode])):
+                self.stdout.write(f"Skipping {mode}, its classifier was not trained (the svm needs two students or more)")
+                continue
+            with override_settings(**overrides):
+                results["modes"][mode] = result = self.replay(course, mode, options)
+            self.stdout.write(f"{mode}: {result['frames']} frame(s) at {result['fps']:.2f} fps, "
+                              f"{result['queries_per_frame']:.2f} queries/frame, {result['students_present']} present")
+            for stage, summary in result["stages"].items():
+                self.stdout.write(f"    {stage:<15} p50 {summary['p50_ms']:9.2f}ms  p90 {summary['p90_ms']:9.2f}ms  "
+                                  f"p99 {summary['p99_ms']:9.2f}ms  ({summary['count']} calls)")
+
+        output = options['output'] or os.path.join(
+            settings.BENCH_ROOT, f"replay-{timezone.now().strftime('%Y%m%d-%H%M%S')}.json")
+        with open(output, 'w') as stream:
+            json.dump(results, stream, indent=2)
+        self.stdout.write(f"Results written to {output}")
@@ -0,0 +1,68 @@
+"""
+Runs the pool of inference workers holding the dlib and EmoPy models for every other process
+"""
+import sys
+import logging
+import multiprocessing
+from multiprocessing.connection import wait
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from fuskar.artificial.inference import InferenceModels, InferenceServer, worker_address
+from fuskar.utils.scheduler import init_worker
+from fuskar.utils.metrics import mark_process_dead
+
+logger = logging.getLogger(__name__)
+
+
+def serve(index):
+    """
+    Load the models and serve them as worker `index` of the pool
+    """
+    models = InferenceModels()
+    seconds = models.warm_up()
+    address = worker_address(index)
+    logger.info("Inference worker %d loaded and warmed up its models in %.1f seconds, serving on %s",
+                index, seconds, address)
+    InferenceServer(models, address, settings.INFERENCE_WORKER_AUTHKEY).serve_forever()
+
+
+def run_worker(index):
+    """
+    Entry point of a spawned worker process
+    """
+    init_worker()
+    serve(index)
+
+
+class Command(BaseCommand):
+    help = ("Load the face and emotion models in INFERENCE_WORKERS processes "
+            "and serve inference requests over local sockets")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.INFERENCE_WORKERS)
+        parser.add_argument('--index', type=int, help="serve only this worker of the pool in this process")
+
+    def handle(self, *args, **options):
+        if options['index'] is not None:
+            serve(options['index'])
+            return
+        # spawned rather than forked, models are loaded in every worker after it started
+        context = multiprocessing.get_context("spawn")
+        workers = [context.Process(target=run_worker, args=(index,), name=f"inference-{index}")
+                   for index in range(options['workers'])]
+        for worker in workers:
+            worker.start()
+        self.stdout.write(f"Started {len(workers)} inference worker(s)")
+        try:
+            # a dead worker takes the pool down so the service manager restarts it whole
+            wait([worker.sentinel for worker in workers])
+            dead = [worker.name for worker in workers if not worker.is_alive()]
+            logger.error("Inference worker(s) %s exited, stopping the pool", ", ".join(dead))
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+            for worker in workers:
+                worker.join()
+                mark_process_dead(worker.pid)
+        sys.exit(1)
@@ -0,0 +1,38 @@
+# Generated by Django 2.2.8 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fuskar', '0007_auto_20191106_0928'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='encoding',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='face_bottom',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='face_left',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='face_right',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='face_top',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
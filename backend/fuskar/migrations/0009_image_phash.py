@@ -0,0 +1,18 @@
+# Generated by Django 2.2.8 on 2026-10-18 11:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fuskar', '0008_image_face_location'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='phash',
+            field=models.CharField(blank=True, max_length=16, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.8 on 2026-10-18 13:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fuskar', '0009_image_phash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmotionBucket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('emotion', models.CharField(max_length=15)),
+                ('started_at', models.DateTimeField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('lecture', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='emotion_buckets', to='fuskar.Lecture')),
+            ],
+            options={
+                'ordering': ['started_at', 'emotion'],
+                'unique_together': {('lecture', 'emotion', 'started_at')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.8 on 2026-10-18 15:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fuskar', '0010_emotionbucket'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lecture',
+            name='source',
+            field=models.CharField(blank=True, default='', max_length=50),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.2.8 on 2026-10-18 16:05
+
+import os
+from django.conf import settings
+from django.db import migrations
+
+
+def backfill_image_phash(apps, schema_editor):
+    from fuskar.utils.phash import backfill_hashes
+
+    Image = apps.get_model('fuskar', 'Image')
+    if backfill_hashes(Image.objects.all()) and os.path.exists(settings.PHASH_INDEX):
+        # rebuilt with the backfilled hashes on first use
+        os.remove(settings.PHASH_INDEX)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fuskar', '0011_lecture_source'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_image_phash, migrations.RunPython.noop),
+    ]
@@ -1,5 +1,6 @@
 import os
 import hashlib
+import numpy as np
 from PIL import Image as Im
 from django.db import models
 from django.utils import timezone
@@ -59,6 +60,22 @@ class Lecture(models.Model):
     students_present = models.ManyToManyField(Student, blank=True)
     emotions = models.ManyToManyField(Emotion, blank=True)
     lock = models.BooleanField(default=False)
+    # key of settings.FRAME_SOURCES, blank uses settings.DEFAULT_FRAME_SOURCE
+    source = models.CharField(max_length=50, blank=True, default='')
+
+class EmotionBucket(models.Model):
+    """
+    Number of times an emotion was detected during a lecture
+    within a bucket of EMOTION_BUCKET_SECONDS starting at started_at
+    """
+    lecture = models.ForeignKey(Lecture, on_delete=models.CASCADE, related_name='emotion_buckets')
+    emotion = models.CharField(max_length=15)
+    started_at = models.DateTimeField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = [['lecture', 'emotion', 'started_at']]
+        ordering = ['started_at', 'emotion']
 
 class Image(models.Model):
     """
@@ -68,10 +85,51 @@ class Image(models.Model):
     file = models.ImageField(blank=False, null=False, upload_to=get_image_path)
     uploaded_at = models.DateTimeField(auto_now_add=True)
     hashval = models.CharField(max_length=255,unique=True, error_messages={'unique':"Image is an exact duplicate of an existing imagw"})
+    # face found when the upload was validated, reused when training
+    face_top = models.IntegerField(blank=True, null=True)
+    face_right = models.IntegerField(blank=True, null=True)
+    face_bottom = models.IntegerField(blank=True, null=True)
+    face_left = models.IntegerField(blank=True, null=True)
+    encoding = models.BinaryField(blank=True, null=True)
+    # 64 bit perceptual hash as hex, indexed in memory to reject near-duplicates
+    phash = models.CharField(max_length=16, blank=True, null=True)
 
     def __str__(self):
         return "Image object : {}".format(self.id)
 
+    @property
+    def face_location(self):
+        """
+        (top, right, bottom, left) of the face or None if it was not stored
+        """
+        location = (self.face_top, self.face_right, self.face_bottom, self.face_left)
+        if None in location:
+            return None
+        return location
+
+    @property
+    def face_encoding(self):
+        """
+        Stored 128-d encoding of the face or None
+        """
+        if not self.encoding:
+            return None
+        return np.frombuffer(bytes(self.encoding), dtype=np.float32)
+
+    @staticmethod
+    def face_fields(location, encoding):
+        """
+        Model field values for a detected face location and its encoding
+        """
+        top, right, bottom, left = [int(value) for value in location]
+        return {
+            'face_top': top,
+            'face_right': right,
+            'face_bottom': bottom,
+            'face_left': left,
+            'encoding': np.asarray(encoding, dtype=np.float32).tobytes(),
+        }
+
 
 class Capturing(models.Model):
     """
@@ -1,11 +1,33 @@
 from rest_framework import serializers
-from fuskar.models import Image, Student, Course, Lecture, Emotion
+from collections import Counter
+from django.conf import settings
+from fuskar.models import Image, Student, Course, Lecture, Emotion, EmotionBucket
+
+
+def emotion_totals(lecture):
+    """
+    Total count of every emotion detected during a lecture
+    """
+    totals = Counter()
+    for bucket in lecture.emotion_buckets.all():
+        totals[bucket.emotion] += bucket.count
+    return dict(totals)
 
 
 class ImageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Image
-        fields = '__all__'
+        exclude = ['encoding', ]
+        read_only_fields = ['face_top', 'face_right', 'face_bottom', 'face_left', 'phash']
+
+    def get_fields(self):
+        fields = super(ImageSerializer, self).get_fields()
+        if self.instance is not None:
+            # the stored face location, encoding and hashes were computed from the uploaded file,
+            # a different photo goes through create as a new Image
+            fields['file'].read_only = True
+            fields['hashval'].read_only = True
+        return fields
 
 class EmotionSerializer(serializers.ModelSerializer):
     class Meta:
@@ -32,22 +54,33 @@ class CourseLectureSerializer(serializers.ModelSerializer):
         model = Lecture
         exclude = ['course', 'lock']
 
+class EmotionBucketSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = EmotionBucket
+        fields = ['started_at', 'emotion', 'count']
+
 class CourseEmotionSerializer(serializers.ModelSerializer):
-    emotions = serializers.SlugRelatedField(
-        many=True,
-        read_only=True,
-        slug_field='emotion'
-    )
+    emotions = serializers.SerializerMethodField()
+    timeline = EmotionBucketSerializer(source='emotion_buckets', many=True, read_only=True)
+
     class Meta:
         model = Lecture
-        fields = ['emotions', ]
+        fields = ['id', 'emotions', 'timeline']
+
+    def get_emotions(self, obj):
+        return emotion_totals(obj)
 
 class LectureSerializer(serializers.ModelSerializer):
-    emotions = serializers.SlugRelatedField(
-        many=True,
-        read_only=True,
-        slug_field='emotion'
-    )
+    emotions = serializers.SerializerMethodField()
+
     class Meta:
         model = Lecture
-        exclude = ['lock', ]
\ No newline at end of file
+        exclude = ['lock', ]
+
+    def get_emotions(self, obj):
+        return emotion_totals(obj)
+
+    def validate_source(self, value):
+        if value and value not in settings.FRAME_SOURCES:
+            raise serializers.ValidationError(f"Unknown frame source, expected one of {list(settings.FRAME_SOURCES)}")
+        return value
\ No newline at end of file
@@ -1,16 +1,21 @@
 import os
 import pickle
+import logging
 import threading
 import django.dispatch
 from django.db import models, transaction
 from django.conf import settings
 from django.dispatch import receiver
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
-from backend.consumers import LectureConsumer
-from fuskar.serializers import LectureSerializer
 from fuskar.models import Image, Lecture, Course
-from fuskar.tasks import retrain_pkl, test_attendance, remove_image_objects
+from fuskar.tasks import request_retrain, test_attendance
+from fuskar.utils.phash import update_index
+from fuskar.utils.attendance import notify_roster_changed
+from fuskar.utils.control import get_control_channel, lecture_stop
+from fuskar.utils.emotions import emotions_flushed, EmotionAggregator
+from fuskar.utils.broadcast import broadcaster
+from fuskar.utils.metrics import STUDENTS_MARKED
+
+logger = logging.getLogger(__name__)
 
 
 @receiver(models.signals.post_delete, sender=Image)
@@ -19,22 +24,25 @@ def auto_delete_file_on_delete(sender, instance, **kwargs):
     Deletes file from filesystem
     when corresponding `Image` object is deleted.
     """
-    print("Received delete signal")
+    logger.debug("Received delete signal")
     if instance.file:
         if os.path.isfile(instance.file.path):
             os.remove(instance.file.path)
-            print(f"Deleting hardcopy image at {instance.file.path}")
-    remove_image_objects(instance)
+            logger.info("Deleting hardcopy image at %s", instance.file.path)
+    if instance.phash:
+        update_index(removed=[(int(instance.phash, 16), instance.id)])
+    request_retrain(removed=[instance.id])
 
 @receiver(models.signals.post_save, sender=Image)
 def retrain_embedding_on_image_save(sender, instance, **kwargs):
     """
-    Retrains the scikit-learn embedding map
+    Adds the image's embedding to the scikit-learn embedding map
     When a new Image is created
 
-    Calls the shared task retrain_pkl()
+    Queues the image for the next coalesced retrain once it is committed
     """
-    retrain_pkl()
+    image_id = instance.id
+    transaction.on_commit(lambda: request_retrain(added=[image_id]))
 
 
 @receiver(models.signals.post_save, sender=Lecture)
@@ -46,20 +54,60 @@ def take_attendance_and_emotions_on_lecture_create(sender, instance, **kwargs):
     test_attendance(instance.id)
 
 
+@receiver(models.signals.post_save, sender=Lecture)
+def stop_attendance_on_lecture_stop(sender, instance, **kwargs):
+    """
+    Stops taking attendance and emotions
+    Once a Lecture object is saved with stopped_at set, whichever way it was written
+    """
+    if instance.stopped_at:
+        lecture_id = instance.id
+        transaction.on_commit(lambda: get_control_channel().signal(lecture_stop(lecture_id)))
+
+
+@receiver(models.signals.m2m_changed, sender=Course.registered_students.through)
+def refresh_attendance_on_registration_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Reloads the roster of running attendance sessions
+    When students are registered for or removed from a course
+    """
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        # instance is a student, pk_set holds courses unless the relation was cleared
+        notify_roster_changed(pk_set)
+    else:
+        notify_roster_changed({instance.id})
+
+
 @receiver(models.signals.m2m_changed, sender=Lecture.students_present.through)
+def broadcast_students_present(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Queues newly present students for the lecture's next websocket delta
+    """
+    if action != 'post_add':
+        return
+    STUDENTS_MARKED.inc(len(pk_set))
+    if reverse:
+        # instance is a student, pk_set holds the lectures
+        for lecture_id in pk_set:
+            broadcaster.students_present(lecture_id, [instance.id])
+    else:
+        broadcaster.students_present(instance.id, pk_set)
+
+
+@receiver(emotions_flushed, sender=EmotionAggregator)
+def broadcast_emotions(sender, instance, counts, **kwargs):
+    """
+    Queues emotion count increments for the lecture's next websocket delta
+    """
+    broadcaster.emotions(instance.id, counts)
+
+
 @receiver(models.signals.m2m_changed, sender=Lecture.emotions.through)
 @receiver(models.signals.post_save, sender=Lecture)
 def trigger_ws_serialization(sender, instance, **kwargs):
     """
-    Triggers sending of a lecture object to a websocket
-    Also closes ws connection if lecture is stopped
-    """
-    serializer = LectureSerializer(instance)
-    channel_layer = get_channel_layer()
-    async_to_sync(channel_layer.group_send)(
-        f'lectures_update_group_{instance.id}',
-        {
-            'type': 'trigger',
-            'message': serializer.data,
-        }
-    )
\ No newline at end of file
+    Triggers sending of a full lecture snapshot to a websocket
+    """
+    broadcaster.snapshot(instance.id)
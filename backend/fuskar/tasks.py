@@ -1,208 +1,386 @@
 from __future__ import absolute_import
 import os
 import cv2
+import json
 import time
+import logging
 import pickle
 import numpy as np
 from huey import crontab
 from django.conf import settings
 from django.db.utils import OperationalError
-from huey.contrib.djhuey import periodic_task, task, lock_task, enqueue
-from fuskar.models import Lecture, Student
+from huey.contrib.djhuey import HUEY, periodic_task, task, lock_task, enqueue
+from huey.exceptions import TaskLockedException
+from fuskar.models import Lecture, Student, Image
 from fuskar.artificial import classifiers as cf
-from fuskar.utils.camera import get_frame
+from fuskar.artificial.cache import publish_json
+from fuskar.artificial.store import EmbeddingStore
+from fuskar.artificial.inference import get_inference
+from fuskar.utils.phash import backfill_hashes, update_index
+from fuskar.utils.scheduler import get_scheduler
+from fuskar.utils.metrics import timed
 import face_recognition
 
+logger = logging.getLogger(__name__)
+
+RETRAIN_PENDING_KEY = 'fuskar-retrain-pending'
+RETRAIN_STATS_KEY = 'fuskar-retrain-stats'
+# created on import so `run_huey --flush-locks` clears them when left behind by a crashed process
+retrain_state_locks = {key: HUEY.lock_task(f'{key}-lock') for key in (RETRAIN_PENDING_KEY, RETRAIN_STATS_KEY)}
 
 def get_boxes(frame):
     """
     Get boxes from a frame
     """
-    # important conversion to rgb frame for dlib
-    print("Converting frame to dlib format")
-    rgb_frame = frame[:, :, ::-1]
-    return frame, face_recognition.face_locations(rgb_frame, model='cnn')
+    return frame, get_inference().detect([frame])[0]
 
-@task()
-@lock_task('rm-image-objects')
-def remove_image_objects(image_instance):
+def get_boxes_batch(frames):
     """
-    Removes the hardcopy of an image and removes it from the cached resources
+    Get boxes for a batch of equally sized frames in a single CNN pass
     """
-    print(f"Received command to remove all cached instances of {image_instance.file.path}")
-    # remove it from path-to-embedding dict
-    if os.path.isfile(settings.PATH_TO_EMBEDDING_DICT):
-        with open(settings.PATH_TO_EMBEDDING_DICT, 'rb') as stream:
-                path_to_embed_dict = pickle.load(stream)
-        if image_instance.file.path in path_to_embed_dict.keys():
-            del path_to_embed_dict[image_instance.file.path]
-            print(f"Deleted Embeddings from Path to Embedding cache")
-        with open(settings.PATH_TO_EMBEDDING_DICT, 'wb') as stream:
-            pickle.dump(path_to_embed_dict, stream)
-    # retrain pkl to remove image from svm map and serial encodings
-    retrain_pkl()
+    return frames, get_inference().detect(frames)
 
+def get_embedding_store():
+    """
+    Embedding store holding one embedding per enrolled image
+    """
+    return EmbeddingStore(settings.EMBEDDING_STORE, compact_ratio=settings.EMBEDDING_STORE_COMPACT_RATIO)
 
-@task()
-@lock_task('retrain-pkl')
-def retrain_pkl():
+def compute_embedding(image_path, face_location=None):
+    """
+    Encode the single face in an image file, None if no face could be found
+
+    :param face_location: (top, right, bottom, left) of the face when already known,
+        skips the CNN detector
+    """
+    inference = get_inference()
+    # dlib loads rgb, the inference models take bgr frames like the camera's
+    face = face_recognition.load_image_file(image_path)[:, :, ::-1]
+    if face_location:
+        boxes = [face_location]
+    else:
+        boxes = inference.detect([face], 'enrolment')[0]
+    try:
+        return inference.encode(face, boxes)[0]
+    except IndexError:
+        return None
+
+def image_embedding(image):
+    """
+    Embedding of an Image, reusing the encoding or face location
+    stored when the upload was validated
+    """
+    if image.face_encoding is not None:
+        return image.face_encoding
+    return compute_embedding(image.file.path, face_location=image.face_location)
+
+def import_legacy_embeddings(store, images):
+    """
+    One time import of the pickled path-to-embedding dict into the embedding store
+    """
+    if not os.path.isfile(settings.PATH_TO_EMBEDDING_DICT):
+        return
+    with open(settings.PATH_TO_EMBEDDING_DICT, 'rb') as stream:
+        path_to_embed_dict = pickle.load(stream)
+    for image in images:
+        if image.id not in store and image.file.path in path_to_embed_dict:
+            store.append(image.id, image.owner_id, path_to_embed_dict[image.file.path])
+    os.remove(settings.PATH_TO_EMBEDDING_DICT)
+    logger.info("Imported %d embedding(s) from %s", len(path_to_embed_dict), settings.PATH_TO_EMBEDDING_DICT)
+
+def load_retrain_state():
     """
-    Background task for retraining the pickled objects
+    Changes applied since the last full rebuild of the classifiers
     """
-    print("Triggered retraining embedding caches")
-    encodings = []
-    id_ = []
+    if os.path.isfile(settings.RETRAIN_STATE):
+        with open(settings.RETRAIN_STATE) as stream:
+            return json.load(stream)
+    return {"changes": 0, "size": 0, "labels": []}
 
-    
-    # Training directory
-    train_dir = os.listdir(settings.TRAIN_DIR)
+def save_retrain_state(state):
+    # the attendance workers read the prediction mode from it
+    publish_json(state, settings.RETRAIN_STATE)
 
-    if os.path.exists(settings.PATH_TO_EMBEDDING_DICT):
-        with open(settings.PATH_TO_EMBEDDING_DICT, 'rb') as stream:
-            path_to_embed_dict = pickle.load(stream)
+def update_classifiers(store, changes=0, rebuild=False, added=(), removed=()):
+    """
+    Refit the classifiers from the embeddings in the store
+
+    KNN and the direct-euclid encoding list are cheap to rebuild from stored embeddings
+    and are always refreshed. The SVM and the lists of the ANN index are only recomputed
+    once the changes since the last full rebuild exceed RETRAIN_DRIFT_THRESHOLD of the
+    gallery, or when a student they cannot predict is enrolled; in between, embeddings
+    are inserted into and deleted from the ANN index in place.
+
+    :param changes: number of embeddings added or removed since the last call
+    :param rebuild: force a full rebuild
+    :param added: (image id, student id, embedding) tuples added since the last call
+    :param removed: image ids removed since the last call
+    """
+    state = load_retrain_state()
+    state["changes"] += changes
+    encodings, student_ids, image_ids = store.gallery()
+    id_ = [str(student_id) for student_id in student_ids]
+    labels = sorted(set(id_))
+    drift = state["changes"] / max(state["size"], 1)
+    rebuild = rebuild or drift >= settings.RETRAIN_DRIFT_THRESHOLD or labels != state["labels"]
+
+    # the ann mode is chosen for galleries too large for the others and is kept,
+    # otherwise knn needs two students or more and direct-euclid handles a single one
+    if settings.PREDICTION_MODE == "ann":
+        mode = "ann"
+    elif len(labels) > 1:
+        mode = "knn"
     else:
-        path_to_embed_dict = dict()
-
-    encoding_list_tuple = list()
-    # Loop through each folder in the image directory
-    for person in train_dir:
-        person_folder = os.path.join(settings.TRAIN_DIR, person)
-        person_folder_listing = os.listdir(person_folder)
-
-        # Loop through each training image for the current person
-        for image in person_folder_listing:
-            # Get the face encodings for the face in each image file
-            image_path = os.path.join(person_folder, image)
-            if image_path in path_to_embed_dict.keys():
-                face_enc = path_to_embed_dict[image_path]
-                id_.append(person)
-                encodings.append(face_enc)
-                encoding_list_tuple.append((list(face_enc), person))
-            else:
-                print(f"Image at {image_path} is not in cache, adding to path-to-embed-dict")
-                face = face_recognition.load_image_file(image_path)
-                boxes = face_recognition.face_locations(face, model='cnn')
-                try:
-                    face_enc = face_recognition.face_encodings(face, known_face_locations=boxes)[0]
-                    # Add face encoding for current image with corresponding label (name) to the training data
-                    encodings.append(face_enc)
-                    id_.append(person)
-                    # create list of encodings tuples
-                    encoding_list_tuple.append((list(face_enc), person))
-                    # add it to path-to-embed-dict
-                    path_to_embed_dict[image_path] = face_enc
-                except IndexError:
-                    pass
-        
-    
-    if len(train_dir) > 1:
+        mode = "direct-euclid"
+
+    if rebuild or not os.path.exists(settings.ANN_INDEX):
+        cf.ANN.train(X=encodings, Y=student_ids, image_ids=image_ids,
+                     pickle_path=settings.ANN_INDEX, nlist=settings.ANN_NLIST)
+    elif added or removed:
+        cf.ANN.update(pickle_path=settings.ANN_INDEX, added=added, removed=removed)
+
+    if len(labels) > 1:
         # Create and train the classifiers
-        settings.PREDICTION_MODE = "knn"
-        cf.SVM.train(X=encodings, Y=id_, pickle_path=settings.SVM_EMBEDDING_MAP)
         cf.KNN.train(X=encodings, Y=id_, pickle_path=settings.KNN_EMBEDDING_MAP)
+        if rebuild:
+            cf.SVM.train(X=encodings, Y=id_, pickle_path=settings.SVM_EMBEDDING_MAP)
     else:
         # use direct euclid if only one student is registered
-        settings.PREDICTION_MODE = "direct-euclid"
+        # create list of encodings tuples
+        encoding_list_tuple = [(list(face_enc), person) for face_enc, person in zip(encodings, id_)]
         cf.DirectEuclid.train(pickle_path=settings.ENCODING_LIST, encoding_list_tuple=encoding_list_tuple)
-    
-    # This dictionary helps prevent scrolling over the entire folder of images recomputing
-    # their embeddings
-    with open(settings.PATH_TO_EMBEDDING_DICT, 'wb') as stream:
-        pickle.dump(path_to_embed_dict, stream)
-        print(f"Done creating path-to-embed-dict at {settings.PATH_TO_EMBEDDING_DICT}")
+
+    if rebuild:
+        store.maybe_compact()
+        state = {"changes": 0, "size": len(id_), "labels": labels}
+        logger.info("Rebuilt classifiers on %d embedding(s) after drift of %.2f", len(id_), drift)
+    state["mode"] = mode
+    save_retrain_state(state)
+
+
+def apply_image_deltas(added, removed):
+    """
+    Embed added images and drop removed images from the store,
+    then update the classifiers once for the whole delta
+    """
+    store = get_embedding_store()
+    appended = list()
+    deleted = list()
+    for image in Image.objects.filter(id__in=added):
+        try:
+            face_enc = image_embedding(image)
+        except Exception:
+            # an unreadable file must not hold back the rest of the delta
+            logger.exception("Cannot embed image %s at %s, skipping it", image.id, image.file.name)
+            continue
+        if face_enc is None:
+            logger.warning("No face found in image at %s, skipping embedding", image.file.path)
+            continue
+        store.append(image.id, image.owner_id, face_enc)
+        appended.append((image.id, image.owner_id, face_enc))
+    for image_id in removed:
+        if store.delete(image_id):
+            deleted.append(image_id)
+    logger.info("Applied %d added and %d removed image(s) to the embedding store", len(added), len(removed))
+    if appended or deleted:
+        update_classifiers(store, changes=len(appended) + len(deleted), added=appended, removed=deleted)
+
+
+def new_pending_retrain():
+    return {
+        "added": set(),
+        "removed": set(),
+        "first_requested_at": None,
+        "last_requested_at": None,
+        # failed attempts at applying the delta and the time before which it is not retried
+        "failures": 0,
+        "retry_at": None,
+    }
+
+def update_retrain_state(key, update, default):
+    """
+    Read-modify-write a value in huey's storage under a lock
+    shared by the web and worker processes
+
+    The lock is only held for a read and a write, so a lock still taken after
+    RETRAIN_LOCK_TIMEOUT seconds was left behind by a crashed process
+
+    :param update: callable receiving the current value, returning (new value, result)
+    :raises TaskLockedException: if the lock could not be taken in time
+    """
+    lock = retrain_state_locks[key]
+    deadline = time.time() + settings.RETRAIN_LOCK_TIMEOUT
+    while True:
+        try:
+            with lock:
+                value = HUEY.get(key, peek=True)
+                value, result = update(default() if value is None else value)
+                HUEY.put(key, value)
+                return result
+        except TaskLockedException:
+            if time.time() >= deadline:
+                raise TaskLockedException(
+                    f"{key} stayed locked for {settings.RETRAIN_LOCK_TIMEOUT} seconds, "
+                    f"restart the huey consumer with --flush-locks if its lock was left behind")
+            time.sleep(0.01)
+
+def count_retrain(counter):
+    def update(stats):
+        stats[counter] += 1
+        return stats, stats
+    try:
+        return update_retrain_state(RETRAIN_STATS_KEY, update, lambda: {"requested": 0, "merged": 0, "executed": 0})
+    except TaskLockedException:
+        # the counters are informational, never fail a retrain or an upload over them
+        logger.warning("Retrain %s not counted", counter, exc_info=True)
+        return retrain_stats()
+
+def retrain_stats():
+    """
+    Number of retrain requests received, merged into a later job and executed
+    """
+    return HUEY.get(RETRAIN_STATS_KEY, peek=True) or {"requested": 0, "merged": 0, "executed": 0}
+
+def request_retrain(added=(), removed=()):
+    """
+    Queue image changes for the next coalesced retrain
+
+    Every request (re)schedules a retrain job RETRAIN_QUIET_WINDOW seconds away.
+    Jobs that find a more recent request merge into the later job,
+    unless the oldest pending request is older than RETRAIN_MAX_LATENCY.
+    """
+    def update(pending):
+        now = time.time()
+        pending["added"] |= set(added)
+        pending["added"] -= set(removed)
+        pending["removed"] |= set(removed)
+        pending["first_requested_at"] = pending["first_requested_at"] or now
+        pending["last_requested_at"] = now
+        return pending, None
+    update_retrain_state(RETRAIN_PENDING_KEY, update, new_pending_retrain)
+    count_retrain("requested")
+    run_coalesced_retrain.schedule(delay=settings.RETRAIN_QUIET_WINDOW)
+
+
+def restore_pending_retrain(taken):
+    """
+    Put a delta taken by a failed retrain back in front of the changes requested since,
+    it is retried after RETRAIN_QUIET_WINDOW seconds, doubled after every failure
+
+    :return: seconds until the retry, None once the delta failed RETRAIN_MAX_ATTEMPTS times and was dropped
+    """
+    failures = taken.get("failures", 0) + 1
+    if failures >= settings.RETRAIN_MAX_ATTEMPTS:
+        return None
+    delay = settings.RETRAIN_QUIET_WINDOW * 2 ** (failures - 1)
+
+    def update(pending):
+        pending["added"] = (set(taken["added"]) - pending["removed"]) | pending["added"]
+        pending["removed"] |= set(taken["removed"])
+        pending["first_requested_at"] = taken["first_requested_at"]
+        pending["last_requested_at"] = pending["last_requested_at"] or taken["last_requested_at"]
+        pending["failures"] = failures
+        pending["retry_at"] = time.time() + delay
+        return pending, None
+    update_retrain_state(RETRAIN_PENDING_KEY, update, new_pending_retrain)
+    return delay
 
 
-# TODO: switch to batch_face_locations to process video stream at once for 
-# quicker processing using nvidia speed up
 @task()
-def test_attendance(lecture_instance_id):
+def run_coalesced_retrain():
     """
-    Begins taking attendance
-    Once a Lecture object is created
+    Applies all pending image changes in one retrain once uploads have been quiet
+    for RETRAIN_QUIET_WINDOW seconds or the oldest change waited RETRAIN_MAX_LATENCY seconds
     """
-    if not Lecture.objects.get(id=lecture_instance_id).lock:
-        print("##############################################################################")
-        lecture_instance = Lecture.objects.get(id=lecture_instance_id)
-        emoclassifier = cf.EmotionClassifier(
-                    lecture_instance=lecture_instance, 
-                    target_emotions=settings.TARGET_EMOTIONS
-                    )
-        direct_euclid_classifier = cf.DirectEuclid(
-                    pickle_path=settings.ENCODING_LIST, 
-                    confidence_threshold=settings.CONFIDENCE
-                    )
-        knn_classifier = cf.KNN(
-                    pickle_path=settings.KNN_EMBEDDING_MAP,
-                    confidence_threshold=settings.CONFIDENCE
-                    )
-        svm_classifier = cf.SVM(
-                    pickle_path=settings.SVM_EMBEDDING_MAP,
-                    confidence_threshold=settings.CONFIDENCE
-        )
-        lecture_processing_time_start = time.time()
-        frame_index = 0
-
-        while not Lecture.objects.get(id=lecture_instance_id).stopped_at:
-            loop_processing_time_start = time.time()
-            lecture_instance = Lecture.objects.get(id=lecture_instance_id)
-            course = lecture_instance.course
-            students = course.registered_students.all()
-            print("Retrieving students ID")
-            registered_student_ids = [int(student.id) for student in students]
-
-            # video_stream is yielding all the images one by one
-            _id = set({})
-            # while True:
-            frame = get_frame()
-            frame, boxes = get_boxes(frame)
-            print(f"Frame [{frame_index}] obtained from stream")
-            # Find all the faces in the test image using the default HOG-based model
-            # face_locations = face_recognition.face_locations(frame, number_of_times_to_upsample=3)
-            no = len(boxes)
-            print(f"Frame [{frame_index}]: {no} face(s) detected")
-            
-            # Predict emotions
-            for i in range(no):
-                print(f"Predicting emotions for Face [{i+1}]")
-                (top, right, bottom, left) = boxes[i]
-                face = frame[top:top+right, bottom:bottom+left]
-                if len(list(face)) > 0:
-                    emoclassifier.predict_emotions(image=frame, threshold=settings.ADJACENT_THRESHOLD)
-
-            # Get the embeddings of every face in the image
-            embedding_list = [x for x in face_recognition.face_encodings(frame, known_face_locations=boxes)]
-            # prediction output is a list of id 
-            if settings.PREDICTION_MODE == "svm":
-                # Prediction using svm
-                recognized = svm_classifier.predict(face_encodings=embedding_list)
-            elif settings.PREDICTION_MODE == "knn":
-                # Prediction using knn
-                recognized = knn_classifier.predict(
-                                face_encodings=embedding_list, 
-                                face_locations=boxes
-                                )
-            elif settings.PREDICTION_MODE == "direct-euclid":
-                # Predict using direct euclid comparison
-                recognized = direct_euclid_classifier.predict(face_encodings=embedding_list)
-            # discard unknown in set if it exists
-            if recognized:
-                _id.update(recognized)
-                _id.discard("unknown")
-            for i in _id:
-                if int(i) in registered_student_ids and not lecture_instance.lock:
-                    # check lecture lock incase processing was occuring when lecture was stopped so as not to add 
-                    # student after stopped_at
-                    student = Student.objects.get(id=int(i))
-                    lecture_instance.students_present.add(student)
-                    print(f"Marking student with id {int(i)} as present for Lecture {lecture_instance.course.name}-{lecture_instance_id}")
+    try:
+        with HUEY.lock_task('retrain-pkl'):
+            def take(pending):
+                if pending["first_requested_at"] is None:
+                    # an earlier job already applied these changes
+                    return pending, None
+                now = time.time()
+                if pending.get("retry_at") and now < pending["retry_at"]:
+                    # backing off after a failure, the job scheduled by the failure picks it up
+                    return pending, None
+                quiet = now - pending["last_requested_at"] >= settings.RETRAIN_QUIET_WINDOW
+                overdue = now - pending["first_requested_at"] >= settings.RETRAIN_MAX_LATENCY
+                if not quiet and not overdue:
+                    return pending, None
+                return new_pending_retrain(), pending
+            pending = update_retrain_state(RETRAIN_PENDING_KEY, take, new_pending_retrain)
+            if pending is None:
+                count_retrain("merged")
+                return
+            try:
+                with timed('retrain'):
+                    apply_image_deltas(pending["added"], pending["removed"])
+            except Exception:
+                # the classifiers must not miss these changes, they are retried with a later job
+                delay = restore_pending_retrain(pending)
+                if delay is None:
+                    logger.exception("Coalesced retrain failed %d times, dropping %d added and %d removed image(s) "
+                                     "until the next full retrain", settings.RETRAIN_MAX_ATTEMPTS,
+                                     len(pending["added"]), len(pending["removed"]))
                 else:
-                    print(f"Student {i} was recognized but was not registered for the course")
+                    logger.exception("Coalesced retrain failed, retrying %d added and %d removed image(s) "
+                                     "in %d seconds", len(pending["added"]), len(pending["removed"]), delay)
+                    run_coalesced_retrain.schedule(delay=delay)
+                raise
+            stats = count_retrain("executed")
+            logger.info("Coalesced retrain executed, %d requested, %d merged and %d executed so far",
+                        stats['requested'], stats['merged'], stats['executed'])
+    except TaskLockedException:
+        # a full retrain is running, try again once it has had time to finish
+        run_coalesced_retrain.schedule(delay=settings.RETRAIN_QUIET_WINDOW)
 
-            frame_index = frame_index + 1
-            print(f"Id's discovered in this iteration {_id}")
-            print(f"Single frame processing ran in {round(time.time() - loop_processing_time_start, 1)} seconds")
-        stop_lecture_time = time.time()
-        print(f"Lecture {lecture_instance.course.name}-{lecture_instance.id} was stopped, exiting attendance, {frame_index} frame(s) processed")
-        print(f"Lecture {lecture_instance.course.name}-{lecture_instance.id} attendance taking process ran for {round(stop_lecture_time - lecture_processing_time_start, 1)} seconds")
-        print("##############################################################################")
 
+@task()
+@lock_task('retrain-pkl')
+def retrain_pkl():
+    """
+    Background task for fully retraining the pickled objects
+    """
+    logger.info("Triggered retraining embedding caches")
+    store = get_embedding_store()
+    images = list(Image.objects.all())
+    import_legacy_embeddings(store, images)
+
+    # Only images without a stored embedding or face location go through the CNN
+    for image in images:
+        if image.id in store:
+            continue
+        logger.info("Image at %s is not in the embedding store, adding it", image.file.path)
+        try:
+            face_enc = image_embedding(image)
+        except Exception:
+            logger.exception("Cannot embed image %s at %s, skipping it", image.id, image.file.name)
+            continue
+        if face_enc is not None:
+            store.append(image.id, image.owner_id, face_enc)
+
+    # drop embeddings of images that no longer exist
+    for image_id in store.image_ids() - set(image.id for image in images):
+        store.delete(image_id)
+
+    # images created without going through the upload checks have no perceptual hash yet
+    hashed = backfill_hashes(Image.objects.all())
+    if hashed:
+        update_index(added=hashed)
+
+    with timed('retrain'):
+        update_classifiers(store, rebuild=True)
+    logger.info("Done retraining on %d embedding(s) from %s", len(store), settings.EMBEDDING_STORE)
+
+
+@task()
+def test_attendance(lecture_instance_id):
+    """
+    Begins taking attendance
+    Once a Lecture object is created
+
+    The lecture's pipeline runs on the attendance scheduler's worker processes,
+    so this task returns right away and lectures in several halls run side by side
+    """
+    lecture_instance = Lecture.objects.get(id=lecture_instance_id)
+    if not lecture_instance.lock and not lecture_instance.stopped_at:
+        get_scheduler().submit(lecture_instance_id, lecture_instance.source or settings.DEFAULT_FRAME_SOURCE)
@@ -1,3 +1,511 @@
-from django.test import TestCase
+import io
+import os
+import time
+import shutil
+import datetime
+import tempfile
+from unittest import mock
+import cv2
+import numpy as np
+from PIL import Image as PILImage
+from huey import MemoryHuey
+from huey.exceptions import TaskLockedException
+from django.db import connection
+from django.utils import timezone
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from backend.consumers import VideoStreamConsumer
+from fuskar import tasks
+from fuskar.models import Student, Course, Lecture, EmotionBucket
+from fuskar.artificial.ivf import IVFIndex
+from fuskar.artificial.matcher import EmbeddingMatcher
+from fuskar.artificial.store import EmbeddingStore
+from fuskar.utils.attendance import AttendanceSession
+from fuskar.utils.emotions import EmotionAggregator
+from fuskar.utils.camera import CaptureService, get_frames, iter_frames, release_capture
+from fuskar.utils.phash import BKTree, phash, hamming
 
-# Create your tests here.
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    CONTROL_CHANNEL={"BACKEND": "fuskar.utils.control.LocalControlChannel"},
+)
+class AttendanceSessionTestCase(TestCase):
+
+    def setUp(self):
+        # websocket deltas are sent from timer threads, keep them out of the test transaction
+        patcher = mock.patch('fuskar.signals.broadcaster')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.course = Course.objects.create(department='CPE', code='501', name='Embedded Systems')
+        Student.objects.bulk_create([
+            Student(gender='M', full_name=f'Student {i}', email=f'student{i}@fuskar.test', matric_no=f'MAT{i}')
+            for i in range(200)
+        ])
+        self.students = list(Student.objects.values_list('id', flat=True))
+        self.course.registered_students.add(*self.students)
+        # lock the lecture so creating it does not start taking attendance
+        self.lecture = Lecture.objects.create(course=self.course, lock=True)
+
+    def test_recognitions_do_not_query_per_frame(self):
+        session = AttendanceSession(self.lecture.id, flush_interval=0)
+        recognized = [str(i) for i in self.students] + ["unknown"]
+        with self.assertNumQueries(0):
+            for _ in range(100):
+                session.mark(recognized)
+        self.assertEqual(session.pending, set(self.students))
+
+    def test_flush_is_a_single_bulk_insert(self):
+        session = AttendanceSession(self.lecture.id, flush_interval=0)
+        session.mark([str(i) for i in self.students])
+        with CaptureQueriesContext(connection) as queries:
+            session.flush()
+        inserts = [query for query in queries.captured_queries if query['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(self.lecture.students_present.count(), 200)
+
+        # students already present are never written again
+        with self.assertNumQueries(0):
+            session.mark([str(i) for i in self.students])
+            session.flush()
+
+    def test_flush_waits_for_interval(self):
+        session = AttendanceSession(self.lecture.id, flush_interval=60)
+        session.mark([str(self.students[0])])
+        with self.assertNumQueries(0):
+            session.flush()
+        session.close()
+        self.assertEqual(list(self.lecture.students_present.values_list('id', flat=True)), [self.students[0]])
+
+    def test_registration_change_reloads_roster(self):
+        session = AttendanceSession(self.lecture.id, flush_interval=0)
+        student = Student.objects.create(gender='F', full_name='Late Student', email='late@fuskar.test', matric_no='LATE1')
+        self.assertEqual(session.mark([str(student.id)]), set())
+        self.course.registered_students.add(student)
+        self.assertEqual(session.mark([str(student.id)]), {student.id})
+        session.close()
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    CONTROL_CHANNEL={"BACKEND": "fuskar.utils.control.LocalControlChannel"},
+)
+class EmotionAggregatorTestCase(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('fuskar.signals.broadcaster')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        course = Course.objects.create(department='CPE', code='502', name='Digital Signal Processing')
+        # created locked so no attendance starts, opened without sending signals
+        self.lecture = Lecture.objects.create(course=course, lock=True)
+        Lecture.objects.filter(id=self.lecture.id).update(lock=False)
+        self.aggregator = EmotionAggregator(self.lecture, bucket_seconds=10, flush_interval=0)
+        self.now = time.time()
+
+    def counts(self):
+        return dict(EmotionBucket.objects.filter(lecture=self.lecture).values_list('emotion', 'count'))
+
+    def test_flush_increments_buckets(self):
+        self.aggregator.add(['calm', 'calm', 'fear'], timestamp=self.now)
+        self.aggregator.flush()
+        self.aggregator.add(['calm'], timestamp=self.now)
+        self.aggregator.flush()
+        self.assertEqual(self.counts(), {'calm': 3, 'fear': 1})
+
+    def test_final_flush_after_stop_keeps_buckets_started_before_it(self):
+        self.aggregator.add(['calm', 'surprise'], timestamp=self.now - 30)
+        self.aggregator.add(['fear'], timestamp=self.now + 30)
+        # the pipeline only closes once the lecture was stopped
+        stopped_at = datetime.datetime.fromtimestamp(self.now, tz=timezone.utc)
+        Lecture.objects.filter(id=self.lecture.id).update(lock=True, stopped_at=stopped_at)
+        self.aggregator.flush(force=True)
+        self.assertEqual(self.counts(), {'calm': 1, 'surprise': 1})
+
+    def test_locked_lecture_drops_counts(self):
+        Lecture.objects.filter(id=self.lecture.id).update(lock=True)
+        self.aggregator.add(['calm'], timestamp=self.now)
+        self.aggregator.flush(force=True)
+        self.assertEqual(self.counts(), {})
+        self.assertFalse(self.aggregator.pending)
+
+
+@override_settings(CONTROL_CHANNEL={"BACKEND": "fuskar.utils.control.LocalControlChannel"})
+class VideoStreamStopTestCase(TestCase):
+
+    def viewer(self):
+        viewer = VideoStreamConsumer({'query_string': b''})
+        viewer.watch_stop()
+        self.addCleanup(viewer.unsubscribe)
+        return viewer
+
+    def stop_stream(self):
+        response = self.client.post('/video')
+        self.assertEqual(response.status_code, 202)
+
+    def test_stop_applies_to_viewers_connected_before_it(self):
+        self.stop_stream()
+        viewer = self.viewer()
+        # the earlier stop does not end a viewer that connected after it
+        self.assertFalse(viewer.stop_requested())
+        self.stop_stream()
+        self.assertTrue(viewer.stop_requested())
+
+    def test_stop_is_per_viewer(self):
+        first = self.viewer()
+        self.stop_stream()
+        second = self.viewer()
+        self.assertTrue(first.stop_requested())
+        self.assertFalse(second.stop_requested())
+        second.unsubscribe()
+        self.stop_stream()
+        # a disconnected viewer no longer listens
+        self.assertFalse(second.stop_requested())
+
+
+class CaptureServiceTestCase(SimpleTestCase):
+    frame_count = 12
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.video_path = os.path.join(directory, 'lecture.avi')
+        writer = cv2.VideoWriter(self.video_path, cv2.VideoWriter_fourcc(*'MJPG'), 25.0, (64, 48))
+        for index in range(self.frame_count):
+            writer.write(np.full((48, 64, 3), index * 20, dtype=np.uint8))
+        writer.release()
+
+    def run_to_end(self, capture):
+        capture.start()
+        capture.join(timeout=10)
+        self.assertFalse(capture.is_alive())
+
+    def test_ring_buffer_keeps_newest_frames(self):
+        capture = CaptureService(source=self.video_path, buffer_size=3, realtime=False)
+        self.run_to_end(capture)
+        self.assertEqual([frame.index for frame in capture.frames()],
+                         [self.frame_count - 2, self.frame_count - 1, self.frame_count])
+        self.assertEqual(capture.latest(timeout=0).index, self.frame_count)
+
+    def test_file_source_stops_at_end_without_loop(self):
+        capture = CaptureService(source=self.video_path, loop=False, realtime=False)
+        self.run_to_end(capture)
+        self.assertFalse(capture.running)
+        self.assertEqual(capture.index, self.frame_count)
+        # an exhausted source answers at once instead of waiting for the timeout
+        self.assertIsNone(capture.latest(after=self.frame_count, timeout=10))
+
+    def test_stop_ends_thread(self):
+        capture = CaptureService(source=self.video_path, loop=True, realtime=False)
+        capture.start()
+        self.assertIsNotNone(capture.latest(timeout=5))
+        capture.stop()
+        capture.join(timeout=5)
+        self.assertFalse(capture.is_alive())
+        self.assertGreater(capture.index, 0)
+
+    def test_get_frames_reads_from_capture_service(self):
+        with override_settings(FRAME_SOURCES={"test": self.video_path}):
+            self.addCleanup(release_capture, "test")
+            frames = get_frames(3, max_wait=5, source="test")
+        self.assertEqual(len(frames), 3)
+        for frame in frames:
+            self.assertEqual(frame.shape, (48, 64, 3))
+
+    def test_iter_frames_reads_the_whole_file(self):
+        self.assertEqual(len(list(iter_frames(self.video_path))), self.frame_count)
+        self.assertEqual(len(list(iter_frames(self.video_path, limit=5))), 5)
+
+    def test_batches_continue_after_the_last_consumed_frame(self):
+        capture = CaptureService(source=self.video_path, realtime=False)
+        self.run_to_end(capture)
+        first = capture.batch(3, max_wait=0)
+        self.assertEqual([frame.index for frame in first], [self.frame_count])
+        # the frame ending the previous batch is not handed out again
+        self.assertEqual(capture.batch(3, max_wait=0, after=first[-1].index), [])
+
+
+class EmbeddingMatcherTestCase(SimpleTestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.embeddings = rng.normal(scale=0.1, size=(5, 128)).astype(np.float32)
+        self.matcher = EmbeddingMatcher(self.embeddings, ['10', '11', '12', '13', '14'])
+
+    def test_match_at_first_gallery_index(self):
+        # the first embedding of the gallery used to be reported as unknown
+        self.assertEqual(self.matcher.match([self.embeddings[0]], 0.4), ['10'])
+
+    def test_matches_every_face_of_a_frame(self):
+        faces = self.embeddings[[3, 0, 4]] + 0.001
+        self.assertEqual(self.matcher.match(faces, 0.4), ['13', '10', '14'])
+
+    def test_faces_beyond_threshold_are_unknown(self):
+        far = self.embeddings[0] + 1.0
+        self.assertEqual(self.matcher.match([far, self.embeddings[2]], 0.4), ['unknown', '12'])
+
+    def test_empty_gallery_and_no_faces(self):
+        empty = EmbeddingMatcher.from_encoding_list([])
+        self.assertEqual(empty.match([self.embeddings[0]], 0.4), ['unknown'])
+        self.assertEqual(self.matcher.match([], 0.4), [])
+
+    def test_distances_match_euclidean_norm(self):
+        expected = np.linalg.norm(self.embeddings[:, None] - self.embeddings[None, :], axis=2)
+        np.testing.assert_allclose(self.matcher.distances(self.embeddings), expected, atol=1e-3)
+
+
+class EmbeddingStoreTestCase(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'embeddings')
+        self.store = EmbeddingStore(self.path, dim=4, compact_ratio=0.25)
+
+    def embedding(self, value):
+        return np.full(4, value, dtype=np.float32)
+
+    def test_append_get_and_replace(self):
+        self.store.append(1, 10, self.embedding(1))
+        self.store.append(2, 20, self.embedding(2))
+        np.testing.assert_array_equal(self.store.get(2), self.embedding(2))
+        self.assertIsNone(self.store.get(3))
+        # appending an image again replaces its embedding
+        self.store.append(1, 10, self.embedding(5))
+        np.testing.assert_array_equal(self.store.get(1), self.embedding(5))
+        self.assertEqual(len(self.store), 2)
+        self.assertEqual(self.store.tombstones(), 1)
+
+    def test_delete_hides_rows_from_gallery(self):
+        for image_id in range(4):
+            self.store.append(image_id, image_id * 10, self.embedding(image_id))
+        self.assertTrue(self.store.delete(1))
+        self.assertFalse(self.store.delete(1))
+        embeddings, student_ids, image_ids = self.store.gallery()
+        self.assertEqual(image_ids.tolist(), [0, 2, 3])
+        self.assertEqual(student_ids.tolist(), [0, 20, 30])
+        np.testing.assert_array_equal(embeddings[:, 0], [0, 2, 3])
+
+    def test_compaction_keeps_live_rows(self):
+        for image_id in range(4):
+            self.store.append(image_id, image_id * 10, self.embedding(image_id))
+        self.store.delete(0)
+        self.assertFalse(self.store.maybe_compact())
+        self.store.delete(2)
+        self.assertTrue(self.store.maybe_compact())
+        self.assertEqual(self.store.tombstones(), 0)
+        self.assertEqual(self.store.generation(), 1)
+        _, _, image_ids = self.store.gallery()
+        self.assertEqual(image_ids.tolist(), [1, 3])
+        np.testing.assert_array_equal(self.store.get(3), self.embedding(3))
+
+    def test_other_instances_see_changes(self):
+        reader = EmbeddingStore(self.path, dim=4)
+        self.assertEqual(len(reader), 0)
+        self.store.append(7, 70, self.embedding(7))
+        self.assertIn(7, reader)
+        self.store.delete(7)
+        self.store.append(8, 80, self.embedding(8))
+        self.store.compact()
+        self.assertEqual(reader.image_ids(), {8})
+        np.testing.assert_array_equal(reader.get(8), self.embedding(8))
+
+    def test_partial_row_of_interrupted_append_is_dropped(self):
+        self.store.append(1, 10, self.embedding(1))
+        embeddings_path, _ = self.store.files()
+        with open(embeddings_path, 'ab') as stream:
+            stream.write(b'\0' * 6)
+        self.store.append(2, 20, self.embedding(2))
+        np.testing.assert_array_equal(self.store.get(2), self.embedding(2))
+        self.assertEqual(os.path.getsize(embeddings_path), 2 * self.store.row_bytes)
+
+
+class CoalescedRetrainTestCase(SimpleTestCase):
+
+    def setUp(self):
+        huey = MemoryHuey('fuskar-test')
+        for patcher in (
+                mock.patch.object(tasks, 'HUEY', huey),
+                mock.patch.object(tasks, 'retrain_state_locks', {
+                    key: huey.lock_task(f'{key}-lock')
+                    for key in (tasks.RETRAIN_PENDING_KEY, tasks.RETRAIN_STATS_KEY)}),
+                mock.patch.object(tasks.run_coalesced_retrain, 'schedule')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(tasks, 'apply_image_deltas')
+        self.apply = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_job(self):
+        return tasks.run_coalesced_retrain.call_local()
+
+    def pending(self):
+        return tasks.update_retrain_state(
+            tasks.RETRAIN_PENDING_KEY, lambda pending: (pending, pending), tasks.new_pending_retrain)
+
+    @override_settings(RETRAIN_QUIET_WINDOW=60, RETRAIN_MAX_LATENCY=600)
+    def test_requests_within_quiet_window_are_merged(self):
+        tasks.request_retrain(added=[1, 3])
+        tasks.request_retrain(added=[2], removed=[3])
+        self.run_job()
+        self.apply.assert_not_called()
+        with override_settings(RETRAIN_QUIET_WINDOW=0):
+            self.run_job()
+            self.run_job()
+        self.apply.assert_called_once_with({1, 2}, {3})
+        self.assertEqual(tasks.retrain_stats(), {"requested": 2, "merged": 2, "executed": 1})
+
+    @override_settings(RETRAIN_QUIET_WINDOW=5, RETRAIN_MAX_LATENCY=0)
+    def test_failed_delta_is_retried_after_backoff(self):
+        tasks.request_retrain(added=[1])
+        self.apply.side_effect = OSError("disk full")
+        with self.assertRaises(OSError):
+            self.run_job()
+        tasks.run_coalesced_retrain.schedule.assert_called_with(delay=5)
+        self.assertEqual(self.pending()["failures"], 1)
+
+        # changes requested meanwhile wait for the retry with the failed delta
+        self.apply.side_effect = None
+        tasks.request_retrain(added=[2])
+        self.run_job()
+        self.apply.assert_called_once()
+        tasks.update_retrain_state(
+            tasks.RETRAIN_PENDING_KEY, lambda pending: (dict(pending, retry_at=None), None), tasks.new_pending_retrain)
+        self.run_job()
+        self.apply.assert_called_with({1, 2}, set())
+        self.assertEqual(self.pending(), tasks.new_pending_retrain())
+
+    @override_settings(RETRAIN_QUIET_WINDOW=0, RETRAIN_MAX_LATENCY=0, RETRAIN_MAX_ATTEMPTS=2)
+    def test_delta_is_dropped_after_max_attempts(self):
+        tasks.request_retrain(added=[1])
+        self.apply.side_effect = OSError("disk full")
+        for _ in range(2):
+            with self.assertRaises(OSError):
+                self.run_job()
+        self.assertEqual(self.apply.call_count, 2)
+        self.assertIsNone(self.pending()["first_requested_at"])
+
+    @override_settings(RETRAIN_LOCK_TIMEOUT=0.05)
+    def test_stale_state_lock_times_out(self):
+        with tasks.retrain_state_locks[tasks.RETRAIN_PENDING_KEY]:
+            with self.assertRaises(TaskLockedException):
+                tasks.request_retrain(added=[1])
+
+
+
+class ApplyImageDeltasTestCase(SimpleTestCase):
+
+    def test_unreadable_image_is_skipped(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        store = EmbeddingStore(directory)
+        images = [mock.Mock(id=1, owner_id=10), mock.Mock(id=2, owner_id=20)]
+        encoding = np.zeros(128, dtype=np.float32)
+        with mock.patch.object(tasks, 'get_embedding_store', return_value=store), \
+                mock.patch.object(tasks.Image.objects, 'filter', return_value=images), \
+                mock.patch.object(tasks, 'image_embedding', side_effect=[OSError("truncated file"), encoding]), \
+                mock.patch.object(tasks, 'update_classifiers') as update_classifiers:
+            tasks.apply_image_deltas({1, 2}, set())
+        self.assertEqual(store.image_ids(), {2})
+        self.assertEqual([image_id for image_id, _, _ in update_classifiers.call_args[1]['added']], [2])
+
+
+class PerceptualHashTestCase(SimpleTestCase):
+
+    def picture(self, seed, size=(160, 120), quality=None):
+        rng = np.random.RandomState(seed)
+        # smooth blobs rather than noise, like a photo the hash survives resizing and recompression
+        small = rng.randint(0, 256, size=(6, 8, 3), dtype=np.uint8)
+        picture = PILImage.fromarray(small).resize(size, PILImage.BICUBIC)
+        stream = io.BytesIO()
+        if quality:
+            picture.save(stream, format='JPEG', quality=quality)
+        else:
+            picture.save(stream, format='PNG')
+        stream.seek(0)
+        return stream
+
+    def test_near_duplicates_hash_close(self):
+        original = phash(self.picture(1))
+        resized = phash(self.picture(1, size=(80, 60), quality=60))
+        other = phash(self.picture(2))
+        self.assertLessEqual(hamming(original, resized), 6)
+        self.assertGreater(hamming(original, other), 6)
+
+    def test_bktree_search_within_distance(self):
+        tree = BKTree()
+        values = [0b0, 0b1, 0b11, 0b111, 0b1111111, 0xffff << 40]
+        for item, value in enumerate(values):
+            tree.add(value, item)
+        self.assertEqual(tree.search(0b0, 2), [(0, 0), (1, 1), (2, 2)])
+        self.assertEqual([item for _, item in tree.search(0b1111111, 0)], [4])
+        self.assertEqual(tree.search(0xffff << 20, 0), [])
+        found = set(item for _, item in tree.search(0xffff << 40, 64))
+        self.assertEqual(found, set(range(len(values))))
+
+    def test_bktree_items_sharing_a_hash_and_removal(self):
+        tree = BKTree()
+        tree.add(0b101, 1)
+        tree.add(0b101, 2)
+        tree.add(0b100, 3)
+        self.assertEqual(len(tree), 3)
+        tree.remove(0b101, 1)
+        tree.remove(0b101, 7)
+        self.assertEqual(sorted(tree.search(0b101, 1)), [(0, 2), (1, 3)])
+        # removing every item of the root hash keeps its children reachable
+        tree.remove(0b101, 2)
+        self.assertEqual(tree.search(0b100, 0), [(0, 3)])
+        self.assertEqual(len(tree), 1)
+
+
+class IVFIndexTestCase(SimpleTestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.embeddings = rng.normal(scale=0.1, size=(200, 128)).astype(np.float32)
+        self.labels = np.arange(200) % 20
+        self.image_ids = np.arange(1000, 1200)
+        self.index = IVFIndex.build(self.embeddings, self.labels, self.image_ids, nlist=8)
+
+    def test_probing_every_list_is_exact(self):
+        queries = self.embeddings[[0, 57, 199]] + 0.001
+        labels, image_ids, distances = self.index.search(queries, nprobe=self.index.nlist)
+        self.assertEqual(image_ids.tolist(), [1000, 1057, 1199])
+        self.assertEqual(labels.tolist(), [0, 17, 19])
+        self.assertTrue(np.all(distances < 0.05))
+
+    def test_match_applies_threshold(self):
+        faces = [self.embeddings[3], self.embeddings[3] + 1.0]
+        self.assertEqual(self.index.match(faces, 0.4, nprobe=self.index.nlist), ['3', 'unknown'])
+        self.assertEqual(self.index.match([], 0.4, nprobe=1), [])
+
+    def test_add_replaces_and_remove_deletes(self):
+        moved = np.full((1, 128), 0.5, dtype=np.float32)
+        self.index.add(moved, [99], [1000])
+        self.assertEqual(len(self.index), 200)
+        _, image_ids, _ = self.index.search(moved, nprobe=self.index.nlist)
+        self.assertEqual(image_ids.tolist(), [1000])
+        self.assertEqual(self.index.remove([1000, 5]), 1)
+        self.assertNotIn(1000, self.index)
+        _, image_ids, _ = self.index.search(self.embeddings[0], nprobe=self.index.nlist)
+        self.assertNotEqual(image_ids.tolist(), [1000])
+
+    def test_save_and_load(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'ann-index.npz')
+        self.index.save(path)
+        loaded = IVFIndex.load(path)
+        self.assertEqual(len(loaded), len(self.index))
+        np.testing.assert_array_equal(loaded.centroids, self.index.centroids)
+        for nprobe in (1, 3):
+            for expected, found in zip(self.index.search(self.embeddings, nprobe), loaded.search(self.embeddings, nprobe)):
+                np.testing.assert_array_equal(expected, found)
+
+    def test_empty_gallery(self):
+        index = IVFIndex.build(np.empty((0, 128), dtype=np.float32), [], [])
+        self.assertEqual(len(index), 0)
+        labels, image_ids, _ = index.search(self.embeddings[:2], nprobe=8)
+        self.assertEqual(image_ids.tolist(), [-1, -1])
+        index.add(self.embeddings[:1], [4], [7])
+        self.assertEqual(index.match(self.embeddings[:1], 0.4, nprobe=8), ['4'])
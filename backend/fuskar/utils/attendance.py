@@ -0,0 +1,92 @@
+"""
+In-memory state of lectures whose attendance is being taken
+"""
+import time
+import logging
+from django.conf import settings
+from django.db import models
+from fuskar.models import Lecture, Student
+from fuskar.utils.control import get_control_channel, ROSTER_CHANGED
+
+logger = logging.getLogger(__name__)
+
+
+def notify_roster_changed(course_ids=None):
+    """
+    Ask running sessions, in any process, to reload their roster and present students
+
+    :param course_ids: only sessions of these courses, every session if None
+    """
+    get_control_channel().publish(ROSTER_CHANGED, {"courses": list(course_ids) if course_ids is not None else None})
+
+
+class AttendanceSession(object):
+    """
+    Loads a lecture's roster and present students once and writes
+    newly recognised students in one bulk insert per flush interval
+    """
+    def __init__(self, lecture_id, flush_interval=None):
+        self.lecture = Lecture.objects.select_related('course').get(id=lecture_id)
+        self.flush_interval = settings.ATTENDANCE_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self.pending = set()
+        self.last_flush = time.time()
+        self.load()
+        get_control_channel().subscribe(ROSTER_CHANGED, self.on_roster_changed)
+
+    def on_roster_changed(self, message):
+        courses = (message or {}).get("courses")
+        if courses is None or self.lecture.course_id in courses:
+            self.stale = True
+
+    def load(self):
+        """
+        (Re)load the roster and the students already present
+        """
+        self.roster = set(self.lecture.course.registered_students.values_list('id', flat=True))
+        self.present = set(self.lecture.students_present.values_list('id', flat=True))
+        self.stale = False
+
+    def mark(self, recognized):
+        """
+        Record recognised student ids, unknown faces and students
+        not registered for the course are ignored
+
+        :return: set of ids seen for the first time in this lecture
+        """
+        if self.stale:
+            self.load()
+        ids = set(int(i) for i in recognized if str(i).isdigit())
+        for i in ids - self.roster:
+            logger.warning("Student %s was recognized but was not registered for the course", i)
+        new = (ids & self.roster) - self.present - self.pending
+        self.pending |= new
+        return new
+
+    def flush(self, force=False):
+        """
+        Insert pending students into the students_present through table,
+        at most once every flush_interval seconds unless forced
+        """
+        if not self.pending or (not force and time.time() - self.last_flush < self.flush_interval):
+            return
+        through = Lecture.students_present.through
+        through.objects.bulk_create(
+            [through(lecture_id=self.lecture.id, student_id=student_id) for student_id in self.pending],
+            ignore_conflicts=True
+        )
+        # bulk_create bypasses m2m_changed, send it so listeners still see the additions
+        models.signals.m2m_changed.send(
+            sender=through, instance=self.lecture, action='post_add',
+            reverse=False, model=Student, pk_set=set(self.pending), using=through.objects.db
+        )
+        logger.info("Marking student(s) with id %s as present for Lecture %s-%s", sorted(self.pending), self.lecture.course.name, self.lecture.id)
+        self.present |= self.pending
+        self.pending = set()
+        self.last_flush = time.time()
+
+    def close(self):
+        """
+        Flush what is left and stop receiving change notifications
+        """
+        self.flush(force=True)
+        get_control_channel().unsubscribe(ROSTER_CHANGED, self.on_roster_changed)
@@ -0,0 +1,138 @@
+"""
+Throttled websocket broadcasting of lecture updates
+
+Changes to a lecture are coalesced for WS_BROADCAST_WINDOW seconds and sent as one
+compact delta (newly present students, emotion count increments). A full serialized
+snapshot is sent when requested and at least every WS_SNAPSHOT_INTERVAL seconds.
+"""
+import json
+import time
+import threading
+from collections import Counter
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import connection
+from django.core.serializers.json import DjangoJSONEncoder
+from fuskar.utils.metrics import timed, WEBSOCKET_MESSAGES, WEBSOCKET_BYTES
+
+
+def lecture_group(lecture_id):
+    return f'lectures_update_group_{lecture_id}'
+
+
+class LectureBroadcaster(object):
+    """
+    Coalesces lecture changes per lecture and sends them to the lecture's websocket group
+    """
+    def __init__(self, window=None, snapshot_interval=None):
+        self.window = settings.WS_BROADCAST_WINDOW if window is None else window
+        self.snapshot_interval = settings.WS_SNAPSHOT_INTERVAL if snapshot_interval is None else snapshot_interval
+        self.lock = threading.Lock()
+        self.pending = dict()
+        self.timers = dict()
+        self.last_snapshot = dict()
+        self.counters = {
+            "messages": 0,
+            "deltas": 0,
+            "snapshots": 0,
+            "bytes": 0,
+        }
+        self.started_at = time.time()
+
+    def changes(self, lecture_id):
+        return self.pending.setdefault(lecture_id, {
+            "students_present": set(),
+            "emotions": Counter(),
+            "snapshot": False,
+        })
+
+    def students_present(self, lecture_id, student_ids):
+        with self.lock:
+            self.changes(lecture_id)["students_present"].update(student_ids)
+            self.schedule(lecture_id)
+
+    def emotions(self, lecture_id, counts):
+        with self.lock:
+            self.changes(lecture_id)["emotions"].update(counts)
+            self.schedule(lecture_id)
+
+    def snapshot(self, lecture_id):
+        with self.lock:
+            self.changes(lecture_id)["snapshot"] = True
+            self.schedule(lecture_id)
+
+    def schedule(self, lecture_id):
+        """
+        Start the window of a lecture unless one is already open, called with the lock held
+        """
+        if lecture_id in self.timers:
+            return
+        if self.window <= 0:
+            threading.Thread(target=self.flush, args=(lecture_id,), daemon=True).start()
+            self.timers[lecture_id] = None
+            return
+        timer = threading.Timer(self.window, self.flush, args=(lecture_id,))
+        timer.daemon = True
+        self.timers[lecture_id] = timer
+        timer.start()
+
+    def message(self, lecture_id, changes):
+        from fuskar.models import Lecture
+        from fuskar.serializers import LectureSerializer
+
+        now = time.time()
+        if changes["snapshot"] or now - self.last_snapshot.get(lecture_id, 0) >= self.snapshot_interval:
+            self.last_snapshot[lecture_id] = now
+            lecture = Lecture.objects.prefetch_related('emotion_buckets').get(id=lecture_id)
+            return 'lecture.snapshot', LectureSerializer(lecture).data
+        return 'lecture.delta', {
+            "id": lecture_id,
+            "students_present": sorted(changes["students_present"]),
+            "emotions": dict(changes["emotions"]),
+        }
+
+    def flush(self, lecture_id):
+        """
+        Send everything that changed for a lecture during its window
+        """
+        with self.lock:
+            self.timers.pop(lecture_id, None)
+            changes = self.pending.pop(lecture_id, None)
+        if not changes:
+            return
+        try:
+            event_type, message = self.message(lecture_id, changes)
+        finally:
+            # timer threads are short lived, do not leak their database connection
+            if threading.current_thread() is not threading.main_thread():
+                connection.close()
+        self.send(lecture_id, event_type, message)
+
+    def send(self, lecture_id, event_type, message):
+        with timed('websocket_send'):
+            async_to_sync(get_channel_layer().group_send)(
+                lecture_group(lecture_id),
+                {
+                    'type': event_type,
+                    'message': message,
+                }
+            )
+        size = len(json.dumps(message, cls=DjangoJSONEncoder))
+        kind = "snapshots" if event_type == 'lecture.snapshot' else "deltas"
+        with self.lock:
+            self.counters["messages"] += 1
+            self.counters[kind] += 1
+            self.counters["bytes"] += size
+        WEBSOCKET_MESSAGES.labels(kind).inc()
+        WEBSOCKET_BYTES.inc(size)
+
+    def stats(self):
+        """
+        Messages and payload bytes sent, with bytes per minute since start
+        """
+        minutes = max(time.time() - self.started_at, 1) / 60
+        return dict(self.counters, bytes_per_minute=round(self.counters["bytes"] / minutes, 1))
+
+
+broadcaster = LectureBroadcaster()
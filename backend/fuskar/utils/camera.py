@@ -1,14 +1,22 @@
 import random
 import string
 import os
+import time
+import fcntl
+import hashlib
 import cv2
 import numpy as np
 import imutils
+import logging
 import threading
+from collections import deque, namedtuple
 from django.conf import settings
 
 from fuskar.utils.nano import running_on_jetson_nano, get_jetson_gstreamer_source
-from fuskar.models import Capturing
+from fuskar.artificial.detectors import get_detector
+from fuskar.utils.metrics import STAGE_SECONDS, CAPTURED_FRAMES
+
+logger = logging.getLogger(__name__)
 
 if settings.DEBUG:
     media_path = settings.MEDIA_ROOT
@@ -18,27 +26,279 @@ else:
     cache_path = settings.CACHE_URL
 
 video_camera = None
-global_frame = None
+camera_lock = threading.Lock()
+# capture services of this process keyed by settings.FRAME_SOURCES name
+captures = dict()
+captures_lock = threading.Lock()
 stopped = False
-prototxtfile = os.path.join(cache_path, "cache", "deploy.prototxt")
-caffemodel = os.path.join(cache_path, "cache", "detect.caffemodel")
 video_path = os.path.join(media_path, 'video', 'video.avi')
 
+# a single captured frame, index increases monotonically per capture service
+Frame = namedtuple('Frame', ['index', 'timestamp', 'image'])
+
+
+def open_capture(source=None):
+    """
+    Open an OpenCV capture for a source
+
+    :param source: None for the default camera (gstreamer on the jetson nano),
+        a device index, a gstreamer pipeline, an RTSP url or a video file path
+    """
+    if source is None:
+        if running_on_jetson_nano():
+            return cv2.VideoCapture(get_jetson_gstreamer_source(), cv2.CAP_GSTREAMER)
+        return cv2.VideoCapture(0)
+    if isinstance(source, str) and source.endswith("appsink"):
+        return cv2.VideoCapture(source, cv2.CAP_GSTREAMER)
+    return cv2.VideoCapture(source)
+
+
+def exclusive_device(source):
+    """
+    True for local cameras, which only one process can read at a time,
+    unlike video files and network streams
+    """
+    if source is None or isinstance(source, int):
+        return True
+    return not os.path.isfile(source) and '://' not in source
+
+
+def device_lock_path(source):
+    """
+    Lock file held by the process reading a local camera
+    """
+    key = hashlib.md5(repr(source).encode()).hexdigest()[:12]
+    return os.path.join(settings.CAPTURE_LOCK_DIR, f"capture-{key}.lock")
+
+
+class CaptureService(threading.Thread):
+    """
+    Owns a video source for the lifetime of the process and keeps
+    the latest frames in a ring buffer so readers never touch the device
+
+    A local camera is only opened while holding its lock file, a process that finds
+    it held by another one (the preview of the web process or an attendance worker)
+    waits CAMERA_FAILURE_TIMEOUT seconds for it and then gives up, instead of
+    failing to read from a device that is already streaming elsewhere.
+    """
+    def __init__(self, source=None, buffer_size=None, loop=False, realtime=None):
+        """
+        :param source: see `open_capture`
+        :param buffer_size: number of frames kept in the ring buffer (default: settings.CAMERA_BUFFER_SIZE)
+        :param loop: rewind file sources once they are exhausted
+        :param realtime: pace file sources at their native frame rate (default: True for files)
+        """
+        threading.Thread.__init__(self, name="Capture Service Thread", daemon=True)
+        self.source = source
+        self.loop = loop
+        self.buffer = deque(maxlen=buffer_size or settings.CAMERA_BUFFER_SIZE)
+        self.condition = threading.Condition()
+        self.isRunning = True
+        self.index = 0
+
+        self.is_file = isinstance(source, str) and os.path.isfile(source)
+        self.realtime = self.is_file if realtime is None else realtime
+        self.device_lock = None
+        self.cap = None
+        self.frame_interval = 0
+        # opened right away when the device is free, run() keeps trying otherwise
+        self.open_source()
+
+    def open_source(self):
+        """
+        Open the source, taking the lock of a local camera first
+
+        :return: False if the camera is held by another process
+        """
+        if exclusive_device(self.source) and self.device_lock is None:
+            os.makedirs(settings.CAPTURE_LOCK_DIR, exist_ok=True)
+            stream = open(device_lock_path(self.source), 'a')
+            try:
+                fcntl.flock(stream, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                stream.close()
+                return False
+            self.device_lock = stream
+        self.cap = open_capture(self.source)
+        fps = self.cap.get(cv2.CAP_PROP_FPS) if self.realtime else 0
+        self.frame_interval = 1.0 / fps if fps and fps > 0 else 0
+        return True
+
+    def run(self):
+        try:
+            self.read_frames()
+        finally:
+            with self.condition:
+                self.isRunning = False
+                self.condition.notify_all()
+            if self.cap is not None:
+                self.cap.release()
+            if self.device_lock is not None:
+                # closing the lock file hands the camera to the next process
+                self.device_lock.close()
+
+    def read_frames(self):
+        last_read = time.time()
+        if self.cap is None:
+            logger.warning("Frame source %s is held by another process, waiting for it", self.source)
+            while not self.open_source():
+                if not self.isRunning:
+                    return
+                if time.time() - last_read >= settings.CAMERA_FAILURE_TIMEOUT:
+                    logger.error("Frame source %s was held by another process for %d seconds, giving up",
+                                 self.source, settings.CAMERA_FAILURE_TIMEOUT)
+                    return
+                time.sleep(0.5)
+            last_read = time.time()
+        while self.isRunning:
+            started = time.time()
+            ret, frame = self.cap.read()
+            STAGE_SECONDS.labels('capture_read').observe(time.time() - started)
+            if not ret:
+                if self.is_file and self.loop:
+                    self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                    continue
+                if self.is_file:
+                    break
+                if time.time() - last_read >= settings.CAMERA_FAILURE_TIMEOUT:
+                    logger.error("Frame source %s delivered no frame for %d seconds, releasing it",
+                                 self.source, settings.CAMERA_FAILURE_TIMEOUT)
+                    break
+                # device hiccup, back off briefly instead of spinning
+                time.sleep(0.01)
+                continue
+            last_read = time.time()
+            CAPTURED_FRAMES.inc()
+            with self.condition:
+                self.index += 1
+                self.buffer.append(Frame(self.index, time.time(), frame))
+                self.condition.notify_all()
+            if self.frame_interval:
+                time.sleep(max(0, self.frame_interval - (time.time() - started)))
+
+    def latest(self, after=0, timeout=None):
+        """
+        Return the most recent `Frame` newer than `after`
+        waiting for the capture thread if necessary
+
+        :param after: index of the last frame the caller has seen
+        :param timeout: seconds to wait for a new frame, None waits forever
+        :return: Frame or None if the source is exhausted or the wait timed out
+        """
+        with self.condition:
+            self.condition.wait_for(
+                lambda: (self.buffer and self.buffer[-1].index > after) or not self.isRunning,
+                timeout=timeout)
+            if self.buffer and self.buffer[-1].index > after:
+                return self.buffer[-1]
+        return None
+
+    def frames(self, after=0):
+        """
+        Return every buffered `Frame` newer than `after`, oldest first
+        """
+        with self.condition:
+            return [frame for frame in self.buffer if frame.index > after]
+
+    def batch(self, count, max_wait, after=0, stop=None):
+        """
+        Collect up to `count` distinct frames newer than `after`,
+        returning early once `max_wait` seconds have passed
+
+        :param after: index of the last frame the caller consumed, pass the index
+            of the last frame of the previous batch so no frame is read twice
+        :param stop: optional `threading.Event`, the batch is returned as soon as it is set
+        :return: list of `Frame`, oldest first
+        """
+        deadline = time.time() + max_wait
+        frames = list()
+        while len(frames) < count and not (stop and stop.is_set()):
+            remaining = deadline - time.time()
+            if frames and remaining <= 0:
+                break
+            frame = self.latest(after=after, timeout=max(remaining, 0) if frames else settings.CAMERA_READ_TIMEOUT)
+            if frame is None:
+                break
+            after = frame.index
+            frames.append(frame)
+        return frames
+
+    @property
+    def running(self):
+        """
+        False once the source is exhausted, has failed or the service was stopped
+        """
+        return self.isRunning and self.is_alive()
+
+    def stop(self):
+        self.isRunning = False
+
+
+def get_capture(name=None):
+    """
+    The capture service of a named frame source, started on first use
+    and shared by every reader in this process, a service that stopped
+    running is replaced by a new one
+
+    :param name: key of settings.FRAME_SOURCES (default: settings.DEFAULT_FRAME_SOURCE)
+    """
+    name = name or settings.DEFAULT_FRAME_SOURCE
+    with captures_lock:
+        capture = captures.get(name)
+        if capture is not None and not capture.running:
+            logger.info("Capture service of frame source %s stopped, opening it again", name)
+            del captures[name]
+            capture = None
+        if capture is None:
+            try:
+                source = settings.FRAME_SOURCES[name]
+            except KeyError:
+                raise KeyError(f"Unknown frame source {name}, expected one of {list(settings.FRAME_SOURCES)}")
+            capture = captures[name] = CaptureService(source=source)
+            capture.start()
+    return capture
+
+def release_capture(name=None):
+    """
+    Stop the capture service of a named frame source and release its device
+    """
+    name = name or settings.DEFAULT_FRAME_SOURCE
+    with captures_lock:
+        capture = captures.pop(name, None)
+    if capture:
+        capture.stop()
+
+def release_unused_capture(name=None):
+    """
+    Release a frame source unless the global camera object still reads it
+
+    :return: True if the capture service was released
+    """
+    name = name or settings.DEFAULT_FRAME_SOURCE
+    with camera_lock:
+        if video_camera is not None and (video_camera.source or settings.DEFAULT_FRAME_SOURCE) == name:
+            return False
+        release_capture(name)
+    return True
+
+
 class RecordingThread(threading.Thread):
     def __init__(self, name, camera):
         threading.Thread.__init__(self)
         self.name = name
         self.isRunning = True
 
-        self.cap = camera
+        self.capture = camera
         fourcc = cv2.VideoWriter_fourcc(*'MJPG')
         self.out = cv2.VideoWriter(video_path,fourcc, 20.0, (640,480))
 
     def run(self):
+        last_index = 0
         while self.isRunning:
-            ret, frame = self.cap.read()
-            if ret:
-                self.out.write(frame)
+            frame = self.capture.latest(after=last_index, timeout=1)
+            if frame:
+                last_index = frame.index
+                self.out.write(frame.image)
 
         self.out.release()
 
@@ -49,71 +309,33 @@ class RecordingThread(threading.Thread):
         self.out.release()
 
 class VideoCamera(object):
-    def __init__(self):
-        # Open a camera
-        if running_on_jetson_nano():
-            self.cap = cv2.VideoCapture(
-                get_jetson_gstreamer_source(),
-                cv2.CAP_GSTREAMER
-            )
-        else:
-            self.cap = cv2.VideoCapture(0)
-      
+    def __init__(self, source=None):
+        # Share the capture service of the frame source, opened once per process
+        self.source = source
+        self.capture = get_capture(source)
+
         # Initialize video recording environment
         self.is_record = False
         self.out = None
-        self.classifier = cv2.dnn.readNetFromCaffe(prototxtfile, caffemodel)
 
         # Thread for recording
         self.recordingThread = None
     
-    def __del__(self):
-        self.cap.release()
+    def stop(self):
+        self.stop_record()
+        release_capture(self.source)
     
     def detect_face(self, frame, draw_bounding_box=True):
         """
-        Detect a face from a frame and draw bounding box
+        Detect faces in a frame with the preview detector and draw bounding boxes
+
+        :return: the frame resized for the stream and the (top, right, bottom, left) boxes in it
         """
         frame = imutils.resize(frame, width=400)
-     
-        # grab the frame dimensions and convert it to a blob
-        (h, w) = frame.shape[:2]
-        blob = cv2.dnn.blobFromImage(cv2.resize(frame, (300, 300)), 1.0,
-        (300, 300), (104.0, 177.0, 123.0))
-        
-        # pass the blob through the network and obtain the detections and
-        # predictions
-        self.classifier.setInput(blob)
-        detections = self.classifier.forward()
-        
-        boxes = list()
-        # loop over the detections
-        for i in range(0, detections.shape[2]):
-            # extract the confidence (i.e., probability) associated with the
-            # prediction
-            confidence_val = detections[0, 0, i, 2]
-            
-            # filter out weak detections by ensuring the `confidence` is
-            # greater than the minimum confidence
-            confidence = settings.CONFIDENCE
-            if confidence_val < confidence:
-                continue
-            
-            # compute the (x, y)-coordinates of the bounding box for the
-            # object
-            box = detections[0, 0, i, 3:7] * np.array([w, h, w, h])
-            (startX, startY, endX, endY) = box.astype("int")
-            boxes.append((startX, startY, endX, endY))
-            
-            # draw the bounding box of the face along with the associated
-            # probability
-            text = "{:.2f}%".format(confidence_val * 100)
-            y = startY - 10 if startY - 10 > 10 else startY + 10
-            if draw_bounding_box:
-                cv2.rectangle(frame, (startX, startY), (endX, endY),
-                (0, 0, 255), 2)
-                cv2.putText(frame, text, (startX, y),
-                cv2.FONT_HERSHEY_SIMPLEX, 0.45, (0, 0, 255), 2)
+        boxes = get_detector('preview').detect([frame])[0]
+        if draw_bounding_box:
+            for top, right, bottom, left in boxes:
+                cv2.rectangle(frame, (left, top), (right, bottom), (0, 0, 255), 2)
         return frame, boxes
 
     def get_frame(self, ret_bytes=True, detect_face=True):
@@ -125,8 +347,9 @@ class VideoCamera(object):
         :param detect_face: draw bounding boxes on frame (default: True)
         :type detect_face: bool
         """
-        print(f"Retrieving Frame with ret_bytes={ret_bytes} and detect_face={detect_face}")
-        ret, frame = self.cap.read()
+        latest = self.capture.latest(timeout=settings.CAMERA_READ_TIMEOUT)
+        ret = latest is not None
+        frame = latest.image if ret else None
         if detect_face and ret:
             frame, boxes = self.detect_face(frame)
             ret, jpeg = cv2.imencode('.jpg', frame)
@@ -135,15 +358,16 @@ class VideoCamera(object):
                 return jpeg.tobytes(), boxes
             else:
                 return jpeg, boxes
-        if not detect_face and frame.any():
-            return frame
+        if detect_face:
+            return None, []
+        return frame
 
     def start_record(self):
         """
         Start recording a video
         """
         self.is_record = True
-        self.recordingThread = RecordingThread("Video Recording Thread", self.cap)
+        self.recordingThread = RecordingThread("Video Recording Thread", self.capture)
         self.recordingThread.start()
 
     def stop_record(self):
@@ -154,60 +378,81 @@ class VideoCamera(object):
 
 def start_cam():
     """
-    Get a global camera object thread
+    Get the global camera object, opening the device on first use only
     """
     global video_camera
 
-    try:
-        if video_camera == None:
-            video_camera = VideoCamera()
-    except:
-        video_camera = VideoCamera()
+    with camera_lock:
+        if video_camera is None:
+            video_camera = VideoCamera(source=settings.DEFAULT_FRAME_SOURCE)
     return video_camera
 
 def stop_cam():
     """
-    Stop global camera object thread
+    Release the global camera object and its capture device
     """
     global video_camera
 
-    if video_camera:
-        video_camera.stop_record()
-        del video_camera
-        video_camera = None
+    with camera_lock:
+        if video_camera:
+            video_camera.stop()
+            video_camera = None
 
 
-def video_stream(stop=False):
+def get_frame():
     """
-    Yield each frame to create the effect of a realtime video
+    Retrieve the latest frame from the capture service's ring buffer
     """
-    global global_frame
-
     video_camera = start_cam()
+    return video_camera.get_frame(ret_bytes=False, detect_face=False)
 
-    # if not, send StreamHTTPResponse formated responses (in bytes)
-    print("Retrieving frame from camera as a stream [bytes mode]")
-    while not Capturing.objects.last().stop:
-        frame, _ = video_camera.get_frame()
-        if frame != None:
-            global_frame = frame
-            yield (b'--frame\r\n'
-                    b'Access-Control-Allow-Origin: *\r\n'
-                    b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n\r\n')
-        else:
-            yield (b'--frame\r\n'
-                    b'Access-Control-Allow-Origin: *\r\n'
-                    b'Content-Type: image/jpeg\r\n\r\n' + global_frame + b'\r\n\r\n')
-    stop_cam()
-    return True
+def get_frames(count, max_wait, stop=None, source=None, capture=None, after=0):
+    """
+    Collect up to `count` distinct frames from the capture service's ring buffer,
+    returning early once `max_wait` seconds have passed, see `CaptureService.batch`
 
-def get_frame():
+    :param count: maximum number of frames in the batch
+    :param max_wait: maximum seconds spent waiting for the batch to fill
+    :param stop: optional `threading.Event`, the batch is returned as soon as it is set
+    :param source: name of the frame source (default: settings.DEFAULT_FRAME_SOURCE)
+    :param capture: read from this capture service instead of the source's current one
+    :param after: index of the last frame already consumed
+    :return: list of images, oldest first
     """
-    Retrieve a single frame from the camera
+    capture = capture or get_capture(source)
+    return [frame.image for frame in capture.batch(count, max_wait, after=after, stop=stop)]
+
+def iter_frames(source, limit=None):
     """
-    video_camera = start_cam()
-    frame = video_camera.get_frame(ret_bytes=False, detect_face=False)
-    print("Retrieving frame from camera as a picture [jpeg mode]")
-    stop_cam()
-    return frame
+    Iterate over the frames of a video file or a directory of images
+    without going through the capture service, used for benchmarks
 
+    :param source: video file path or directory of jpeg/png images
+    :param limit: maximum number of frames to read
+    """
+    count = 0
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            if limit and count >= limit:
+                break
+            frame = cv2.imread(os.path.join(source, name))
+            if frame is not None:
+                count += 1
+                yield frame
+        return
+    cap = cv2.VideoCapture(source)
+    try:
+        while not limit or count < limit:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            count += 1
+            yield frame
+    finally:
+        cap.release()
+
+def read_frames(source, limit=None):
+    """
+    Read every frame of a video file or a directory of images, see `iter_frames`
+    """
+    return list(iter_frames(source, limit=limit))
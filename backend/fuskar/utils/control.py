@@ -0,0 +1,150 @@
+"""
+Control channel for stopping loops and notifying running sessions across processes
+
+Flags (e.g. "lecture 3 was stopped") are kept by the backend and mirrored into
+in-process `threading.Event`s so hot loops check them without any I/O.
+Messages are fire-and-forget notifications delivered to subscribers.
+"""
+import json
+import threading
+from collections import defaultdict
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+control_channel = None
+control_channel_lock = threading.Lock()
+
+
+def lecture_stop(lecture_id):
+    return f'lecture-{lecture_id}-stop'
+
+STREAM_STOP = 'stream-stop'
+ROSTER_CHANGED = 'roster-changed'
+
+
+class LocalControlChannel(object):
+    """
+    In-process control channel, a stand-in for redis pub/sub when
+    everything runs in one process (tests, runserver with immediate huey)
+    """
+    def __init__(self, **config):
+        self.lock = threading.Lock()
+        self.events = defaultdict(threading.Event)
+        self.subscribers = defaultdict(list)
+
+    def event(self, name):
+        """
+        `threading.Event` set while the flag name is set
+        """
+        with self.lock:
+            return self.events[name]
+
+    def is_set(self, name):
+        return self.event(name).is_set()
+
+    def signal(self, name):
+        """
+        Set a flag, waking every loop waiting on it
+        """
+        self.receive(name, {"flag": True})
+
+    def clear(self, name):
+        self.receive(name, {"flag": False})
+
+    def publish(self, name, message=None):
+        """
+        Deliver a message to the subscribers of name without setting a flag
+        """
+        self.receive(name, {"message": message})
+
+    def subscribe(self, name, callback):
+        """
+        Call callback(message) for every message published to name
+        """
+        with self.lock:
+            self.subscribers[name].append(callback)
+
+    def unsubscribe(self, name, callback):
+        with self.lock:
+            if callback in self.subscribers[name]:
+                self.subscribers[name].remove(callback)
+
+    def receive(self, name, payload):
+        if "flag" in payload:
+            if payload["flag"]:
+                self.event(name).set()
+            else:
+                self.event(name).clear()
+            return
+        with self.lock:
+            callbacks = list(self.subscribers[name])
+        for callback in callbacks:
+            callback(payload.get("message"))
+
+
+class RedisControlChannel(LocalControlChannel):
+    """
+    Flags are redis keys and notifications go through redis pub/sub,
+    a listener thread mirrors them into the local events and subscribers
+    """
+    prefix = 'fuskar-control:'
+
+    def __init__(self, hosts, flag_expiry=24 * 60 * 60, **config):
+        import redis
+
+        super(RedisControlChannel, self).__init__(**config)
+        host, port = hosts[0]
+        self.redis = redis.Redis(host=host, port=port)
+        self.flag_expiry = flag_expiry
+        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.psubscribe(**{f'{self.prefix}*': self.on_message})
+        self.listener = self.pubsub.run_in_thread(sleep_time=0.01, daemon=True)
+
+    def on_message(self, message):
+        name = message['channel'].decode()[len(self.prefix):]
+        self.receive(name, json.loads(message['data']))
+
+    def event(self, name):
+        with self.lock:
+            known = name in self.events
+            event = self.events[name]
+        if not known and self.redis.exists(self.prefix + name):
+            # the flag was set before this process started listening
+            event.set()
+        return event
+
+    def signal(self, name):
+        self.redis.set(self.prefix + name, 1, ex=self.flag_expiry)
+        self.redis.publish(self.prefix + name, json.dumps({"flag": True}))
+
+    def clear(self, name):
+        self.redis.delete(self.prefix + name)
+        self.redis.publish(self.prefix + name, json.dumps({"flag": False}))
+        # clear locally right away so a loop started next does not see the stale flag
+        super(RedisControlChannel, self).clear(name)
+
+    def publish(self, name, message=None):
+        self.redis.publish(self.prefix + name, json.dumps({"message": message}))
+
+
+def get_control_channel():
+    """
+    The process wide control channel configured by settings.CONTROL_CHANNEL
+    """
+    global control_channel
+
+    with control_channel_lock:
+        if control_channel is None:
+            backend = import_string(settings.CONTROL_CHANNEL["BACKEND"])
+            control_channel = backend(**settings.CONTROL_CHANNEL.get("CONFIG", {}))
+    return control_channel
+
+
+@receiver(setting_changed)
+def reset_control_channel(setting, **kwargs):
+    global control_channel
+
+    if setting == 'CONTROL_CHANNEL':
+        control_channel = None
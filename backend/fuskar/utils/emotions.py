@@ -0,0 +1,82 @@
+"""
+Time-bucketed emotion counts accumulated in memory and flushed in bulk
+"""
+import time
+import datetime
+from collections import Counter
+import django.dispatch
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from fuskar.models import EmotionBucket, Lecture
+
+# sent after every flush with the lecture and the emotion counts that were written
+emotions_flushed = django.dispatch.Signal(providing_args=["instance", "counts"])
+
+
+class EmotionAggregator(object):
+    """
+    Counts emotions per EMOTION_BUCKET_SECONDS bucket of a lecture
+    and writes them at most once every EMOTION_FLUSH_INTERVAL seconds
+    """
+    def __init__(self, lecture, bucket_seconds=None, flush_interval=None):
+        self.lecture = lecture
+        self.bucket_seconds = bucket_seconds or settings.EMOTION_BUCKET_SECONDS
+        self.flush_interval = settings.EMOTION_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self.pending = Counter()
+        self.last_flush = time.time()
+
+    def bucket(self, timestamp):
+        start = int(timestamp // self.bucket_seconds) * self.bucket_seconds
+        return datetime.datetime.fromtimestamp(start, tz=timezone.utc)
+
+    def add(self, emotions, timestamp=None):
+        """
+        Count detected emotions in the bucket of timestamp (default: now)
+        """
+        bucket = self.bucket(time.time() if timestamp is None else timestamp)
+        for emotion in emotions:
+            self.pending[(bucket, emotion)] += 1
+
+    def flush(self, force=False):
+        """
+        Write pending counts, creating missing buckets in one bulk insert
+        and incrementing existing ones in place
+
+        Counts are checked against the lecture row in the same transaction as the writes
+        rather than a copy loaded earlier: those of a locked lecture that is not running are
+        dropped, and once the lecture stopped only the buckets that started before it stopped
+        are written, so the forced flush of a stopping pipeline keeps its last interval
+        """
+        if not self.pending or (not force and time.time() - self.last_flush < self.flush_interval):
+            return
+        pending, self.pending = self.pending, Counter()
+        self.last_flush = time.time()
+        with transaction.atomic():
+            # the row stays locked until the writes commit, so the lecture cannot end in between
+            lecture = Lecture.objects.select_for_update().filter(id=self.lecture.id).values('lock', 'stopped_at').first()
+            if lecture is None or (lecture['lock'] and lecture['stopped_at'] is None):
+                return
+            if lecture['stopped_at'] is not None:
+                pending = Counter({
+                    (started_at, emotion): count for (started_at, emotion), count in pending.items()
+                    if started_at < lecture['stopped_at']})
+                if not pending:
+                    return
+            existing = dict(
+                ((bucket.started_at, bucket.emotion), bucket.id)
+                for bucket in EmotionBucket.objects.filter(
+                    lecture=self.lecture, started_at__in=set(started_at for started_at, _ in pending))
+            )
+            EmotionBucket.objects.bulk_create([
+                EmotionBucket(lecture=self.lecture, started_at=started_at, emotion=emotion, count=count)
+                for (started_at, emotion), count in pending.items() if (started_at, emotion) not in existing
+            ])
+            for key, bucket_id in existing.items():
+                if key in pending:
+                    EmotionBucket.objects.filter(id=bucket_id).update(count=F('count') + pending[key])
+        counts = Counter()
+        for (_, emotion), count in pending.items():
+            counts[emotion] += count
+        emotions_flushed.send(sender=EmotionAggregator, instance=self.lecture, counts=dict(counts))
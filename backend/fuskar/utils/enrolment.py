@@ -0,0 +1,219 @@
+"""
+Bulk enrolment of student photos
+"""
+import io
+import os
+import hashlib
+import logging
+import zipfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import face_recognition
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import IntegrityError, transaction
+from fuskar.models import Image, Student
+from fuskar.utils.phash import BKTree, phash, find_near_duplicates, update_index
+from fuskar.artificial.inference import get_inference
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+enrolment_pool = None
+enrolment_pool_lock = threading.Lock()
+
+
+def get_enrolment_pool():
+    """
+    Threads validating bulk enrolment photos, shared by every request of the process
+
+    Threads rather than processes, the web process holds threads and sockets that must
+    not be forked, and the models are in the inference workers: every thread keeps its
+    own connection to one of them so the photos of a batch are detected in parallel.
+    """
+    global enrolment_pool
+
+    with enrolment_pool_lock:
+        if enrolment_pool is None:
+            enrolment_pool = ThreadPoolExecutor(
+                max_workers=settings.ENROLMENT_WORKERS, thread_name_prefix="enrolment")
+    return enrolment_pool
+
+
+def inspect_faces(data):
+    """
+    Face locations the enrolment detector finds in encoded image bytes and the encoding
+    of the face when there is exactly one, runs inside the enrolment thread pool
+
+    :return: (locations, encoding or None), locations is None if the bytes are not an image
+    """
+    try:
+        # uploads load as rgb, the inference models take bgr frames like the camera's
+        face = face_recognition.load_image_file(io.BytesIO(data))[:, :, ::-1]
+    except Exception:
+        return None, None
+    inference = get_inference()
+    locations = inference.detect([face], 'enrolment')[0]
+    if len(locations) != 1:
+        return locations, None
+    return locations, inference.encode(face, locations)[0]
+
+
+def entries_from_archive(archive):
+    """
+    Read (owner id, file name, bytes) entries from a zip laid out as <student id>/<photo>
+    """
+    entries = list()
+    with zipfile.ZipFile(archive) as zipped:
+        for info in zipped.infolist():
+            if info.is_dir() or not info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            parts = info.filename.strip('/').split('/')
+            owner = parts[-2] if len(parts) > 1 else None
+            entries.append((owner, parts[-1], zipped.read(info)))
+    return entries
+
+
+def entries_from_files(files, owners):
+    """
+    Read (owner id, file name, bytes) entries from uploaded files,
+    owners holds either a single student id or one per file
+    """
+    if len(owners) == 1:
+        owners = owners * len(files)
+    entries = list()
+    for index, upload in enumerate(files):
+        owner = owners[index] if index < len(owners) else None
+        entries.append((owner, os.path.basename(upload.name), upload.read()))
+    return entries
+
+
+def delete_stored_file(image):
+    """
+    Remove the file an Image wrote to storage when its row could not be inserted
+    """
+    if image.file and image.file.name and image.file.storage.exists(image.file.name):
+        image.file.storage.delete(image.file.name)
+
+
+def insert_images(build, count):
+    """
+    Insert images in a single bulk_create, one row at a time if the batch conflicts
+
+    Files are written to storage while inserting, the files of rows that end up
+    not being inserted are deleted again. Backends that do not return primary keys
+    from bulk inserts (SQLite) get them fetched again by hash.
+
+    :param build: callable returning a new unsaved Image for an index below count,
+        every call gets its own file content so a row can be saved again
+    :return: list of the inserted Image or None per index
+    """
+    images = [build(index) for index in range(count)]
+    try:
+        with transaction.atomic():
+            Image.objects.bulk_create(images)
+    except IntegrityError:
+        # a concurrent upload inserted one of these hashes, only the conflicting rows are rejected
+        logger.info("Bulk insert of %d image(s) conflicted, inserting them one by one", count)
+        for image in images:
+            delete_stored_file(image)
+    else:
+        missing = [image for image in images if image.pk is None]
+        if missing:
+            ids = dict(Image.objects.filter(hashval__in=[image.hashval for image in missing]).values_list('hashval', 'id'))
+            for image in missing:
+                image.pk = ids[image.hashval]
+        return images
+
+    inserted = list()
+    for index in range(count):
+        image = build(index)
+        try:
+            with transaction.atomic():
+                image.save()
+        except IntegrityError:
+            delete_stored_file(image)
+            image = None
+        inserted.append(image)
+    return inserted
+
+
+def bulk_enrol(entries):
+    """
+    Validate, dedupe and create Image rows for a batch of photos
+
+    Photos are hashed and deduplicated first, exact copies by MD5 and re-encoded or
+    resized copies by perceptual hash, the remaining ones are checked for
+    exactly one face on the inference workers, see `get_enrolment_pool`, and all accepted photos are inserted
+    with their face location and encoding in a single bulk_create, see `insert_images`.
+
+    :param entries: list of (owner id, file name, bytes)
+    :return: (created images, per file report)
+    """
+    report = [{"file": name, "owner": owner, "status": "rejected", "detail": None} for owner, name, _ in entries]
+    owner_ids = set()
+    for owner, _, _ in entries:
+        if str(owner).isdigit():
+            owner_ids.add(int(owner))
+    students = Student.objects.in_bulk(list(owner_ids))
+
+    hashes = [hashlib.md5(data).hexdigest() for _, _, data in entries]
+    existing = set(Image.objects.filter(hashval__in=hashes).values_list('hashval', flat=True))
+    seen = set()
+    # near duplicates within the batch are caught by a batch local tree
+    batch_tree = BKTree()
+    perceptual_hashes = dict()
+    candidates = list()
+    for index, (owner, _, data) in enumerate(entries):
+        if not str(owner).isdigit() or int(owner) not in students:
+            report[index]["detail"] = "Unknown student"
+            continue
+        if hashes[index] in existing or hashes[index] in seen:
+            report[index]["detail"] = "Image is an exact duplicate of an existing image"
+            continue
+        seen.add(hashes[index])
+        try:
+            perceptual_hash = phash(io.BytesIO(data))
+        except Exception:
+            report[index]["detail"] = "File is not a readable image"
+            continue
+        near_duplicates = find_near_duplicates(perceptual_hash)
+        batch_duplicates = batch_tree.search(perceptual_hash, settings.PHASH_MAX_DISTANCE)
+        if near_duplicates or batch_duplicates:
+            report[index]["detail"] = "Image is a near duplicate of an existing image"
+            continue
+        batch_tree.add(perceptual_hash, index)
+        perceptual_hashes[index] = perceptual_hash
+        candidates.append(index)
+
+    faces = list(get_enrolment_pool().map(inspect_faces, [entries[index][2] for index in candidates]))
+
+    accepted = list()
+    for index, (locations, encoding) in zip(candidates, faces):
+        if encoding is None:
+            report[index]["detail"] = "Image contains no recognizable face or multiple faces"
+            continue
+        accepted.append((index, locations[0], encoding))
+
+    def build(position):
+        index, location, encoding = accepted[position]
+        owner, name, data = entries[index]
+        return Image(
+            owner=students[int(owner)],
+            file=ContentFile(data, name=name),
+            hashval=hashes[index],
+            phash=format(perceptual_hashes[index], '016x'),
+            **Image.face_fields(location, encoding)
+        )
+
+    images = list()
+    for (index, _, _), image in zip(accepted, insert_images(build, len(accepted))):
+        if image is None:
+            report[index]["detail"] = "Image is an exact duplicate of an existing image"
+            continue
+        report[index].update({"status": "created", "id": image.id, "owner": image.owner_id})
+        images.append(image)
+    if images:
+        update_index(added=[(int(image.phash, 16), image.id) for image in images])
+    return images, report
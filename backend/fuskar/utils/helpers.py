@@ -69,12 +69,15 @@ def get_encodings(encoding_list):
     encoding = [i[0] for i in encoding_list]
     return encoding
 
-def get_hash(image):
+def get_hash(image, chunk_size=64 * 1024):
     """
-    Generate image hash for a value
+    Generate image hash for a value, reading the file in chunks
     """
     import hashlib
-    
-    hashobj = hashlib.md5(image.read()).hexdigest()
-    print(hashobj)
-    return hashobj
+
+    hashobj = hashlib.md5()
+    image.seek(0)
+    for chunk in iter(lambda: image.read(chunk_size), b''):
+        hashobj.update(chunk)
+    image.seek(0)
+    return hashobj.hexdigest()
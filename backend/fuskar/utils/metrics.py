@@ -0,0 +1,145 @@
+"""
+Prometheus metrics of the capture, recognition and broadcast stages
+
+Every process records into the prometheus_client default registry. With
+METRICS_MULTIPROC_DIR set, the values are kept in memory-mapped files shared
+by the web, huey, inference and attendance worker processes, and `render()`
+aggregates all of them, so /metrics works without an external collector.
+Files of processes that exited are dropped by `clear_dead_processes()` when a
+service starts and `mark_process_dead()` when a worker process exits.
+"""
+import os
+import time
+from contextlib import contextmanager
+from django.conf import settings
+
+# must be set before prometheus_client is imported anywhere in the process
+if settings.METRICS_MULTIPROC_DIR:
+    os.makedirs(settings.METRICS_MULTIPROC_DIR, exist_ok=True)
+    os.environ.setdefault('prometheus_multiproc_dir', settings.METRICS_MULTIPROC_DIR)
+
+from prometheus_client import (
+    Counter, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess)
+from prometheus_client.core import GaugeMetricFamily
+
+# from a cheap motion check to a full CNN pass over a batch
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+STAGE_SECONDS = Histogram(
+    'fuskar_stage_seconds', "Duration of pipeline stages",
+    ['stage'], buckets=LATENCY_BUCKETS)
+FRAMES = Counter(
+    'fuskar_frames_total', "Frames read by lecture pipelines, by motion gate decision",
+    ['result'])
+FACES = Counter(
+    'fuskar_faces_total', "Faces detected by lecture pipelines")
+RECOGNITIONS = Counter(
+    'fuskar_recognitions_total', "Faces resolved by lecture pipelines: encoded and known, encoded and unknown, or carried by a track",
+    ['result'])
+STUDENTS_MARKED = Counter(
+    'fuskar_students_marked_total', "Students marked present in lectures")
+CAPTURED_FRAMES = Counter(
+    'fuskar_captured_frames_total', "Frames read from capture devices")
+MODEL_CACHE = Counter(
+    'fuskar_model_cache_requests_total', "Classifier artifact lookups",
+    ['result'])
+WEBSOCKET_MESSAGES = Counter(
+    'fuskar_websocket_messages_total', "Lecture messages sent to websocket groups",
+    ['type'])
+WEBSOCKET_BYTES = Counter(
+    'fuskar_websocket_bytes_total', "Payload bytes of lecture messages sent to websocket groups")
+
+
+@contextmanager
+def timed(stage):
+    """
+    Record the duration of the block in fuskar_stage_seconds
+    """
+    started = time.time()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.time() - started)
+
+
+class RetrainCollector(object):
+    """
+    Coalesced retrain statistics, read at scrape time from the huey storage they are kept in
+    """
+    def describe(self):
+        return list()
+
+    def collect(self):
+        from fuskar.tasks import retrain_stats
+
+        metric = GaugeMetricFamily('fuskar_retrain', "Coalesced retrain requests and executions", labels=['kind'])
+        for kind, value in retrain_stats().items():
+            if isinstance(value, (int, float)):
+                metric.add_metric([kind], value)
+        yield metric
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def clear_dead_processes():
+    """
+    Remove the metric files of processes that are no longer running, left behind by
+    earlier runs of the services or by killed workers, called when a service starts
+
+    Files of running processes are kept, the services share the directory and restart independently.
+
+    :return: number of files removed
+    """
+    directory = settings.METRICS_MULTIPROC_DIR
+    if not directory or not os.path.isdir(directory):
+        return 0
+    removed = 0
+    for name in os.listdir(directory):
+        if not name.endswith('.db'):
+            continue
+        # <type>_<pid>.db or gauge_<mode>_<pid>.db
+        try:
+            pid = int(name[:-len('.db')].rsplit('_', 1)[1])
+        except (IndexError, ValueError):
+            continue
+        if pid_alive(pid):
+            continue
+        try:
+            os.remove(os.path.join(directory, name))
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def mark_process_dead(pid=None):
+    """
+    Drop the live gauge files of an exited process (default: this one) from the aggregation
+    """
+    if settings.METRICS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid or os.getpid())
+
+
+retrain_collector = RetrainCollector()
+if not settings.METRICS_MULTIPROC_DIR:
+    REGISTRY.register(retrain_collector)
+
+
+def render():
+    """
+    (body, content type) of the metrics of every process in the prometheus text format
+    """
+    registry = REGISTRY
+    if settings.METRICS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(retrain_collector)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,88 @@
+"""
+Cheap change detection in front of face detection
+"""
+import time
+import cv2
+import numpy as np
+from django.conf import settings
+
+
+class MotionGate(object):
+    """
+    Lets a frame through to detection and recognition only when a region of it
+    changed enough since the last frame let through, or when MOTION_KEEP_ALIVE
+    seconds have passed
+
+    Frames are compared downscaled to MOTION_WIDTH pixels, grayscale and blurred,
+    split into a MOTION_GRID x MOTION_GRID grid so a single student moving in a
+    corner of the hall is not averaged away by the static rest of the frame.
+    """
+    def __init__(self, threshold=None, keep_alive=None, width=None, grid=None, pixel_threshold=None):
+        """
+        :param threshold: share of changed pixels in a cell that opens the gate (default: settings.MOTION_THRESHOLD)
+        :param keep_alive: seconds after which the gate opens regardless, 0 keeps it always open (default: settings.MOTION_KEEP_ALIVE)
+        :param width: width frames are downscaled to (default: settings.MOTION_WIDTH)
+        :param grid: cells per side (default: settings.MOTION_GRID)
+        :param pixel_threshold: intensity difference counted as a change (default: settings.MOTION_PIXEL_THRESHOLD)
+        """
+        self.threshold = settings.MOTION_THRESHOLD if threshold is None else threshold
+        self.keep_alive = settings.MOTION_KEEP_ALIVE if keep_alive is None else keep_alive
+        self.width = width or settings.MOTION_WIDTH
+        self.grid = grid or settings.MOTION_GRID
+        self.pixel_threshold = settings.MOTION_PIXEL_THRESHOLD if pixel_threshold is None else pixel_threshold
+        self.reference = None
+        self.opened_at = 0
+        self.processed = 0
+        self.skipped = 0
+        self.seconds = 0
+
+    def prepare(self, frame):
+        gray = frame
+        if len(frame.shape) > 2:
+            gray = cv2.cvtColor(frame, code=cv2.COLOR_BGR2GRAY)
+        height, width = gray.shape[:2]
+        # a multiple of the grid on both sides so the cells reshape evenly
+        small_width = max(self.width - self.width % self.grid, self.grid)
+        small_height = max(int(height * small_width / width) // self.grid * self.grid, self.grid)
+        small = cv2.resize(gray, (small_width, small_height), interpolation=cv2.INTER_AREA)
+        return cv2.GaussianBlur(small, (5, 5), 0)
+
+    def change(self, small):
+        """
+        Largest share of changed pixels in any cell compared to the reference frame
+        """
+        changed = cv2.absdiff(small, self.reference) > self.pixel_threshold
+        height, width = changed.shape
+        cells = changed.reshape(self.grid, height // self.grid, self.grid, width // self.grid)
+        return cells.mean(axis=(1, 3)).max()
+
+    def check(self, frame, now=None):
+        """
+        Whether the frame should go through detection and recognition
+        """
+        if not self.keep_alive:
+            self.processed += 1
+            return True
+        started = time.time()
+        now = now or started
+        small = self.prepare(frame)
+        opened = (self.reference is None
+                  or now - self.opened_at >= self.keep_alive
+                  or self.change(small) >= self.threshold)
+        if opened:
+            self.reference = small
+            self.opened_at = now
+            self.processed += 1
+        else:
+            self.skipped += 1
+        self.seconds += time.time() - started
+        return opened
+
+    def stats(self):
+        total = self.processed + self.skipped
+        return {
+            "processed": self.processed,
+            "skipped": self.skipped,
+            "skip_ratio": round(self.skipped / total, 3) if total else 0,
+            "ms_per_frame": round(1000 * self.seconds / total, 2) if total else 0,
+        }
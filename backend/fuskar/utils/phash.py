@@ -0,0 +1,204 @@
+"""
+Perceptual hashing and a BK-tree index for rejecting near-duplicate uploads
+"""
+import os
+import fcntl
+import logging
+import threading
+from contextlib import contextmanager
+import numpy as np
+from PIL import Image as Im
+from django.conf import settings
+from fuskar.artificial.cache import model_cache, publish_pickle, load_pickle
+
+logger = logging.getLogger(__name__)
+
+HASH_SIZE = 8
+DCT_SIZE = HASH_SIZE * 4
+
+
+def dct_matrix(size):
+    """
+    Orthonormal DCT-II basis, dct(x) == matrix @ x
+    """
+    n = np.arange(size)
+    matrix = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size)) * np.sqrt(2.0 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+DCT = dct_matrix(DCT_SIZE)
+
+
+def phash(image):
+    """
+    64 bit perceptual hash of an image file or file-like object
+
+    The image is shrunk to 32x32 grayscale, the low frequency 8x8 corner of its
+    DCT is compared against its median and the resulting bits are packed into an int.
+    """
+    with Im.open(image) as picture:
+        # let the JPEG decoder downscale while decoding, much cheaper than a full decode
+        picture.draft('L', (DCT_SIZE * 2, DCT_SIZE * 2))
+        pixels = np.asarray(picture.convert('L').resize((DCT_SIZE, DCT_SIZE), Im.ANTIALIAS), dtype=np.float64)
+    if hasattr(image, 'seek'):
+        image.seek(0)
+    low = (DCT @ pixels @ DCT.T)[:HASH_SIZE, :HASH_SIZE]
+    bits = (low > np.median(low)).flatten()
+    return int(''.join('1' if bit else '0' for bit in bits), 2)
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class BKTree(object):
+    """
+    Burkhard-Keller tree over perceptual hashes with the hamming distance
+
+    Every node is [hash, {distance: child node}], the items (image ids) of a hash are
+    kept beside the tree so removing an image never restructures it.
+    """
+    def __init__(self):
+        self.root = None
+        self.items = dict()
+
+    def __len__(self):
+        return sum(len(items) for items in self.items.values())
+
+    def add(self, value, item):
+        self.items.setdefault(value, set()).add(item)
+        if self.root is None:
+            self.root = [value, dict()]
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = [value, dict()]
+                return
+            node = child
+
+    def remove(self, value, item):
+        items = self.items.get(value)
+        if items:
+            items.discard(item)
+
+    def search(self, value, max_distance):
+        """
+        Items whose hash is within max_distance of value
+
+        :return: list of (distance, item) sorted by distance
+        """
+        found = list()
+        if self.root is None:
+            return found
+        stack = [self.root]
+        while stack:
+            node_value, children = stack.pop()
+            distance = hamming(value, node_value)
+            if distance <= max_distance:
+                found.extend((distance, item) for item in self.items.get(node_value, ()))
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return sorted(found, key=lambda match: match[0])
+
+
+index_lock = threading.Lock()
+
+@contextmanager
+def locked_index():
+    """
+    Exclusive access to the persisted index across threads and processes
+    """
+    directory = os.path.dirname(settings.PHASH_INDEX)
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    with index_lock, open(settings.PHASH_INDEX + '.lock', 'a') as stream:
+        fcntl.flock(stream, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(stream, fcntl.LOCK_UN)
+
+def backfill_hashes(images):
+    """
+    Compute and store the perceptual hash of images uploaded without one,
+    written with a queryset update so no retrain is triggered
+
+    :param images: Image queryset, rows that already have a hash are skipped
+    :return: list of (hash, image id) that were stored
+    """
+    hashed = list()
+    for image in images.filter(phash=None).only('id', 'file'):
+        try:
+            with image.file.open('rb') as stream:
+                value = phash(stream)
+        except Exception:
+            logger.warning("Cannot compute the perceptual hash of image %s at %s", image.id, image.file.name)
+            continue
+        images.model.objects.filter(id=image.id).update(phash=format(value, '016x'))
+        hashed.append((value, image.id))
+    if hashed:
+        logger.info("Stored the perceptual hash of %d image(s) uploaded without one", len(hashed))
+    return hashed
+
+def build_index():
+    """
+    Build the index from the perceptual hashes stored on Image rows,
+    hashing the images that have none first
+    """
+    from fuskar.models import Image
+
+    backfill_hashes(Image.objects.all())
+    tree = BKTree()
+    for image_id, value in Image.objects.exclude(phash=None).values_list('id', 'phash'):
+        tree.add(int(value, 16), image_id)
+    return tree
+
+def load_index():
+    """
+    A private copy of the latest persisted index, built from the database
+    and persisted if it is missing, must be called holding `locked_index`
+    """
+    if os.path.exists(settings.PHASH_INDEX):
+        return load_pickle(settings.PHASH_INDEX)
+    tree = build_index()
+    publish_pickle(tree, settings.PHASH_INDEX)
+    return tree
+
+def get_index():
+    """
+    The persisted perceptual hash index shared by this process, never modified in place
+    """
+    try:
+        return model_cache.get(settings.PHASH_INDEX)
+    except FileNotFoundError:
+        with locked_index():
+            load_index()
+        return model_cache.get(settings.PHASH_INDEX)
+
+def find_near_duplicates(value):
+    """
+    Ids of enrolled images within PHASH_MAX_DISTANCE of a hash
+    """
+    return [item for _, item in get_index().search(value, settings.PHASH_MAX_DISTANCE)]
+
+def update_index(added=(), removed=()):
+    """
+    Add and remove (hash, image id) pairs and persist the index
+
+    The change is applied to a copy of the latest persisted version, read under a lock
+    shared with the other processes, so trees cached for searching are never modified
+    and concurrent updates never overwrite each other
+    """
+    with locked_index():
+        tree = load_index()
+        for value, item in added:
+            tree.add(value, item)
+        for value, item in removed:
+            tree.remove(value, item)
+        publish_pickle(tree, settings.PHASH_INDEX)
@@ -0,0 +1,234 @@
+"""
+Attendance and emotion pipeline of a single lecture
+"""
+import time
+import logging
+from collections import defaultdict
+from contextlib import contextmanager
+from django.conf import settings
+from django.utils import timezone
+from fuskar.models import Lecture
+from fuskar.artificial import classifiers as cf
+from fuskar.artificial.cache import model_cache
+from fuskar.artificial.inference import get_inference
+from fuskar.utils.camera import get_capture
+from fuskar.utils.attendance import AttendanceSession
+from fuskar.utils.motion import MotionGate
+from fuskar.utils.tracking import FaceTracker
+from fuskar.utils.control import get_control_channel, lecture_stop
+from fuskar.utils.broadcast import broadcaster
+from fuskar.utils.metrics import STAGE_SECONDS, FRAMES, FACES, RECOGNITIONS
+
+logger = logging.getLogger(__name__)
+
+
+class AttendancePipeline(object):
+    """
+    Takes attendance and emotions of a lecture from its frame source,
+    a bounded number of frames at a time so lectures can take turns on a process
+    """
+    def __init__(self, lecture_id, source=None, record_timings=False, prediction_mode=None):
+        """
+        :param source: key of settings.FRAME_SOURCES (default: the lecture's source)
+        :param prediction_mode: classify with this mode instead of the one the classifiers were trained for
+        :param record_timings: keep the duration of every stage in self.timings
+        """
+        self.lecture_instance = Lecture.objects.select_related('course').get(id=lecture_id)
+        self.source = source or self.lecture_instance.source or settings.DEFAULT_FRAME_SOURCE
+        # models stay loaded in the inference worker (or once per process) between lectures
+        self.inference = get_inference()
+        self.emoclassifier = cf.EmotionClassifier(
+                    lecture_instance=self.lecture_instance,
+                    target_emotions=settings.TARGET_EMOTIONS,
+                    inference=self.inference
+                    )
+        self.direct_euclid_classifier = cf.DirectEuclid(
+                    pickle_path=settings.ENCODING_LIST,
+                    confidence_threshold=settings.CONFIDENCE
+                    )
+        self.knn_classifier = cf.KNN(
+                    pickle_path=settings.KNN_EMBEDDING_MAP,
+                    confidence_threshold=settings.CONFIDENCE
+                    )
+        self.svm_classifier = cf.SVM(
+                    pickle_path=settings.SVM_EMBEDDING_MAP,
+                    confidence_threshold=settings.CONFIDENCE
+        )
+        self.ann_classifier = cf.ANN(
+                    pickle_path=settings.ANN_INDEX,
+                    confidence_threshold=settings.CONFIDENCE,
+                    nprobe=settings.ANN_NPROBE
+                    )
+        self.prediction_mode = prediction_mode
+        self.session = AttendanceSession(lecture_id)
+        # opened by the first turn and kept for the whole lecture,
+        # a source that died is not silently reopened mid lecture
+        self.capture = None
+        # index of the last frame taken from the capture, the next batch starts after it
+        self.last_index = 0
+        # set by LectureViewSet.end through the control channel, checked without touching the database
+        self.stop = get_control_channel().event(lecture_stop(lecture_id))
+        if self.lecture_instance.stopped_at:
+            self.stop.set()
+        # skips detection while the hall is static
+        self.motion_gate = MotionGate()
+        # carries recognised identities across frames
+        self.tracker = FaceTracker()
+        self.frame_index = 0
+        self.started_at = time.time()
+        # stage name -> durations in seconds, used by replay_attendance
+        self.timings = defaultdict(list) if record_timings else None
+
+    def __str__(self):
+        return f"{self.lecture_instance.course.name}-{self.lecture_instance.id}"
+
+    @property
+    def stopped(self):
+        return self.stop.is_set()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a stage of the pipeline into fuskar_stage_seconds
+        """
+        started = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - started
+            STAGE_SECONDS.labels(name).observe(duration)
+            if self.timings is not None:
+                self.timings[name].append(duration)
+
+    def classify(self, embedding_list, boxes):
+        """
+        Id (or "unknown") of every face encoding
+        """
+        # prediction output is a list of id
+        recognized = None
+        # read on every call, retraining in the huey process may switch it
+        mode = self.prediction_mode or cf.trained_prediction_mode()
+        if mode == "svm":
+            # Prediction using svm
+            recognized = self.svm_classifier.predict(face_encodings=embedding_list)
+        elif mode == "knn":
+            # Prediction using knn
+            recognized = self.knn_classifier.predict(
+                            face_encodings=embedding_list,
+                            face_locations=boxes
+                            )
+        elif mode == "direct-euclid":
+            # Predict using direct euclid comparison
+            recognized = self.direct_euclid_classifier.predict(face_encodings=embedding_list)
+        elif mode == "ann":
+            # Predict using the approximate nearest neighbour index
+            recognized = self.ann_classifier.predict(face_encodings=embedding_list)
+        return recognized or ["unknown"] * len(boxes)
+
+    def recognize(self, frame, boxes):
+        """
+        Ids of the students whose faces are at boxes, only faces of new or
+        unresolved tracks and tracks due for re-verification are encoded
+        """
+        now = time.time()
+        tracks = self.tracker.update(boxes)
+        pending = [index for index, track in enumerate(tracks) if self.tracker.needs_recognition(track, now)]
+        self.tracker.encoded += len(pending)
+        self.tracker.reused += len(tracks) - len(pending)
+        RECOGNITIONS.labels('tracked').inc(len(tracks) - len(pending))
+        if pending:
+            pending_boxes = [boxes[index] for index in pending]
+            # Get the embeddings of the faces that need recognition
+            with self.stage('encoding'):
+                embedding_list = [x for x in self.inference.encode(frame, pending_boxes)]
+            with self.stage('classification'):
+                recognized = self.classify(embedding_list, pending_boxes)
+            for index, identity in zip(pending, recognized):
+                self.tracker.resolve(tracks[index], identity, now)
+                RECOGNITIONS.labels('unknown' if identity == "unknown" else 'known').inc()
+        # unknown faces stay unresolved and are never marked
+        return set(track.identity for track in tracks if track.identity is not None)
+
+    def process(self, budget):
+        """
+        Process at most `budget` frames of the lecture's frame source
+
+        Frames the motion gate skips count towards the budget but cost no detection pass
+
+        :return: number of frames consumed, fewer than budget once the lecture
+            stopped or the source stopped delivering frames
+        """
+        if self.capture is None:
+            self.capture = get_capture(self.source)
+        processed = 0
+        while processed < budget and not self.stopped:
+            # collect a batch of frames from the capture service
+            with self.stage('capture'):
+                frames = self.capture.batch(
+                    min(settings.ATTENDANCE_BATCH_SIZE, budget - processed),
+                    settings.ATTENDANCE_BATCH_MAX_WAIT,
+                    after=self.last_index,
+                    stop=self.stop)
+            if not frames or self.stopped:
+                break
+            self.last_index = frames[-1].index
+            processed = processed + len(frames)
+            self.process_frames([frame.image for frame in frames])
+        return processed
+
+    def process_frames(self, frames):
+        """
+        Run a batch of frames through motion gating, detection, emotions,
+        recognition and the database writes
+        """
+        loop_processing_time_start = time.time()
+        self.frame_index = self.frame_index + len(frames)
+        read = len(frames)
+        with self.stage('motion'):
+            frames = [frame for frame in frames if self.motion_gate.check(frame)]
+        FRAMES.labels('processed').inc(len(frames))
+        FRAMES.labels('skipped').inc(read - len(frames))
+        if frames:
+            # detect faces across the whole batch in a single CNN pass
+            with self.stage('detection'):
+                batch_boxes = self.inference.detect(frames)
+
+            for frame, boxes in zip(frames, batch_boxes):
+                if self.stopped:
+                    break
+                FACES.inc(len(boxes))
+                logger.debug("Lecture %s: %d face(s) detected", self, len(boxes))
+
+                # Predict emotions of every face crop in one model pass
+                with self.stage('emotions'):
+                    self.emoclassifier.predict_emotions_batch(frame=frame, boxes=boxes, threshold=settings.ADJACENT_THRESHOLD)
+
+                _id = self.recognize(frame, boxes)
+                self.session.mark(_id)
+                logger.debug("Lecture %s: id's discovered in this frame %s", self, _id)
+        with self.stage('flush'):
+            self.session.flush()
+            self.emoclassifier.flush()
+        logger.debug("Lecture %s: batch of %d frame(s) processed in %.3f seconds, motion gate %s, tracker %s",
+                     self, read, time.time() - loop_processing_time_start, self.motion_gate.stats(), self.tracker.stats())
+
+    def fail(self, reason):
+        """
+        End the lecture because its frames can no longer be processed
+        """
+        logger.error("Lecture %s ended with an error: %s", self, reason)
+        self.lecture_instance.lock = True
+        self.lecture_instance.stopped_at = timezone.now()
+        self.lecture_instance.save(update_fields=['lock', 'stopped_at'])
+        self.stop.set()
+
+    def close(self):
+        """
+        Write everything still pending and stop listening for roster changes
+        """
+        with self.stage('flush'):
+            self.session.close()
+            self.emoclassifier.flush(force=True)
+        logger.info("Lecture %s was stopped after %.1f seconds, %d frame(s) read, motion gate %s, tracker %s",
+                    self, time.time() - self.started_at, self.frame_index, self.motion_gate.stats(), self.tracker.stats())
+        logger.info("Classifier cache %s, websocket broadcast %s", model_cache.stats(), broadcaster.stats())
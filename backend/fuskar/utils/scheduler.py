@@ -0,0 +1,188 @@
+"""
+Runs lecture pipelines concurrently across a pool of worker processes
+
+Every lecture is pinned to one worker process which keeps its pipeline
+(classifiers, roster, capture service) between turns. A turn processes at
+most settings.ATTENDANCE_FRAME_BUDGET frames and is then queued behind the
+other lectures of the same worker, so lectures sharing a worker take turns
+while new lectures go to the least loaded worker.
+"""
+import os
+import logging
+import threading
+import multiprocessing
+from multiprocessing.util import Finalize
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+scheduler = None
+scheduler_lock = threading.Lock()
+# lecture id -> AttendancePipeline of the lectures pinned to this worker process
+pipelines = dict()
+
+
+def init_worker():
+    """
+    Set up django in a freshly spawned worker process
+    """
+    import django
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")
+    django.setup()
+
+    from fuskar.utils.metrics import mark_process_dead
+
+    # run by multiprocessing when the worker exits, atexit handlers are not
+    Finalize(None, mark_process_dead, args=(os.getpid(),), exitpriority=0)
+
+
+def close_pipeline(lecture_id):
+    """
+    Close a lecture's pipeline and release its frame source once no other
+    lecture pinned to this worker reads it, the device is free for the preview
+    and the other workers until the next lecture in this hall
+    """
+    from fuskar.utils.camera import release_capture
+
+    pipeline = pipelines.pop(lecture_id)
+    try:
+        pipeline.close()
+    finally:
+        if not any(other.source == pipeline.source for other in pipelines.values()):
+            release_capture(pipeline.source)
+
+
+def run_turn(lecture_id, source, budget):
+    """
+    Advance a lecture's pipeline by at most `budget` frames, runs inside a worker process
+
+    :return: True while the lecture is still running
+    """
+    from fuskar.utils.pipeline import AttendancePipeline
+
+    pipeline = pipelines.get(lecture_id)
+    if pipeline is None:
+        pipeline = pipelines[lecture_id] = AttendancePipeline(lecture_id, source)
+    try:
+        processed = pipeline.process(budget)
+        if not processed and not pipeline.stopped and not pipeline.capture.running:
+            # an exhausted file or a failed device would otherwise be rescheduled forever
+            pipeline.fail(f"frame source {source} stopped delivering frames")
+    except Exception:
+        close_pipeline(lecture_id)
+        raise
+    if pipeline.stopped:
+        close_pipeline(lecture_id)
+        return False
+    return True
+
+
+class AttendanceScheduler(object):
+    """
+    Maps running lectures to worker processes and keeps their turns coming
+    """
+    def __init__(self, workers=None, budget=None):
+        """
+        :param workers: number of worker processes (default: settings.ATTENDANCE_WORKERS)
+        :param budget: frames per turn (default: settings.ATTENDANCE_FRAME_BUDGET)
+        """
+        self.workers = workers or settings.ATTENDANCE_WORKERS
+        self.budget = budget or settings.ATTENDANCE_FRAME_BUDGET
+        self.executors = [None] * self.workers
+        # lecture id -> (worker, frame source)
+        self.lectures = dict()
+        # reentrant, done callbacks of already finished futures run in the submitting thread
+        self.lock = threading.RLock()
+
+    def executor(self, worker):
+        if self.executors[worker] is None:
+            # spawned rather than forked, the parent holds threads and sockets
+            # (control channel, capture services) that must not be copied
+            self.executors[worker] = ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_worker)
+        return self.executors[worker]
+
+    def assign(self, source):
+        """
+        Worker for a new lecture, the one already reading its frame source
+        since a device can only be opened once, otherwise the least loaded one
+        """
+        load = [0] * self.workers
+        for worker, lecture_source in self.lectures.values():
+            if lecture_source == source:
+                return worker
+            load[worker] += 1
+        return load.index(min(load))
+
+    def submit(self, lecture_id, source=None):
+        """
+        Start taking attendance of a lecture
+
+        :param source: key of settings.FRAME_SOURCES (default: settings.DEFAULT_FRAME_SOURCE)
+        :return: False if the lecture is already running
+        """
+        source = source or settings.DEFAULT_FRAME_SOURCE
+        with self.lock:
+            if lecture_id in self.lectures:
+                return False
+            worker = self.assign(source)
+            self.lectures[lecture_id] = (worker, source)
+            self.schedule(lecture_id)
+        logger.info("Lecture %s scheduled on attendance worker %d reading %s", lecture_id, worker, source)
+        return True
+
+    def schedule(self, lecture_id):
+        worker, source = self.lectures[lecture_id]
+        future = self.executor(worker).submit(run_turn, lecture_id, source, self.budget)
+        future.add_done_callback(partial(self.finished, lecture_id))
+
+    def finished(self, lecture_id, future):
+        try:
+            running = future.result()
+        except BrokenProcessPool as exc:
+            logger.error("Attendance worker of lecture %s died: %r", lecture_id, exc)
+            running = False
+            with self.lock:
+                worker, _ = self.lectures[lecture_id]
+                self.executors[worker] = None
+        except Exception as exc:
+            logger.exception("Lecture %s attendance failed", lecture_id)
+            running = False
+        with self.lock:
+            if running:
+                # back of the worker's queue, behind the other lectures pinned to it
+                self.schedule(lecture_id)
+            else:
+                self.lectures.pop(lecture_id, None)
+
+    def running(self):
+        """
+        Worker of every running lecture
+        """
+        with self.lock:
+            return {lecture_id: worker for lecture_id, (worker, _) in self.lectures.items()}
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            executors, self.executors = self.executors, [None] * self.workers
+        for executor in executors:
+            if executor is not None:
+                executor.shutdown(wait=wait)
+
+
+def get_scheduler():
+    """
+    The process wide attendance scheduler
+    """
+    global scheduler
+
+    with scheduler_lock:
+        if scheduler is None:
+            scheduler = AttendanceScheduler()
+    return scheduler
@@ -0,0 +1,206 @@
+"""
+Live preview stream shared by every viewer of a frame source
+"""
+import time
+import logging
+import threading
+import cv2
+import imutils
+from django.conf import settings
+
+from fuskar.utils.camera import get_capture, release_unused_capture
+from fuskar.utils.control import get_control_channel, STREAM_STOP
+from fuskar.artificial.detectors import get_detector
+
+logger = logging.getLogger(__name__)
+
+# frame broadcasters of this process keyed by settings.FRAME_SOURCES name
+frame_broadcasters = dict()
+frame_broadcasters_lock = threading.Lock()
+
+
+def annotate(frame):
+    """
+    Draw the boxes the preview detector finds on a copy of the frame
+    """
+    frame = frame.copy()
+    for top, right, bottom, left in get_detector('preview').detect([frame])[0]:
+        cv2.rectangle(frame, (left, top), (right, bottom), (0, 0, 255), 2)
+    return frame
+
+
+def encode(frame, width, quality):
+    """
+    JPEG bytes of a frame resized to width, None if encoding failed
+    """
+    if width and width < frame.shape[1]:
+        frame = imutils.resize(frame, width=width)
+    ret, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return jpeg.tobytes() if ret else None
+
+
+class FrameBroadcaster(threading.Thread):
+    """
+    Single producer of a frame source's preview: reads the capture service,
+    annotates and JPEG encodes each frame once and publishes the latest one
+    with a sequence number. Subscribers only ever get the newest frame, a slow
+    viewer skips frames instead of holding up the producer or other viewers.
+    Other sizes and qualities are encoded on demand, once per frame and variant.
+
+    The producer stops once it had no subscribers for STREAM_IDLE_TIMEOUT seconds
+    and then releases the frame source, so an attendance worker can open its camera.
+    """
+    def __init__(self, source=None):
+        threading.Thread.__init__(self, name=f"Frame Broadcaster Thread ({source})", daemon=True)
+        self.source = source or settings.DEFAULT_FRAME_SOURCE
+        self.condition = threading.Condition()
+        self.sequence = 0
+        self.frame = None
+        self.jpeg = None
+        # (width, quality) -> (sequence, jpeg) of the latest frame encoded that way
+        self.variants = dict()
+        self.variants_lock = threading.Lock()
+        self.subscribers = 0
+        self.idle_since = time.time()
+        self.isRunning = True
+        self.encoded = 0
+
+    def run(self):
+        try:
+            self.produce()
+        finally:
+            # under the registry lock, a viewer arriving meanwhile starts a new producer
+            # only once this one released the source
+            with frame_broadcasters_lock:
+                with self.condition:
+                    self.isRunning = False
+                    self.condition.notify_all()
+                if frame_broadcasters.get(self.source) is self:
+                    release_unused_capture(self.source)
+
+    def produce(self):
+        capture = get_capture(self.source)
+        last_index = 0
+        while self.isRunning:
+            with self.condition:
+                if not self.subscribers and time.time() - self.idle_since >= settings.STREAM_IDLE_TIMEOUT:
+                    break
+            latest = capture.latest(after=last_index, timeout=settings.CAMERA_READ_TIMEOUT)
+            if latest is None:
+                if not capture.running:
+                    # viewers subscribe again, which reopens the source
+                    break
+                continue
+            last_index = latest.index
+            frame = annotate(latest.image)
+            jpeg = encode(frame, settings.STREAM_WIDTH, settings.STREAM_JPEG_QUALITY)
+            if jpeg is None:
+                continue
+            with self.condition:
+                self.frame = frame
+                self.jpeg = jpeg
+                self.sequence += 1
+                self.encoded += 1
+                self.condition.notify_all()
+
+    def latest(self, after=0, timeout=None):
+        """
+        The newest (sequence, jpeg) published after `after`,
+        None if nothing new was published within timeout
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.sequence > after or not self.isRunning, timeout=timeout)
+            if self.sequence > after:
+                return self.sequence, self.jpeg
+        return None
+
+    def variant(self, width, quality):
+        """
+        The current (sequence, jpeg) at another width and quality,
+        encoded once per frame no matter how many viewers ask for it
+        """
+        with self.condition:
+            sequence, frame, jpeg = self.sequence, self.frame, self.jpeg
+        if frame is None or (width, quality) == (settings.STREAM_WIDTH, settings.STREAM_JPEG_QUALITY):
+            return sequence, jpeg
+        with self.variants_lock:
+            cached = self.variants.get((width, quality))
+            if cached and cached[0] >= sequence:
+                return cached
+            jpeg = encode(frame, width, quality)
+            self.variants[(width, quality)] = (sequence, jpeg)
+            self.encoded += 1
+        return sequence, jpeg
+
+    def acquire(self):
+        """
+        Register a viewer, keeping the producer running
+        """
+        with self.condition:
+            self.subscribers += 1
+
+    def release(self):
+        with self.condition:
+            self.subscribers -= 1
+            if not self.subscribers:
+                self.idle_since = time.time()
+
+    def subscribe(self, stop=None):
+        """
+        Yield the newest jpeg every time one is published until stop is set,
+        the last jpeg is repeated while the source delivers nothing new
+        """
+        self.acquire()
+        try:
+            seen = 0
+            while not (stop and stop.is_set()) and self.isRunning:
+                published = self.latest(after=seen, timeout=settings.CAMERA_READ_TIMEOUT)
+                if published:
+                    seen, jpeg = published
+                    yield jpeg
+                elif self.jpeg is not None:
+                    yield self.jpeg
+        finally:
+            self.release()
+
+    def stop(self):
+        self.isRunning = False
+
+    def stats(self):
+        with self.condition:
+            return {"source": self.source, "subscribers": self.subscribers, "encoded": self.encoded}
+
+
+def get_frame_broadcaster(source=None):
+    """
+    The running frame broadcaster of a frame source, started on first use
+    """
+    source = source or settings.DEFAULT_FRAME_SOURCE
+    with frame_broadcasters_lock:
+        frame_broadcaster = frame_broadcasters.get(source)
+        if frame_broadcaster is None or not frame_broadcaster.isRunning:
+            frame_broadcaster = frame_broadcasters[source] = FrameBroadcaster(source)
+            frame_broadcaster.start()
+    return frame_broadcaster
+
+
+def video_stream(source=None):
+    """
+    Yield each frame to create the effect of a realtime video
+    """
+    stop = get_control_channel().event(STREAM_STOP)
+
+    # send StreamHTTPResponse formated responses (in bytes)
+    logger.debug("Subscribing to the camera preview [bytes mode]")
+    while not stop.is_set():
+        # the producer may have gone idle between lookup and subscription, resubscribe to a new one
+        streamed = False
+        for frame in get_frame_broadcaster(source).subscribe(stop=stop):
+            streamed = True
+            yield (b'--frame\r\n'
+                    b'Access-Control-Allow-Origin: *\r\n'
+                    b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n\r\n')
+        if not streamed:
+            # the source could not be opened
+            break
+    return True
@@ -0,0 +1,120 @@
+"""
+Face tracking across frames so recognised students are not encoded again on every frame
+"""
+import time
+import itertools
+from django.conf import settings
+
+
+def iou(a, b):
+    """
+    Intersection over union of two (top, right, bottom, left) boxes
+    """
+    top, bottom = max(a[0], b[0]), min(a[2], b[2])
+    left, right = max(a[3], b[3]), min(a[1], b[1])
+    if bottom <= top or right <= left:
+        return 0.0
+    intersection = (bottom - top) * (right - left)
+    area_a = (a[2] - a[0]) * (a[1] - a[3])
+    area_b = (b[2] - b[0]) * (b[1] - b[3])
+    return intersection / float(area_a + area_b - intersection)
+
+
+class Track(object):
+    """
+    A face followed across frames and the identity resolved for it
+    """
+    __slots__ = ('id', 'box', 'identity', 'verified_at', 'misses')
+
+    def __init__(self, track_id, box):
+        self.id = track_id
+        self.box = box
+        # student id once recognised, None while unresolved
+        self.identity = None
+        self.verified_at = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f"Track({self.id}, {self.box}, identity={self.identity})"
+
+
+class FaceTracker(object):
+    """
+    Greedy IoU tracker, each detected box continues the unmatched track it overlaps most
+    or starts a new one, tracks missing for more than max_misses updates are dropped
+    """
+    def __init__(self, iou_threshold=None, max_misses=None, reverify_interval=None):
+        """
+        :param iou_threshold: minimum overlap continuing a track (default: settings.TRACKING_IOU_THRESHOLD)
+        :param max_misses: updates a track survives without a matching box (default: settings.TRACKING_MAX_MISSES)
+        :param reverify_interval: seconds after which a resolved track is recognised again (default: settings.TRACKING_REVERIFY_INTERVAL)
+        """
+        self.iou_threshold = iou_threshold or settings.TRACKING_IOU_THRESHOLD
+        self.max_misses = settings.TRACKING_MAX_MISSES if max_misses is None else max_misses
+        self.reverify_interval = reverify_interval or settings.TRACKING_REVERIFY_INTERVAL
+        self.tracks = list()
+        self.ids = itertools.count(1)
+        self.encoded = 0
+        self.reused = 0
+
+    def update(self, boxes):
+        """
+        Match the boxes of a frame to the current tracks
+
+        :return: track of every box, in the order of boxes
+        """
+        pairs = sorted(
+            ((iou(track.box, box), track_index, box_index)
+             for track_index, track in enumerate(self.tracks)
+             for box_index, box in enumerate(boxes)),
+            reverse=True)
+        matched = [None] * len(boxes)
+        used = set()
+        for overlap, track_index, box_index in pairs:
+            if overlap < self.iou_threshold:
+                break
+            if track_index in used or matched[box_index] is not None:
+                continue
+            used.add(track_index)
+            track = self.tracks[track_index]
+            track.box = tuple(boxes[box_index])
+            track.misses = 0
+            matched[box_index] = track
+
+        survivors = list()
+        for track_index, track in enumerate(self.tracks):
+            if track_index not in used:
+                track.misses += 1
+                if track.misses > self.max_misses:
+                    continue
+            survivors.append(track)
+        for box_index, box in enumerate(boxes):
+            if matched[box_index] is None:
+                matched[box_index] = Track(next(self.ids), tuple(box))
+                survivors.append(matched[box_index])
+        self.tracks = survivors
+        return matched
+
+    def needs_recognition(self, track, now=None):
+        """
+        Whether the face of a track has to be encoded and classified:
+        new or unresolved tracks, and resolved ones due for re-verification
+        """
+        now = now or time.time()
+        return track.identity is None or now - track.verified_at >= self.reverify_interval
+
+    def resolve(self, track, identity, now=None):
+        """
+        Record the classification of a track, "unknown" leaves it unresolved
+        """
+        track.identity = None if identity == "unknown" else identity
+        track.verified_at = now or time.time()
+
+    def stats(self):
+        total = self.encoded + self.reused
+        return {
+            "tracks": len(self.tracks),
+            "encoded": self.encoded,
+            "reused": self.reused,
+            "reuse_ratio": round(self.reused / total, 3) if total else 0,
+        }
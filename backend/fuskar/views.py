@@ -1,14 +1,21 @@
+import logging
+import zipfile
 import face_recognition
 from django.utils import timezone
 from django.shortcuts import render
-from django.http import StreamingHttpResponse
+from django.http import StreamingHttpResponse, HttpResponse
 from django.http import HttpResponseRedirect
 from django.core.exceptions import ObjectDoesNotExist
-from django.views.decorators import gzip
 from rest_framework import viewsets, status
 from fuskar.models import Student, Image, Course, Lecture, Capturing, Emotion
-from fuskar.utils.camera import video_stream
+from fuskar.utils.stream import video_stream
 from fuskar.utils.helpers import get_hash
+from fuskar.utils.phash import phash, find_near_duplicates, update_index
+from fuskar.utils.control import get_control_channel, STREAM_STOP
+from fuskar.utils.enrolment import bulk_enrol, entries_from_archive, entries_from_files
+from fuskar.tasks import request_retrain
+from fuskar.artificial.inference import get_inference
+from fuskar.utils import metrics as fuskar_metrics
 from fuskar.serializers import (
                         StudentSerializer, 
                         ImageSerializer, 
@@ -22,6 +29,8 @@ from fuskar.serializers import (
 from rest_framework.decorators import action, api_view
 from rest_framework.response import Response
 
+logger = logging.getLogger(__name__)
+
 class ImageViewSet(viewsets.ModelViewSet):
     """
     Viewset for handling image queries 
@@ -41,13 +50,29 @@ class ImageViewSet(viewsets.ModelViewSet):
             return Response(
                 {'detail': "No image sent"},
                 status=status.HTTP_406_NOT_ACCEPTABLE)
-        face = face_recognition.load_image_file(image)
-        face_bounding_boxes = face_recognition.face_locations(face, model='cnn')
+        # cheap uniqueness checks first so bad uploads never reach the CNN
+        hashval = get_hash(image)
+        if Image.objects.filter(hashval=hashval).exists():
+            return Response(
+                {'detail': "Image is an exact duplicate of an existing image"},
+                status=status.HTTP_406_NOT_ACCEPTABLE)
+        perceptual_hash = phash(image)
+        near_duplicates = find_near_duplicates(perceptual_hash)
+        if near_duplicates:
+            return Response(
+                {'detail': f"Image is a near duplicate of image(s) {near_duplicates}"},
+                status=status.HTTP_406_NOT_ACCEPTABLE)
+        # uploads load as rgb, the inference models take bgr frames like the camera's
+        face = face_recognition.load_image_file(image)[:, :, ::-1]
+        inference = get_inference()
+        face_bounding_boxes = inference.detect([face], 'enrolment')[0]
         if len(face_bounding_boxes) == 1 :
-            print("Image accepted as image contained only one face, checking uniqueness")
-            # check image uniqueness
-            image = request.data.copy()['file']
-            hashval = get_hash(image)
+            logger.info("Image accepted as image contained only one face")
+            # keep the detected face so training does not run the CNN again
+            encoding = inference.encode(face, face_bounding_boxes)[0]
+            self.face_fields = Image.face_fields(face_bounding_boxes[0], encoding)
+            self.face_fields['phash'] = format(perceptual_hash, '016x')
+            image.seek(0)
             request._full_data['hashval'] = hashval
             return super(ImageViewSet, self).create(request, *args, **kwargs)
         else:
@@ -55,6 +80,38 @@ class ImageViewSet(viewsets.ModelViewSet):
                 {'detail': "Image contains no recognizable face or multiple faces"},
                 status=status.HTTP_406_NOT_ACCEPTABLE)
 
+    def perform_create(self, serializer):
+        instance = serializer.save(**getattr(self, 'face_fields', {}))
+        if instance.phash:
+            update_index(added=[(int(instance.phash, 16), instance.id)])
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """
+        Enrol many photos at once, either a zip archive laid out as <student id>/<photo>
+        or multipart `files` with an `owner` per file or a single `owner` for all of them
+
+        Returns a per file report and triggers a single retrain
+        """
+        if 'archive' in request.FILES:
+            try:
+                entries = entries_from_archive(request.FILES['archive'])
+            except zipfile.BadZipFile:
+                return Response(
+                    {'detail': "Archive is not a valid zip file"},
+                    status=status.HTTP_406_NOT_ACCEPTABLE)
+        else:
+            entries = entries_from_files(request.FILES.getlist('files'), request.data.getlist('owner'))
+        if not entries:
+            return Response(
+                {'detail': "No image sent"},
+                status=status.HTTP_406_NOT_ACCEPTABLE)
+        images, report = bulk_enrol(entries)
+        if images:
+            request_retrain(added=[image.id for image in images])
+        logger.info("Bulk enrolment accepted %d of %d image(s)", len(images), len(entries))
+        return Response({'created': len(images), 'results': report}, status=status.HTTP_201_CREATED)
+
 class EmotionViewSet(viewsets.ModelViewSet):
     """
     Viewset for handling emotion queries 
@@ -89,8 +146,8 @@ class CourseViewSet(viewsets.ModelViewSet):
         Returns all emotions for a particular course
         """
         course = Course.objects.get(id=pk)
-        # get all lectures for that course
-        queryset = course.lecture_set
+        # get all lectures for that course with their emotion rollups
+        queryset = course.lecture_set.prefetch_related('emotion_buckets')
         serializer = self.emotion_serializer(queryset.all(), many=True)
         return Response(serializer.data)
 
@@ -159,8 +216,22 @@ class LectureViewSet(viewsets.ModelViewSet):
    Viewset for handling lecture queries 
     """
     serializer_class = LectureSerializer
-    queryset = Lecture.objects.all()
-    emotion_serializer = EmotionSerializer
+    queryset = Lecture.objects.prefetch_related('emotion_buckets')
+    emotion_serializer = CourseEmotionSerializer
+
+    @action(detail=True, methods=['get'])
+    def emotions(self, request, pk=None):
+        """
+        Returns the emotion totals and timeline of a lecture
+        """
+        try:
+            lecture = self.get_queryset().get(id=pk)
+        except ObjectDoesNotExist:
+            return Response(
+                {'detail': "lecture {} does not exist".format(pk)},
+                status=status.HTTP_406_NOT_ACCEPTABLE)
+        serializer = self.emotion_serializer(lecture)
+        return Response(serializer.data)
 
 
     @action(detail=True, methods=['post'])
@@ -184,28 +255,41 @@ class LectureViewSet(viewsets.ModelViewSet):
             # save time of stoppage as now
             lecture_object.lock = True
             lecture_object.stopped_at = now
+            # saving stopped_at signals the attendance loop to end
             lecture_object.save()
-            # send signal to end attendance taking
             serializer = self.get_serializer(lecture_object)
             return Response(serializer.data)
 
 
-@gzip.gzip_page
 @api_view(['get', 'post'])
 def get_stream(request):
     """
-    Stream the video coming from connected camera
+    Stream the video coming from connected camera,
+    /video/live streams the same frames without holding a worker thread per viewer
     """
-    Capturing.objects.create()
-    response = StreamingHttpResponse(video_stream(), content_type="multipart/x-mixed-replace;boundary=frame")
     if request.method == "GET":
-        return response
+        Capturing.objects.create()
+        get_control_channel().clear(STREAM_STOP)
+        return StreamingHttpResponse(video_stream(), content_type="multipart/x-mixed-replace;boundary=frame")
     elif request.method == "POST":
         capturing = Capturing.objects.last()
-        capturing.stop = True
-        capturing.save()
-        response.close()
+        if capturing:
+            capturing.stop = True
+            capturing.save()
+        channel = get_control_channel()
+        # the flag ends the legacy stream until its next GET,
+        # the message stops every /video/live viewer connected at this point
+        channel.signal(STREAM_STOP)
+        channel.publish(STREAM_STOP)
         return Response(
                     {"detail": "Stopped video stream"},
                     status=status.HTTP_202_ACCEPTED
-                )
\ No newline at end of file
+                )
+
+
+def metrics(request):
+    """
+    Pipeline, cache and broadcast metrics of every fuskar process in the prometheus text format
+    """
+    body, content_type = fuskar_metrics.render()
+    return HttpResponse(body, content_type=content_type)
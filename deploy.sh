@@ -55,6 +55,8 @@ sudo cp "$nginx_conf" "$sites_available"
 # TODO: start up all services and check statuses
 # enable redis-server service
 sudo systemctl enable redis-server.service
+# enable inference worker
+sudo systemctl enable fuskar-inference.service
 # enable huey-service
 sudo systemctl enable fuskar-huey-composer.service
 # enable backend service